@@ -0,0 +1,92 @@
+"""
+Benchmark: previous local fallback vs the fallback engine (single process and process pool).
+
+Pillow only, no network:
+
+    python benchmarks/bench_fallback.py --images 24 --size 2048x1536 --workers 4
+"""
+
+import argparse
+import io
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageChops, ImageDraw, ImageOps
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fallback_engine import render_fallback  # noqa: E402
+
+
+def legacy_fallback_process(image_bytes: bytes) -> tuple[bytes, str, str]:
+    """Implementation the engine replaces (RGBA/RGB round-trips + full-size overlay)."""
+    img = Image.open(io.BytesIO(image_bytes)).convert("RGBA")
+    img = ImageOps.invert(img.convert("RGB")).convert("RGBA")
+
+    overlay = Image.new("RGBA", img.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+
+    text = "DEMO - FALLBACK (OpenAI unavailable / billing)"
+    draw.text((20, 20), text, fill=(255, 0, 0, 200))
+
+    img = Image.alpha_composite(img, overlay)
+
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="PNG")
+    return buf.getvalue(), "image/png", "png"
+
+
+def _sample_jpeg(width: int, height: int) -> bytes:
+    # Gradient + noise: compresses like a photo, not like a flat colour
+    img = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    img = Image.blend(img, Image.effect_noise((width, height), 64).convert("RGB"), 0.5)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def _report(label: str, elapsed: float, images: int, out_bytes: int) -> None:
+    print(
+        f"{label:<28} {images} images in {elapsed:7.3f}s  "
+        f"({images / elapsed:6.2f} img/s, {1000 * elapsed / images:7.1f} ms/img, avg PNG {out_bytes // images // 1024} KiB)"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=24)
+    parser.add_argument("--size", default="2048x1536")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.lower().split("x"))
+    src = _sample_jpeg(width, height)
+    print(f"input: {width}x{height} JPEG, {len(src) // 1024} KiB, {args.images} images, {args.workers} workers")
+
+    # Same picture (blend rounding aside)
+    legacy = Image.open(io.BytesIO(legacy_fallback_process(src)[0]))
+    engine = Image.open(io.BytesIO(render_fallback(src)[0]))
+    extrema = ImageChops.difference(legacy, engine).getextrema()
+    print(f"max per-channel difference vs previous output: {max(hi for _lo, hi in extrema)}")
+
+    start = time.perf_counter()
+    size = sum(len(legacy_fallback_process(src)[0]) for _ in range(args.images))
+    _report("previous (sequential)", time.perf_counter() - start, args.images, size)
+
+    start = time.perf_counter()
+    size = sum(len(render_fallback(src)[0]) for _ in range(args.images))
+    _report("engine (sequential)", time.perf_counter() - start, args.images, size)
+
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        list(pool.map(render_fallback, [src] * args.workers))  # warm-up: spawn + imports
+        start = time.perf_counter()
+        size = sum(len(out[0]) for out in pool.map(render_fallback, [src] * args.images))
+        _report(f"engine (pool x{args.workers})", time.perf_counter() - start, args.images, size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Microbenchmark: per-call boto3 clients vs the shared, pooled S3/COS client.
+
+Runs against a local moto server (no COS credentials, no network):
+
+    pip install -r benchmarks/requirements.txt
+    python benchmarks/bench_s3_client.py --ops 200 --concurrency 8
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from moto.server import ThreadedMotoServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _configure_env(port: int, workdir: str) -> None:
+    # main opens its SQLite files at import: keep them out of the current directory
+    os.environ.update(
+        COS_ENDPOINT=f"http://127.0.0.1:{port}",
+        COS_REGION="us-east-1",
+        COS_ACCESS_KEY_ID="bench",
+        COS_SECRET_ACCESS_KEY="bench",
+        COS_INPUT_BUCKET="bench-input",
+        COS_OUTPUT_BUCKET="bench-output",
+        CALLBACK_QUEUE_PATH=os.path.join(workdir, "callbacks.db"),
+        JOB_STORE_PATH=os.path.join(workdir, "jobs.db"),
+        JOB_QUEUE_PATH=os.path.join(workdir, "jobqueue.db"),
+    )
+
+
+def _run(label: str, op, ops: int, concurrency: int) -> float:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(op, range(ops)))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {ops} ops in {elapsed:7.3f}s  ({ops / elapsed:8.1f} ops/s, {1000 * elapsed / ops:6.2f} ms/op)")
+    return elapsed
+
+
+def main_bench() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--ops", type=int, default=200, help="put+get round trips per variant")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--size", type=int, default=64 * 1024, help="object size in bytes")
+    parser.add_argument("--port", type=int, default=5055)
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=args.port, verbose=False)
+    server.start()
+    workdir = tempfile.mkdtemp(prefix="wxo-bench-s3-")
+    try:
+        _configure_env(args.port, workdir)
+        import main  # imported after env so the COS config points at moto
+
+        main.make_s3_client().create_bucket(Bucket=main.COS_OUTPUT_BUCKET)
+        body = os.urandom(args.size)
+
+        def per_call(i: int) -> None:
+            key = f"bench/per-call/{i}.bin"
+            main.make_s3_client().put_object(Bucket=main.COS_OUTPUT_BUCKET, Key=key, Body=body)
+            main.make_s3_client().get_object(Bucket=main.COS_OUTPUT_BUCKET, Key=key)["Body"].read()
+
+        def shared(i: int) -> None:
+            key = f"bench/shared/{i}.bin"
+            main.put_object_bytes(main.COS_OUTPUT_BUCKET, key, body, "application/octet-stream")
+            main.get_object_bytes(main.COS_OUTPUT_BUCKET, key)
+
+        main.get_s3_client()  # lazy init outside the timed section, like a warm worker
+        t_per_call = _run("per-call clients", per_call, args.ops, args.concurrency)
+        t_shared = _run("shared pooled client", shared, args.ops, args.concurrency)
+        print(f"speedup: x{t_per_call / t_shared:.2f}")
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_bench()
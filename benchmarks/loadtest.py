@@ -0,0 +1,278 @@
+"""
+Offline load test: the real service (uvicorn main:app, separate process) against local stand-ins
+for OpenAI, COS (moto) and the callback receiver. No credentials, no network.
+
+    pip install -r requirements.txt -r benchmarks/requirements.txt
+    python benchmarks/loadtest.py --requests 200 --concurrency 20 --openai-latency 2
+    python benchmarks/loadtest.py --endpoint batch --batch-jobs 2 --batch-images 50
+    python benchmarks/loadtest.py --endpoint batch --batch-prompts 3 --batch-formats jpeg,webp
+    python benchmarks/loadtest.py --openai-rpm 60 --callback-error-rate 0.2 --env CALLBACK_BACKOFF_SECONDS=0.5
+    python benchmarks/loadtest.py --endpoint b64 --result-edge 2048 --env CALLBACK_COMPRESSION=gzip
+    python benchmarks/loadtest.py --endpoint url --openai-latency 5 --deadline 8 --env OPENAI_EXPECTED_SECONDS=5
+
+Per endpoint: accept latency (POST -> 202), completion latency (POST -> callback received),
+throughput, 429s, failed jobs and callback body sizes. Peak RSS is the service's VmHWM (Linux).
+Each request gets its own prompt, so the result cache does not short-circuit OpenAI.
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import boto3
+import httpx
+
+from stand_ins import CallbackSink, FakeOpenAI, free_port, percentile, sample_image, serve_in_thread, start_moto, wait_for
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = {
+    "url": "/process-image-async",
+    "b64": "/process-image-async-b64",
+    "batch": "/batch-process-images",
+}
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoint", action="append", choices=sorted(ENDPOINTS), help="repeatable (default: all three)")
+    parser.add_argument("--requests", type=int, default=50, help="single-image requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=10, help="requests in flight from the client")
+    parser.add_argument("--image-edge", type=int, default=1024, help="input image size (px, square JPEG)")
+    parser.add_argument("--batch-jobs", type=int, default=1)
+    parser.add_argument("--batch-images", type=int, default=20, help="objects in the input bucket")
+    parser.add_argument("--batch-prompts", type=int, default=1, help="prompts per batch job (fan-out)")
+    parser.add_argument("--batch-formats", default="", help="comma-separated output_formats per batch job (fan-out)")
+    parser.add_argument("--openai-latency", type=float, default=1.0)
+    parser.add_argument("--openai-jitter", type=float, default=0.2)
+    parser.add_argument("--openai-429-rate", type=float, default=0.0)
+    parser.add_argument("--openai-billing-rate", type=float, default=0.0)
+    parser.add_argument("--openai-5xx-rate", type=float, default=0.0, help="share of 503s (outage)")
+    parser.add_argument("--openai-rpm", type=int, default=0, help="requests/minute before 429 (0 = unlimited)")
+    parser.add_argument("--result-edge", type=int, default=1024, help="size of the image OpenAI returns")
+    parser.add_argument("--callback-latency", type=float, default=0.0)
+    parser.add_argument("--callback-error-rate", type=float, default=0.0)
+    parser.add_argument("--deadline", type=float, default=None, help="x-deadline-seconds sent with each job")
+    parser.add_argument("--timeout", type=float, default=600, help="max wait for callbacks per endpoint (s)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra service env var")
+    parser.add_argument("--service-log", default="", help="file for the service stdout/stderr (default: discarded)")
+    return parser.parse_args()
+
+
+def _service_env(args, workdir: str, moto_port: int, openai_port: int) -> dict:
+    env = dict(os.environ)
+    env.update(
+        OPENAI_API_KEY="loadtest",
+        OPENAI_BASE_URL=f"http://127.0.0.1:{openai_port}/v1",
+        COS_ENDPOINT=f"http://127.0.0.1:{moto_port}",
+        COS_REGION="us-east-1",
+        COS_ACCESS_KEY_ID="loadtest",
+        COS_SECRET_ACCESS_KEY="loadtest",
+        COS_INPUT_BUCKET="loadtest-input",
+        COS_OUTPUT_BUCKET="loadtest-output",
+        CALLBACK_QUEUE_PATH=os.path.join(workdir, "callbacks.db"),
+        JOB_STORE_PATH=os.path.join(workdir, "jobs.db"),
+        JOB_QUEUE_PATH=os.path.join(workdir, "jobqueue.db"),
+        UPLOAD_TMP_DIR=os.path.join(workdir, "uploads"),
+        PYTHONUNBUFFERED="1",
+    )
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key.strip()] = value
+    return env
+
+
+def _peak_rss_mib(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+
+def _seed_batch_inputs(moto_port: int, count: int, edge: int) -> None:
+    s3 = boto3.client(
+        "s3",
+        endpoint_url=f"http://127.0.0.1:{moto_port}",
+        region_name="us-east-1",
+        aws_access_key_id="loadtest",
+        aws_secret_access_key="loadtest",
+    )
+    for bucket in ("loadtest-input", "loadtest-output"):
+        s3.create_bucket(Bucket=bucket)
+    for i in range(count):
+        s3.put_object(Bucket="loadtest-input", Key=f"img-{i:05d}.jpg", Body=sample_image(edge, seed=i), ContentType="image/jpeg")
+
+
+async def _drive(
+    base_url: str, callback_url: str, name: str, bodies: list, concurrency: int, deadline=None
+) -> tuple[dict, list, dict]:
+    """
+    POST every body with at most `concurrency` in flight.
+    Returns ({job_id: submitted_at}, accept latencies, {status_code: count}).
+    """
+    submitted: dict = {}
+    accept: list = []
+    codes: dict = {}
+    slots = asyncio.Semaphore(max(concurrency, 1))
+    headers = {"callbackUrl": callback_url}
+    if deadline is not None:
+        headers["x-deadline-seconds"] = str(deadline)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+
+        async def one(body: dict) -> None:
+            async with slots:
+                start = time.monotonic()
+                try:
+                    r = await client.post(ENDPOINTS[name], json=body, headers=headers)
+                    code = r.status_code
+                except httpx.HTTPError as e:
+                    code = type(e).__name__
+                elapsed = time.monotonic() - start
+                codes[code] = codes.get(code, 0) + 1
+                if code == 202:
+                    accept.append(elapsed)
+                    submitted[r.json()["job_id"]] = start
+
+        await asyncio.gather(*(one(body) for body in bodies))
+    return submitted, accept, codes
+
+
+def _fmt(seconds) -> str:
+    return "-" if seconds is None else f"{seconds * 1000:8.0f}ms" if seconds < 10 else f"{seconds:8.1f}s "
+
+
+def _report(name: str, submitted: dict, accept: list, codes: dict, sink: CallbackSink, started: float, rss: float) -> None:
+    arrivals = {job_id: sink.arrivals[job_id] for job_id in submitted if job_id in sink.arrivals}
+    done = [a["at"] - submitted[job_id] for job_id, a in arrivals.items()]
+    statuses: dict = {}
+    for a in arrivals.values():
+        statuses[a["status"]] = statuses.get(a["status"], 0) + 1
+    last = max((a["at"] for a in arrivals.values()), default=time.monotonic())
+    wall = max(last - started, 1e-9)
+
+    print(f"\n== {name} ({ENDPOINTS[name]}) ==")
+    print(f"  HTTP codes      : {dict(sorted(codes.items(), key=str))}")
+    print(f"  callbacks       : {len(arrivals)}/{len(submitted)} {statuses}")
+    errors: dict = {}
+    for a in arrivals.values():
+        if a["payload"].get("error"):
+            # Group by message without the figures (seconds left, sizes...)
+            key = re.sub(r"[\d.]+", "N", a["payload"]["error"])[:100]
+            errors[key] = errors.get(key, 0) + 1
+    for message, count in sorted(errors.items(), key=lambda kv: -kv[1])[:3]:
+        print(f"  error x{count:<8}: {message}")
+    print("                     p50        p95        p99        max")
+    for label, values in (("  accept latency", accept), ("  completion    ", done)):
+        print(f"{label}  " + "   ".join(_fmt(percentile(values, p)) for p in (50, 95, 99, 100)))
+    print(f"  throughput      : {len(arrivals) / wall:.2f} jobs/s over {wall:.1f}s")
+    wire = [a["wire_bytes"] / 1024 for a in arrivals.values()]
+    if wire:
+        print(f"  callback body   : p50 {percentile(wire, 50):.0f} KiB, max {max(wire):.0f} KiB on the wire")
+    if name == "b64":
+        deliveries: dict = {}
+        for a in arrivals.values():
+            key = a["payload"].get("delivery", "-")
+            deliveries[key] = deliveries.get(key, 0) + 1
+        print(f"  b64 delivery    : {deliveries}")
+    if name == "batch":
+        images = sum(a["payload"].get("processed", 0) for a in arrivals.values())
+        print(f"  batch images    : {images} processed, {images / wall:.2f} images/s")
+        for a in arrivals.values():
+            for v in a["payload"].get("variants") or []:
+                print(f"  variant {v['name']:<8}: processed {v['processed']}, failed {v['failed']}, fallback {v['fallback_local']}")
+    print(f"  service peak RSS: {rss:.0f} MiB")
+
+
+def main() -> None:
+    args = _parse_args()
+    endpoints = args.endpoint or ["url", "b64", "batch"]
+
+    fake_openai = FakeOpenAI(
+        latency=args.openai_latency,
+        jitter=args.openai_jitter,
+        rate_429=args.openai_429_rate,
+        rate_billing=args.openai_billing_rate,
+        rate_5xx=args.openai_5xx_rate,
+        rpm=args.openai_rpm,
+        result_edge=args.result_edge,
+    )
+    sink = CallbackSink(latency=args.callback_latency, error_rate=args.callback_error_rate)
+    openai_port, sink_port, moto_port, service_port = free_port(), free_port(), free_port(), free_port()
+    serve_in_thread(fake_openai.app, openai_port)
+    serve_in_thread(sink.app, sink_port)
+    moto = start_moto(moto_port)
+    _seed_batch_inputs(moto_port, args.batch_images if "batch" in endpoints else 0, args.image_edge)
+
+    workdir = tempfile.mkdtemp(prefix="wxo-loadtest-")
+    log = open(args.service_log, "w") if args.service_log else subprocess.DEVNULL
+    service = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(service_port), "--no-access-log"],
+        cwd=ROOT,
+        env=_service_env(args, workdir, moto_port, openai_port),
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    base_url = f"http://127.0.0.1:{service_port}"
+    callback_url = f"http://127.0.0.1:{sink_port}/callback"
+
+    def healthy() -> bool:
+        try:
+            return httpx.get(base_url + "/health", timeout=1).status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    try:
+        if not wait_for(healthy, timeout=30):
+            raise SystemExit("service did not start (see --service-log)")
+
+        image_b64 = base64.b64encode(sample_image(args.image_edge)).decode("ascii")
+        print(
+            f"input {args.image_edge}px JPEG ({len(image_b64) // 1024} KiB base64), concurrency {args.concurrency}, "
+            f"OpenAI {args.openai_latency}s +/- {args.openai_jitter}s, service pid {service.pid}"
+        )
+
+        for name in endpoints:
+            if name == "batch":
+                bodies = [
+                    {"prompts": [f"loadtest batch #{i} v{j}" for j in range(max(args.batch_prompts, 1))]}
+                    for i in range(args.batch_jobs)
+                ]
+                if args.batch_formats:
+                    for body in bodies:
+                        body["output_formats"] = args.batch_formats.split(",")
+            else:
+                bodies = [
+                    {"prompt": f"loadtest {name} #{i}", "filename": f"img-{i}.jpg", "image_base64": image_b64}
+                    for i in range(args.requests)
+                ]
+            started = time.monotonic()
+            submitted, accept, codes = asyncio.run(
+                _drive(base_url, callback_url, name, bodies, args.concurrency, args.deadline)
+            )
+            wait_for(lambda: all(job_id in sink.arrivals for job_id in submitted), timeout=args.timeout, interval=0.2)
+            _report(name, submitted, accept, codes, sink, started, _peak_rss_mib(service.pid))
+
+        print(f"\nfake OpenAI : {fake_openai.stats()}")
+        print(f"callback sink: {sink.stats()}")
+    finally:
+        service.terminate()
+        try:
+            service.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            service.kill()
+        moto.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+Local stand-ins for the services main.py talks to, so benchmarks run with no credentials and no network:
+
+- FakeOpenAI: POST /v1/images/edits with configurable latency, rate limit (429), billing errors and outages (503)
+- CallbackSink: records every callback with its arrival time (optional latency / failures, gzip/deflate bodies)
+- start_moto(): moto S3 server standing in for COS
+
+Each stand-in is a small FastAPI app served by uvicorn in a background thread.
+"""
+
+import asyncio
+import base64
+import gzip
+import io
+import json
+import math
+import random
+import socket
+import threading
+import time
+import zlib
+from collections import deque
+from typing import Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from PIL import Image
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_in_thread(app: FastAPI, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"stand-in did not start on port {port}")
+        time.sleep(0.05)
+    return server
+
+
+def sample_image(edge: int, fmt: str = "JPEG", seed: int = 0) -> bytes:
+    """Noise image: compresses like a photo, so transfer sizes are realistic. `seed` varies the bytes."""
+    img = Image.effect_noise((edge, edge), 48 + seed % 16).convert("RGB")
+    img.putpixel((0, 0), (seed % 256, (seed // 256) % 256, 0))
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    return buf.getvalue()
+
+
+class FakeOpenAI:
+    """
+    images.edit stand-in, answering:
+    - 429 (x-ratelimit-* + retry-after headers) if over `rpm` requests in the last minute, or with probability `rate_429`
+    - 400 billing_hard_limit_reached with probability `rate_billing`
+    - 503 (outage) with probability `rate_5xx`, after the usual latency
+    - otherwise 200 with a fixed `result_edge` PNG as b64_json, after `latency` +/- `jitter` seconds
+    """
+
+    def __init__(
+        self,
+        latency: float = 1.0,
+        jitter: float = 0.0,
+        rate_429: float = 0.0,
+        rate_billing: float = 0.0,
+        rate_5xx: float = 0.0,
+        rpm: int = 0,
+        result_edge: int = 1024,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rate_billing = rate_billing
+        self.rate_5xx = rate_5xx
+        self.rpm = rpm
+        self.result_b64 = base64.b64encode(sample_image(result_edge, fmt="PNG")).decode("ascii")
+        self.requests = 0
+        self.ok = 0
+        self.rate_limited = 0
+        self.billing_errors = 0
+        self.server_errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.bytes_in = 0
+        self.qualities: dict = {}
+        self._window: deque = deque()
+        self.app = FastAPI()
+        self.app.post("/v1/images/edits")(self._edits)
+
+    def _rate_limit_headers(self, now: float) -> dict:
+        while self._window and self._window[0] <= now - 60:
+            self._window.popleft()
+        if not self.rpm:
+            return {}
+        reset = max(60 - (now - self._window[0]), 0.0) if self._window else 0.0
+        return {
+            "x-ratelimit-limit-requests": str(self.rpm),
+            "x-ratelimit-remaining-requests": str(max(self.rpm - len(self._window), 0)),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s",
+        }
+
+    async def _edits(self, request: Request):
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            form = await request.form()
+            self.bytes_in += len(await form["image"].read())
+            quality = form.get("quality", "-")
+            self.qualities[quality] = self.qualities.get(quality, 0) + 1
+
+            now = time.monotonic()
+            headers = self._rate_limit_headers(now)
+            if (self.rpm and len(self._window) >= self.rpm) or random.random() < self.rate_429:
+                self.rate_limited += 1
+                retry_after = float(headers.get("x-ratelimit-reset-requests", "1s")[:-1]) if self.rpm else 1.0
+                headers["retry-after"] = str(max(int(retry_after + 0.999), 1))
+                body = {"error": {"message": "Rate limit reached for images", "type": "requests", "code": "rate_limit_exceeded"}}
+                return JSONResponse(body, status_code=429, headers=headers)
+            self._window.append(now)
+
+            if random.random() < self.rate_billing:
+                self.billing_errors += 1
+                body = {
+                    "error": {
+                        "message": "Billing hard limit has been reached",
+                        "type": "billing_limit_user_error",
+                        "code": "billing_hard_limit_reached",
+                    }
+                }
+                return JSONResponse(body, status_code=400)
+
+            await asyncio.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0.0))
+            if random.random() < self.rate_5xx:
+                self.server_errors += 1
+                body = {"error": {"message": "The server is overloaded", "type": "server_error", "code": None}}
+                return JSONResponse(body, status_code=503)
+            self.ok += 1
+            return JSONResponse({"created": int(time.time()), "data": [{"b64_json": self.result_b64}]}, headers=headers)
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "ok": self.ok,
+            "rate_limited": self.rate_limited,
+            "billing_errors": self.billing_errors,
+            "server_errors": self.server_errors,
+            "max_in_flight": self.max_in_flight,
+            "qualities": self.qualities,
+            "mib_in": round(self.bytes_in / 1024 / 1024, 1),
+        }
+
+
+class CallbackSink:
+    """
+    Callback receiver: keeps (arrival time, payload summary) per job_id, answers 200
+    after `latency` seconds, or 500 with probability `error_rate` (exercises retries).
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.arrivals: dict = {}
+        self.attempts = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.compressed = 0
+        self.app = FastAPI()
+        self.app.post("/callback")(self._callback)
+
+    async def _callback(self, request: Request):
+        self.attempts += 1
+        wire = await request.body()
+        self.bytes_in += len(wire)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return JSONResponse({"ok": False}, status_code=500)
+
+        encoding = request.headers.get("content-encoding", "")
+        body = gzip.decompress(wire) if encoding == "gzip" else zlib.decompress(wire) if encoding == "deflate" else wire
+        self.compressed += bool(encoding)
+        payload = json.loads(body)
+        job_id = payload.get("job_id")
+        if job_id not in self.arrivals:
+            self.arrivals[job_id] = {
+                "at": time.monotonic(),
+                "status": payload.get("status"),
+                "bytes": len(body),
+                "wire_bytes": len(wire),
+                "payload": {k: v for k, v in payload.items() if k != "result_image_base64"},
+            }
+        return {"ok": True}
+
+    def stats(self) -> dict:
+        return {
+            "attempts": self.attempts,
+            "errors": self.errors,
+            "received": len(self.arrivals),
+            "compressed": self.compressed,
+            "mib_in": round(self.bytes_in / 1024 / 1024, 1),
+        }
+
+
+def start_moto(port: int):
+    """moto S3 server (pip install -r benchmarks/requirements.txt)."""
+    import logging
+
+    from moto.server import ThreadedMotoServer
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    return server
+
+
+def wait_for(predicate, timeout: float, interval: float = 0.1) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return predicate()
+
+
+def percentile(values: list, pct: float) -> Optional[float]:
+    """Nearest-rank percentile (None for an empty list)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
@@ -0,0 +1,66 @@
+"""
+Local fallback engine (demo continuity): negative image + red "DEMO - FALLBACK" banner.
+
+Kept out of main.py on purpose: main.py runs it in a spawn ProcessPoolExecutor, so pool
+processes import this module (Pillow only) instead of the FastAPI app, the clients and the stores.
+Spawn also re-imports the parent's __main__ module: the entry points (uvicorn, worker.py) must not
+be main.py itself, or each pool process would run all of main's import-time setup again.
+"""
+
+import io
+from functools import lru_cache
+from typing import Optional
+
+from PIL import Image, ImageDraw
+
+FALLBACK_TEXT = "DEMO - FALLBACK (OpenAI unavailable / billing)"
+FALLBACK_TEXT_XY = (20, 20)
+FALLBACK_TEXT_RGBA = (255, 0, 0, 200)
+
+# 255 - v on each of R, G, B: one LUT pass instead of ImageOps.invert round-trips
+_INVERT_LUT = [255 - v for v in range(256)] * 3
+
+
+@lru_cache(maxsize=1)
+def _banner_tile() -> Image.Image:
+    """
+    Text rendered once on a transparent tile just large enough to hold it.
+    """
+    left, top, right, bottom = ImageDraw.Draw(Image.new("RGBA", (1, 1))).textbbox(FALLBACK_TEXT_XY, FALLBACK_TEXT)
+    tile = Image.new("RGBA", (right, bottom), (0, 0, 0, 0))
+    ImageDraw.Draw(tile).text(FALLBACK_TEXT_XY, FALLBACK_TEXT, fill=FALLBACK_TEXT_RGBA)
+    return tile
+
+
+@lru_cache(maxsize=64)
+def banner_overlay(size: tuple[int, int]) -> Optional[tuple[Image.Image, Image.Image]]:
+    """
+    Banner clipped to an image size: (RGB ink, alpha mask), or None if nothing is visible.
+    Batches tend to share a handful of sizes, so this is rendered once per size.
+    """
+    tile = _banner_tile()
+    width, height = min(size[0], tile.width), min(size[1], tile.height)
+    if width <= 0 or height <= 0:
+        return None
+    clipped = tile.crop((0, 0, width, height))
+    return clipped.convert("RGB"), clipped.getchannel("A")
+
+
+def render_fallback(image_bytes: bytes, png_compress_level: int = 1) -> tuple[bytes, str, str]:
+    """
+    Decode once to RGB, invert with a LUT, blend the cached banner in place, save as PNG.
+    Same result as compositing a full-size RGBA overlay, without the intermediate copies.
+    """
+    img = Image.open(io.BytesIO(image_bytes))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    img = img.point(_INVERT_LUT)
+
+    overlay = banner_overlay(img.size)
+    if overlay is not None:
+        ink, mask = overlay
+        img.paste(ink, (0, 0), mask)
+
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", compress_level=png_compress_level)
+    return buf.getvalue(), "image/png", "png"
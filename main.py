@@ -4,34 +4,67 @@
 # - Lightweight workshop "guard": optional shared token header
 # - More robust callbacks: retries with backoff
 # - Optional fallback for single-image endpoints
-# - Soft safety limits: max base64 size + basic concurrency cap
+# - Soft safety limits: max base64 size + admission control (per-lane caps, bounded queues)
 # ==================================================
 
 # ==================================================
 # Imports
 # ==================================================
 import os
+import math
 import io
 import re
 import time
 import base64
 import uuid
 import asyncio
-from typing import Optional, List
-from urllib.parse import urlparse, urlunparse
+import functools
+import contextvars
+import threading
+import hashlib
+import mimetypes
+import json
+import gzip
+import zlib
+import sqlite3
+import shutil
+import tempfile
+import signal
+import socket
+import sys
+import random
+import multiprocessing
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Union, Literal, List, Callable, Awaitable, AsyncIterable, AsyncIterator, Iterator, TypeVar
+from urllib.parse import urlparse, urlunparse, unquote
+from email.utils import parsedate_to_datetime
 
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config as BotoConfig
 from botocore.exceptions import BotoCoreError, ClientError
 
 import httpx
-from fastapi import FastAPI, BackgroundTasks, Header, HTTPException, Request
+from fastapi import FastAPI, BackgroundTasks, Header, HTTPException, Request, Response
 from pydantic import BaseModel, Field
 
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
 
-# Fallback local
-from PIL import Image, ImageOps, ImageDraw
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, start_http_server
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.process_collector import ProcessCollector
+
+# Input preprocessing
+from PIL import Image, ImageOps
+
+# Fallback local (separate module: runs in worker processes)
+from fallback_engine import render_fallback
 
 
 # ==================================================
@@ -50,15 +83,94 @@ CALLBACK_TIMEOUT_SECONDS = float(os.getenv("CALLBACK_TIMEOUT_SECONDS", "30"))
 CALLBACK_MAX_RETRIES = int(os.getenv("CALLBACK_MAX_RETRIES", "3"))  # total attempts
 CALLBACK_BACKOFF_SECONDS = os.getenv("CALLBACK_BACKOFF_SECONDS", "1,3,8").strip()
 
+# Callback dispatcher: shared pooled client + retry queue (SQLite file = survives restarts, empty = memory)
+CALLBACK_CONCURRENCY = int(os.getenv("CALLBACK_CONCURRENCY", "20"))
+CALLBACK_HTTP2 = os.getenv("CALLBACK_HTTP2", "true").strip().lower() == "true"
+CALLBACK_QUEUE_PATH = os.getenv("CALLBACK_QUEUE_PATH", "callbacks.db").strip()
+CALLBACK_QUEUE_POLL_SECONDS = float(os.getenv("CALLBACK_QUEUE_POLL_SECONDS", "1.0"))
+
+# Callback body compression (Content-Encoding): the receiver must accept it, hence off by default
+CALLBACK_COMPRESSION = os.getenv("CALLBACK_COMPRESSION", "none").strip().lower()  # none|gzip|deflate
+CALLBACK_COMPRESS_MIN_BYTES = int(os.getenv("CALLBACK_COMPRESS_MIN_BYTES", "65536"))  # smaller bodies sent as-is
+
 # Optional fallback for single endpoints (demo continuity)
 ENABLE_FALLBACK_SINGLE = os.getenv("ENABLE_FALLBACK_SINGLE", "true").strip().lower() == "true"
 
+# Local fallback engine: process pool so a billing-limited batch uses every core (0 = bounded thread pool)
+FALLBACK_PROCESS_WORKERS = int(os.getenv("FALLBACK_PROCESS_WORKERS", str(os.cpu_count() or 1)))
+FALLBACK_PNG_COMPRESS_LEVEL = int(os.getenv("FALLBACK_PNG_COMPRESS_LEVEL", "1"))  # 0-9, demo output favours speed
+
 # Soft limit: reject overly large base64 payloads (approx; base64 length is ~4/3 bytes)
 # Default: 10 MB decoded ≈ 13.4 MB base64 chars. We'll use 14_000_000 chars as a simple guard.
 MAX_IMAGE_BASE64_CHARS = int(os.getenv("MAX_IMAGE_BASE64_CHARS", "14000000"))
 
-# Soft concurrency cap for in-process BackgroundTasks (workshop safety)
-MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "10"))
+# Size-aware delivery for /process-image-async-b64 (0 = disabled):
+# results over B64_RESULT_BUDGET_BYTES are re-encoded (quality ladder), results still over
+# B64_REFERENCE_MIN_BYTES are uploaded to COS and sent as a presigned URL instead of base64
+B64_RESULT_BUDGET_BYTES = int(os.getenv("B64_RESULT_BUDGET_BYTES", str(4 * 1024 * 1024)))
+B64_REENCODE_FORMAT = os.getenv("B64_REENCODE_FORMAT", "jpeg").strip().lower()  # jpeg|webp (smaller, ~10x slower to encode)
+B64_REENCODE_QUALITIES = os.getenv("B64_REENCODE_QUALITIES", "90,80,65,50").strip()
+B64_REFERENCE_MIN_BYTES = int(os.getenv("B64_REFERENCE_MIN_BYTES", str(8 * 1024 * 1024)))
+
+# Binary upload endpoints (multipart/form-data or raw body): size cap enforced while the body streams in,
+# body written to a temp file in UPLOAD_TMP_DIR (shared with queue-mode workers on the same host)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR", os.path.join(tempfile.gettempdir(), "wxo-uploads")).strip()
+
+# Job scheduler: one lane per kind of work, each with its own concurrency cap and bounded queue.
+# A full queue answers 429 + Retry-After instead of piling up BackgroundTasks.
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "10"))  # single-image lane
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "100"))
+MAX_CONCURRENT_BATCH_JOBS = int(os.getenv("MAX_CONCURRENT_BATCH_JOBS", "2"))
+MAX_QUEUED_BATCH_JOBS = int(os.getenv("MAX_QUEUED_BATCH_JOBS", "10"))
+
+# Job deadlines (seconds, 0 = none): x-deadline-seconds header, else the lane default. Every stage only gets
+# what is left; an OpenAI edit that cannot fit switches to DEADLINE_FALLBACK_QUALITY, then to the local
+# fallback (ENABLE_FALLBACK_SINGLE), else the job fails early. DEADLINE_RESERVE_SECONDS stay for upload + callback.
+JOB_DEADLINE_SECONDS = float(os.getenv("JOB_DEADLINE_SECONDS", "170"))  # single-image lane (callers give up at 180 s)
+BATCH_JOB_DEADLINE_SECONDS = float(os.getenv("BATCH_JOB_DEADLINE_SECONDS", "0"))
+MAX_DEADLINE_SECONDS = float(os.getenv("MAX_DEADLINE_SECONDS", "86400"))  # longer deadlines are capped
+DEADLINE_RESERVE_SECONDS = float(os.getenv("DEADLINE_RESERVE_SECONDS", "10"))
+DEADLINE_FALLBACK_QUALITY = os.getenv("DEADLINE_FALLBACK_QUALITY", "low").strip()  # "" = never downgrade
+OPENAI_EXPECTED_SECONDS = float(os.getenv("OPENAI_EXPECTED_SECONDS", "60"))  # per edit until measured
+
+# Memory budget (bytes, 0 = disabled): single-image jobs reserve their estimated peak footprint at admission
+# (429 when the budget is busy, 413 when it can never fit), batch items before their input is downloaded.
+# Batch items may hold at most MEMORY_BATCH_SHARE of the budget: the rest stays free for single-image jobs.
+# Edit results are assumed MEMORY_RESULT_INPUT_RATIO x the input size, within MEMORY_RESULT_ESTIMATE_BYTES
+# (before base64; the cap alone when the input size is unknown).
+MEMORY_BUDGET_BYTES = int(os.getenv("MEMORY_BUDGET_BYTES", str(256 * 1024 * 1024)))
+MEMORY_BATCH_SHARE = float(os.getenv("MEMORY_BATCH_SHARE", "0.5"))
+MEMORY_RESULT_ESTIMATE_BYTES = int(os.getenv("MEMORY_RESULT_ESTIMATE_BYTES", str(4 * 1024 * 1024)))
+MEMORY_RESULT_INPUT_RATIO = float(os.getenv("MEMORY_RESULT_INPUT_RATIO", "4"))
+
+# Job store: "memory" (per-process LRU) or "sqlite" (file-backed, survives restarts)
+JOB_STORE_BACKEND = os.getenv("JOB_STORE_BACKEND", "memory").strip()
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "jobs.db").strip()
+JOB_STORE_MAX_JOBS = int(os.getenv("JOB_STORE_MAX_JOBS", "500"))
+JOB_STORE_MAX_BYTES = int(os.getenv("JOB_STORE_MAX_BYTES", str(64 * 1024 * 1024)))  # memory store, base64 results included
+JOB_PROGRESS_INTERVAL_SECONDS = float(os.getenv("JOB_PROGRESS_INTERVAL_SECONDS", "0.5"))
+
+# Duplicate submissions attach to the job already doing the work (one edit, callbacks fanned out):
+# same Idempotency-Key header (result replayed until IDEMPOTENCY_TTL_SECONDS after acceptance),
+# or same content (image + prompt + options) while the first job is still running
+COALESCE_DUPLICATES = os.getenv("COALESCE_DUPLICATES", "true").strip().lower() == "true"
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "3600"))
+
+# Execution mode: "inprocess" (BackgroundTasks) or "queue" (endpoints only enqueue, `python worker.py` runs jobs)
+JOB_EXECUTION_MODE = os.getenv("JOB_EXECUTION_MODE", "inprocess").strip().lower()
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "sqlite").strip().lower()
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "jobqueue.db").strip()
+JOB_QUEUE_LEASE_SECONDS = float(os.getenv("JOB_QUEUE_LEASE_SECONDS", "60"))  # renewed while the job runs
+JOB_QUEUE_POLL_SECONDS = float(os.getenv("JOB_QUEUE_POLL_SECONDS", "1.0"))
+JOB_QUEUE_MAX_ATTEMPTS = int(os.getenv("JOB_QUEUE_MAX_ATTEMPTS", "3"))  # claims before a job is given up
+
+# Prometheus metrics: GET /metrics on the API, optional HTTP port per queue-mode worker (0 = disabled)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").strip().lower() == "true"
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+# Thread pool for blocking calls (OpenAI SDK, boto3, Pillow) made from background jobs
+BLOCKING_MAX_WORKERS = int(os.getenv("BLOCKING_MAX_WORKERS", "32"))
 
 
 def _parse_backoff_list(s: str) -> List[float]:
@@ -76,8 +188,488 @@ def _parse_backoff_list(s: str) -> List[float]:
 
 CALLBACK_BACKOFF_LIST = _parse_backoff_list(CALLBACK_BACKOFF_SECONDS)
 
-# In-memory concurrency semaphore (per process)
-_job_semaphore = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+
+# ==================================================
+# Execution layer: keep blocking calls off the event loop
+# ==================================================
+T = TypeVar("T")
+
+# Bounded pool: /health, new 202s and callbacks keep running while edits are in flight
+_blocking_executor = ThreadPoolExecutor(
+    max_workers=max(BLOCKING_MAX_WORKERS, 1),
+    thread_name_prefix="wxo-blocking",
+)
+
+
+async def run_blocking(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run a synchronous function (OpenAI SDK, boto3, Pillow) in the bounded thread pool.
+    """
+    loop = asyncio.get_running_loop()
+    # Copy of the caller's context: the job deadline is visible from the worker thread too
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_blocking_executor, functools.partial(ctx.run, fn, *args, **kwargs))
+
+
+# ==================================================
+# Job deadlines: remaining time budget of the running job
+# ==================================================
+# Absolute deadline (epoch seconds) of the job running in this context, None = no deadline
+_job_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("job_deadline", default=None)
+
+
+class DeadlineExceededError(RuntimeError):
+    """Raised instead of starting a stage the job's remaining time budget cannot cover."""
+
+
+def time_left() -> Optional[float]:
+    deadline = _job_deadline.get()
+    return None if deadline is None else deadline - time.time()
+
+
+def check_deadline(stage: str, needed: float = 0.0) -> None:
+    """
+    Fail early when less than `needed` seconds remain before `stage` (no-op without a deadline).
+    """
+    left = time_left()
+    if left is not None and left <= needed:
+        DEADLINE_ACTIONS_TOTAL.labels(action="aborted", stage=stage).inc()
+        raise DeadlineExceededError(f"délai du job dépassé avant l'étape {stage} ({max(left, 0.0):.1f}s restantes)")
+
+
+def budget_timeout(default: float, reserve: float = 0.0) -> float:
+    # `default` capped by the time left, minus `reserve` seconds kept for the following stages
+    left = time_left()
+    if left is None:
+        return default
+    return max(min(default, left - reserve), 0.1)
+
+
+async def within_deadline(stage: str, aw: Awaitable[T]) -> T:
+    """
+    Await `aw` for at most the time left (no limit without a deadline), DeadlineExceededError past it.
+    A run_blocking call still finishes in its thread; the job just stops waiting for it.
+    """
+    left = time_left()
+    if left is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, timeout=max(left, 0.0))
+    except asyncio.TimeoutError:
+        if (time_left() or 0.0) > 0:
+            raise  # a timeout of the call itself, not the deadline
+        DEADLINE_ACTIONS_TOTAL.labels(action="aborted", stage=stage).inc()
+        raise DeadlineExceededError(f"délai du job dépassé pendant l'étape {stage}")
+
+
+# ==================================================
+# Metrics (Prometheus): per-stage latency, callbacks, occupancy
+# ==================================================
+# Own registry: process metrics + ours, no duplicate registration if the module is imported twice
+METRICS_REGISTRY = CollectorRegistry()
+ProcessCollector(registry=METRICS_REGISTRY)
+
+# Seconds: from a few ms (presign, base64) to long OpenAI edits
+_STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+_JOB_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600)
+
+STAGE_SECONDS = Histogram(
+    "wxo_stage_seconds",
+    "Duration of one processing stage (b64_decode, cos_get, preprocess, openai_wait, openai_edit, fallback, cos_put, presign, callback)",
+    ["stage", "outcome"],
+    buckets=_STAGE_BUCKETS,
+    registry=METRICS_REGISTRY,
+)
+JOB_WAIT_SECONDS = Histogram(
+    "wxo_job_wait_seconds",
+    "Time between admission (202) and the start of the job",
+    ["lane"],
+    buckets=_JOB_BUCKETS,
+    registry=METRICS_REGISTRY,
+)
+JOB_RUN_SECONDS = Histogram(
+    "wxo_job_run_seconds",
+    "Job duration, from start to callback queued",
+    ["lane"],
+    buckets=_JOB_BUCKETS,
+    registry=METRICS_REGISTRY,
+)
+IMAGES_TOTAL = Counter(
+    "wxo_images_total",
+    "Edited images by engine (openai, cache, fallback)",
+    ["engine"],
+    registry=METRICS_REGISTRY,
+)
+CALLBACK_ATTEMPTS_TOTAL = Counter(
+    "wxo_callback_attempts_total",
+    "Callback HTTP attempts, retries included",
+    ["result"],
+    registry=METRICS_REGISTRY,
+)
+CALLBACKS_TOTAL = Counter(
+    "wxo_callbacks_total",
+    "Callbacks by final outcome (delivered, failed after every retry)",
+    ["outcome"],
+    registry=METRICS_REGISTRY,
+)
+
+DEADLINE_ACTIONS_TOTAL = Counter(
+    "wxo_deadline_actions_total",
+    "Stages changed by the job deadline (downgraded quality, local fallback, aborted, callback dropped)",
+    ["action", "stage"],
+    registry=METRICS_REGISTRY,
+)
+
+
+@contextmanager
+def track_stage(stage: str) -> Iterator[None]:
+    """
+    Observe the duration of the enclosed block in wxo_stage_seconds (outcome=ok|error).
+    """
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        STAGE_SECONDS.labels(stage=stage, outcome=outcome).observe(time.perf_counter() - start)
+
+
+class OccupancyCollector:
+    """
+    Gauges read at scrape time from the objects /health already reports (no bookkeeping twice).
+    """
+
+    def collect(self):
+        lane_in_flight = GaugeMetricFamily("wxo_lane_in_flight", "Jobs running in a scheduler lane", labels=["lane"])
+        lane_limit = GaugeMetricFamily("wxo_lane_limit", "Concurrency cap of a scheduler lane", labels=["lane"])
+        lane_queued = GaugeMetricFamily("wxo_lane_queued", "Admitted jobs waiting for a lane slot", labels=["lane"])
+        lane_rejected = CounterMetricFamily("wxo_lane_rejected", "Submissions refused with 429", labels=["lane"])
+        for name, lane in job_scheduler.lanes.items():
+            lane_in_flight.add_metric([name], lane.in_flight)
+            lane_limit.add_metric([name], lane.limit)
+            lane_queued.add_metric([name], lane.queued)
+            lane_rejected.add_metric([name], lane.rejected)
+        yield from (lane_in_flight, lane_limit, lane_queued, lane_rejected)
+
+        if job_queue is not None:
+            depth = GaugeMetricFamily("wxo_job_queue_jobs", "Jobs in the durable job queue", labels=["lane", "state"])
+            for lane_name, counts in job_queue.stats(time.time()).items():
+                for state, count in counts.items():
+                    depth.add_metric([lane_name, state], count)
+            yield depth
+
+        budget = memory_budget.stats()
+        yield GaugeMetricFamily("wxo_memory_budget_bytes", "Process memory budget for job payloads (0 = disabled)", value=budget["limit_bytes"])
+        yield GaugeMetricFamily("wxo_memory_reserved_bytes", "Bytes reserved by running and admitted jobs", value=budget["reserved_bytes"])
+        yield GaugeMetricFamily("wxo_memory_waiting", "Reservations waiting for budget", value=budget["waiting"])
+        rejected = CounterMetricFamily("wxo_memory_rejected", "Submissions refused by the memory budget", labels=["reason"])
+        rejected.add_metric(["busy"], budget["rejected_busy"])
+        rejected.add_metric(["too_large"], budget["rejected_too_large"])
+        yield rejected
+
+        coalescing = job_coalescer.stats()
+        coalesced = CounterMetricFamily("wxo_jobs_coalesced", "Duplicate submissions served by an existing job", labels=["how"])
+        coalesced.add_metric(["attached"], coalescing["coalesced"])
+        coalesced.add_metric(["replayed"], coalescing["replayed"])
+        yield coalesced
+
+        callbacks = callback_dispatcher.stats()
+        yield GaugeMetricFamily("wxo_callback_queue_pending", "Callbacks waiting for delivery or retry", value=callbacks["pending"])
+        yield GaugeMetricFamily("wxo_callback_in_flight", "Callbacks being sent", value=callbacks["in_flight"])
+
+        breaker = openai_breaker.stats()
+        state = GaugeMetricFamily("wxo_openai_breaker_state", "OpenAI circuit state (1 for the current one)", labels=["state"])
+        for name in ("closed", "open", "half_open"):
+            state.add_metric([name], 1 if breaker["state"] == name else 0)
+        yield state
+        yield CounterMetricFamily("wxo_openai_breaker_rejected", "Edits refused while the circuit was open", value=breaker["rejected"])
+
+        limiter = openai_limiter.stats()
+        yield GaugeMetricFamily("wxo_openai_concurrency_limit", "Current AIMD concurrency limit for OpenAI edits", value=limiter["concurrency_limit"])
+        yield GaugeMetricFamily("wxo_openai_in_flight", "OpenAI edit requests in flight", value=limiter["in_flight"])
+        yield CounterMetricFamily("wxo_openai_throttled", "OpenAI 429 responses", value=limiter["throttled"])
+        yield CounterMetricFamily("wxo_openai_retries", "OpenAI edit retries (429 and transient errors)", value=limiter["retries"])
+
+        cache = result_cache.stats()
+        lookups = CounterMetricFamily("wxo_result_cache_lookups", "Result cache lookups", labels=["result"])
+        lookups.add_metric(["memory_hit"], cache["memory_hits"])
+        lookups.add_metric(["cos_hit"], cache["cos_hits"])
+        lookups.add_metric(["miss"], cache["misses"])
+        yield lookups
+        yield GaugeMetricFamily("wxo_result_cache_bytes", "Bytes held by the in-memory result cache", value=cache["bytes"])
+
+
+METRICS_REGISTRY.register(OccupancyCollector())
+
+
+# ==================================================
+# Job scheduler: admission control + per-lane queues
+# ==================================================
+class SchedulerLane:
+    """
+    FIFO lane: at most `limit` jobs running, at most `max_queued` waiting.
+    Slots are handed over directly to the oldest waiter on release.
+    """
+
+    def __init__(self, name: str, limit: int, max_queued: int, expected_run_seconds: float) -> None:
+        self.name = name
+        self.limit = max(limit, 1)
+        self.max_queued = max(max_queued, 0)
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self.started = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        # EWMA of job duration, only used to estimate Retry-After
+        self.avg_run_seconds = expected_run_seconds
+        self._waiters: "deque[asyncio.Future]" = deque()
+
+    def is_full(self) -> bool:
+        return self.queued >= self.max_queued and self.in_flight >= self.limit
+
+    def record_start(self, waited: float) -> None:
+        JOB_WAIT_SECONDS.labels(lane=self.name).observe(waited)
+        self.started += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def record_finish(self, duration: float) -> None:
+        JOB_RUN_SECONDS.labels(lane=self.name).observe(duration)
+        self.avg_run_seconds = 0.8 * self.avg_run_seconds + 0.2 * duration
+
+    def retry_after_seconds(self) -> int:
+        rounds = (self.queued // self.limit) + 1
+        return int(min(max(self.avg_run_seconds * rounds, 1.0), 300.0))
+
+    async def acquire(self) -> None:
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()  # slot was handed over right before the cancellation
+            else:
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)  # in_flight unchanged: the slot moves to the waiter
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "max_queued": self.max_queued,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "started": self.started,
+            "rejected": self.rejected,
+            "avg_wait_seconds": round(self.wait_total / self.started, 3) if self.started else 0.0,
+            "max_wait_seconds": round(self.wait_max, 3),
+            "avg_run_seconds": round(self.avg_run_seconds, 3),
+        }
+
+
+class JobScheduler:
+    """
+    Admission happens in the endpoint (before the 202), execution in the background task.
+    Single-image and batch work use separate lanes, so a long batch never holds an interactive slot.
+    """
+
+    def __init__(self, lanes: List[SchedulerLane]) -> None:
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.closed = False
+
+    def admit(self, lane_name: str, queued: Optional[int] = None) -> float:
+        """
+        Reserve a queue place or raise 429 (queue full) / 503 (shutting down) with Retry-After.
+        `queued`: depth of the durable job queue (queue mode) instead of this process' own waiters.
+        Returns the admission timestamp, to be passed to run().
+        """
+        lane = self.lanes[lane_name]
+        if self.closed:
+            raise HTTPException(
+                status_code=503,
+                detail="Service en cours d'arrêt, réessayez plus tard",
+                headers={"Retry-After": "5"},
+            )
+        full = lane.is_full() if queued is None else queued >= max(lane.max_queued, 1)
+        if full:
+            lane.rejected += 1
+            retry_after = lane.retry_after_seconds()
+            print(f"[SCHEDULER] lane={lane_name} full (in_flight={lane.in_flight} queued={lane.queued}) -> 429")
+            raise HTTPException(
+                status_code=429,
+                detail=f"File d'attente pleine ({lane_name}), réessayez dans {retry_after}s",
+                headers={"Retry-After": str(retry_after)},
+            )
+        if queued is None:
+            lane.queued += 1
+        return time.monotonic()
+
+    def withdraw(self, lane_name: str) -> None:
+        # Undo an in-process admit() whose job never reached run()
+        self.lanes[lane_name].queued -= 1
+
+    async def run(self, lane_name: str, admitted_at: float, fn: Callable[..., Awaitable[None]], *args) -> None:
+        lane = self.lanes[lane_name]
+        try:
+            await lane.acquire()
+        finally:
+            lane.queued -= 1
+        lane.record_start(time.monotonic() - admitted_at)
+        start = time.monotonic()
+        try:
+            await fn(*args)
+        finally:
+            lane.record_finish(time.monotonic() - start)
+            lane.release()
+
+    def close(self) -> None:
+        self.closed = True
+
+    def stats(self) -> dict:
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+
+job_scheduler = JobScheduler([
+    SchedulerLane("single", MAX_CONCURRENT_JOBS, MAX_QUEUED_JOBS, expected_run_seconds=15.0),
+    SchedulerLane("batch", MAX_CONCURRENT_BATCH_JOBS, MAX_QUEUED_BATCH_JOBS, expected_run_seconds=120.0),
+])
+
+
+class MemoryBudget:
+    """
+    Process-wide byte budget: job counts say nothing about memory when one payload is 10 KB and the
+    next 14 MB. Reservations are FIFO per lane; a lane can be capped to a share of the budget, so its
+    waiters never hold back the other lane. One larger than its lane's limit is clamped to it (runs alone).
+    """
+
+    def __init__(self, limit_bytes: int, lane_shares: Optional[dict] = None) -> None:
+        self.limit = max(limit_bytes, 0)
+        self.lane_limits = {
+            lane: max(int(self.limit * min(max(share, 0.0), 1.0)), 1) for lane, share in (lane_shares or {}).items()
+        }
+        self.reserved = 0
+        self.lane_reserved: dict = {}
+        self.peak = 0
+        self.rejected_busy = 0
+        self.rejected_too_large = 0
+        self._waiters: "dict[str, deque[tuple[int, asyncio.Future]]]" = {}
+
+    def lane_limit(self, lane: str) -> int:
+        return self.lane_limits.get(lane, self.limit)
+
+    def fits(self, nbytes: int, lane: str = "single") -> bool:
+        return not self.limit or nbytes <= self.lane_limit(lane)
+
+    def _clamp(self, nbytes: int, lane: str) -> int:
+        return min(max(nbytes, 0), self.lane_limit(lane)) if self.limit else 0
+
+    def _has_room(self, n: int, lane: str) -> bool:
+        return self.reserved + n <= self.limit and self.lane_reserved.get(lane, 0) + n <= self.lane_limit(lane)
+
+    def _take(self, n: int, lane: str) -> None:
+        self.reserved += n
+        self.lane_reserved[lane] = self.lane_reserved.get(lane, 0) + n
+        self.peak = max(self.peak, self.reserved)
+
+    def try_reserve(self, nbytes: int, lane: str = "single") -> Optional[int]:
+        """
+        Reserve now without waiting. Returns the amount to release, or None if the budget is busy.
+        """
+        n = self._clamp(nbytes, lane)
+        if self.limit and (self._waiters.get(lane) or not self._has_room(n, lane)):
+            return None
+        self._take(n, lane)
+        return n
+
+    async def reserve(self, nbytes: int, lane: str = "single") -> int:
+        """
+        Wait until the reservation fits. Returns the amount to release.
+        """
+        n = self._clamp(nbytes, lane)
+        waiters = self._waiters.setdefault(lane, deque())
+        if not self.limit or (not waiters and self._has_room(n, lane)):
+            self._take(n, lane)
+            return n
+        fut = asyncio.get_running_loop().create_future()
+        waiters.append((n, fut))
+        try:
+            await fut
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                self.release(n, lane)  # granted while being cancelled
+            else:
+                self._wake()
+            raise
+        return n
+
+    def release(self, n: int, lane: str = "single") -> None:
+        self.reserved -= n
+        self.lane_reserved[lane] = self.lane_reserved.get(lane, 0) - n
+        self._wake()
+
+    def _wake(self) -> None:
+        for lane, waiters in self._waiters.items():
+            while waiters:
+                n, fut = waiters[0]
+                if fut.done():
+                    waiters.popleft()
+                    continue
+                if not self._has_room(n, lane):
+                    break
+                waiters.popleft()
+                self._take(n, lane)
+                fut.set_result(None)
+
+    def stats(self) -> dict:
+        lanes = sorted(set(self.lane_limits) | set(self.lane_reserved))
+        return {
+            "limit_bytes": self.limit,
+            "reserved_bytes": self.reserved,
+            "peak_bytes": self.peak,
+            "waiting": sum(1 for waiters in self._waiters.values() for _n, fut in waiters if not fut.done()),
+            "lanes": {
+                lane: {"limit_bytes": self.lane_limit(lane), "reserved_bytes": self.lane_reserved.get(lane, 0)}
+                for lane in lanes
+            },
+            "rejected_busy": self.rejected_busy,
+            "rejected_too_large": self.rejected_too_large,
+        }
+
+
+memory_budget = MemoryBudget(MEMORY_BUDGET_BYTES, {"batch": MEMORY_BATCH_SHARE})
+
+
+def result_estimate(input_bytes: Optional[int]) -> int:
+    # Edit result size (before base64) assumed for an input of `input_bytes` (None = unknown)
+    if input_bytes is None:
+        return MEMORY_RESULT_ESTIMATE_BYTES
+    return min(int(input_bytes * MEMORY_RESULT_INPUT_RATIO), MEMORY_RESULT_ESTIMATE_BYTES)
+
+
+async def run_job(nbytes: int, deadline: Optional[float], fn: Callable[..., Awaitable[None]], *args) -> None:
+    # Runs the job under its deadline, then releases the reservation taken at admission (single lane)
+    token = _job_deadline.set(deadline)
+    try:
+        await fn(*args)
+    finally:
+        _job_deadline.reset(token)
+        memory_budget.release(nbytes)
 
 
 # ==================================================
@@ -106,12 +698,45 @@ COS_ACCESS_KEY_ID = os.getenv("COS_ACCESS_KEY_ID", "").strip()
 COS_SECRET_ACCESS_KEY = os.getenv("COS_SECRET_ACCESS_KEY", "").strip()
 COS_PRESIGN_EXPIRES = int(os.getenv("COS_PRESIGN_EXPIRES", "900"))
 
+# Shared client HTTP pool (should cover BATCH_DOWNLOAD + BATCH_UPLOAD concurrency across jobs)
+COS_MAX_POOL_CONNECTIONS = int(os.getenv("COS_MAX_POOL_CONNECTIONS", "50"))
+
+# Streaming transfers: downloads go through a spooled buffer (RAM up to COS_SPOOL_MAX_BYTES, then a temp
+# file), uploads above the threshold are split into parts sent concurrently
+COS_SPOOL_MAX_BYTES = int(os.getenv("COS_SPOOL_MAX_BYTES", str(8 * 1024 * 1024)))
+COS_MULTIPART_THRESHOLD_BYTES = int(os.getenv("COS_MULTIPART_THRESHOLD_BYTES", str(8 * 1024 * 1024)))
+COS_MULTIPART_CHUNKSIZE_BYTES = int(os.getenv("COS_MULTIPART_CHUNKSIZE_BYTES", str(8 * 1024 * 1024)))
+COS_TRANSFER_CONCURRENCY = int(os.getenv("COS_TRANSFER_CONCURRENCY", "4"))
+
 # Batch (input/output)
 COS_INPUT_BUCKET = os.getenv("COS_INPUT_BUCKET", "").strip()                 # e.g. input-images
 COS_OUTPUT_BUCKET = os.getenv("COS_OUTPUT_BUCKET", COS_BUCKET).strip()       # e.g. wxo-images
 COS_INPUT_PREFIX = os.getenv("COS_INPUT_PREFIX", "").strip()                 # e.g. demo/
 COS_OUTPUT_PREFIX = os.getenv("COS_OUTPUT_PREFIX", "results/batch").strip()  # e.g. results/batch
 
+# Direct-to-COS uploads: presigned PUT/POST into COS_INPUT_BUCKET under this prefix (skipped by batch listings)
+COS_UPLOAD_PREFIX = os.getenv("COS_UPLOAD_PREFIX", "uploads").strip().strip("/")
+
+# Batch pipeline: per-stage concurrency + bounded queues between stages
+BATCH_DOWNLOAD_CONCURRENCY = int(os.getenv("BATCH_DOWNLOAD_CONCURRENCY", "4"))
+BATCH_EDIT_CONCURRENCY = int(os.getenv("BATCH_EDIT_CONCURRENCY", "8"))
+BATCH_UPLOAD_CONCURRENCY = int(os.getenv("BATCH_UPLOAD_CONCURRENCY", "4"))
+BATCH_QUEUE_SIZE = int(os.getenv("BATCH_QUEUE_SIZE", "8"))
+
+# Fan-out batches (prompts x output_formats): each input is downloaded and preprocessed once, one edit per
+# prompt, other formats re-encoded locally at BATCH_VARIANT_QUALITY (jpeg/webp)
+BATCH_MAX_VARIANTS = int(os.getenv("BATCH_MAX_VARIANTS", "8"))
+BATCH_VARIANT_QUALITY = int(os.getenv("BATCH_VARIANT_QUALITY", "90"))
+
+# Incremental batches: persist the manifest every N new outputs (and at the end of the run)
+BATCH_MANIFEST_FLUSH_EVERY = int(os.getenv("BATCH_MANIFEST_FLUSH_EVERY", "20"))
+
+# Batch listing filters (applied to list_objects_v2 metadata while streaming the listing)
+BATCH_INCLUDE_SUFFIXES = [x.strip() for x in os.getenv("BATCH_INCLUDE_SUFFIXES", "").split(",") if x.strip()]
+BATCH_IMAGES_ONLY = os.getenv("BATCH_IMAGES_ONLY", "false").strip().lower() == "true"
+BATCH_MIN_SIZE_BYTES = int(os.getenv("BATCH_MIN_SIZE_BYTES", "0"))
+BATCH_MAX_SIZE_BYTES = int(os.getenv("BATCH_MAX_SIZE_BYTES", "0"))  # 0 = no limit
+
 
 def _require_cos_config() -> None:
     missing = []
@@ -134,6 +759,8 @@ def make_s3_client():
         signature_version="s3v4",
         s3={"addressing_style": "path"},
         retries={"max_attempts": 3, "mode": "standard"},
+        max_pool_connections=max(COS_MAX_POOL_CONNECTIONS, 1),
+        tcp_keepalive=True,
     )
     return boto3.client(
         "s3",
@@ -144,6 +771,30 @@ def make_s3_client():
     )
 
 
+# Process-wide client: boto3 clients are thread-safe once created, so one instance
+# shares its parsed service model and warm connection pool across all jobs.
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+# Multipart settings shared by every upload (5 MiB is the S3/COS minimum part size)
+COS_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=max(COS_MULTIPART_THRESHOLD_BYTES, 5 * 1024 * 1024),
+    multipart_chunksize=max(COS_MULTIPART_CHUNKSIZE_BYTES, 5 * 1024 * 1024),
+    max_concurrency=max(COS_TRANSFER_CONCURRENCY, 1),
+    use_threads=COS_TRANSFER_CONCURRENCY > 1,
+)
+
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = make_s3_client()
+    return _s3_client
+
+
 # ==================================================
 # OpenAI Config (env vars)
 # ==================================================
@@ -152,6 +803,45 @@ OPENAI_IMAGE_MODEL = os.getenv("OPENAI_IMAGE_MODEL", "gpt-image-1").strip()
 OPENAI_IMAGE_QUALITY = os.getenv("OPENAI_IMAGE_QUALITY", "medium").strip()          # low|medium|high|auto
 OPENAI_IMAGE_OUTPUT_FORMAT = os.getenv("OPENAI_IMAGE_OUTPUT_FORMAT", "png").strip() # png|jpeg|webp
 
+# Long-lived client settings (shared HTTP pool, timeouts, SDK retries)
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "120"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+
+# Process-wide rate limiter: token bucket (requests/min, learned from x-ratelimit-* headers) + AIMD concurrency.
+# When enabled, the limiter owns retries (429 and transient errors) instead of the SDK.
+OPENAI_LIMITER_ENABLED = os.getenv("OPENAI_LIMITER_ENABLED", "true").strip().lower() == "true"
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "0"))  # starting requests/minute, 0 = no cap until headers give one
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+OPENAI_MIN_CONCURRENCY = int(os.getenv("OPENAI_MIN_CONCURRENCY", "1"))
+OPENAI_THROTTLE_RETRIES = int(os.getenv("OPENAI_THROTTLE_RETRIES", "6"))  # 429 retries per edit
+OPENAI_RETRY_BASE_SECONDS = float(os.getenv("OPENAI_RETRY_BASE_SECONDS", "1.0"))
+OPENAI_RETRY_MAX_SECONDS = float(os.getenv("OPENAI_RETRY_MAX_SECONDS", "60"))
+
+# Circuit breaker on the provider: opens on error rate or slow-call rate over the last N calls,
+# then fails fast (or goes straight to the local fallback) until a half-open probe succeeds
+OPENAI_BREAKER_ENABLED = os.getenv("OPENAI_BREAKER_ENABLED", "true").strip().lower() == "true"
+OPENAI_BREAKER_POLICY = os.getenv("OPENAI_BREAKER_POLICY", "fallback").strip().lower()  # fallback|fail
+OPENAI_BREAKER_WINDOW = int(os.getenv("OPENAI_BREAKER_WINDOW", "20"))  # last N calls
+OPENAI_BREAKER_MIN_CALLS = int(os.getenv("OPENAI_BREAKER_MIN_CALLS", "5"))
+OPENAI_BREAKER_ERROR_RATE = float(os.getenv("OPENAI_BREAKER_ERROR_RATE", "0.5"))
+OPENAI_BREAKER_SLOW_SECONDS = float(os.getenv("OPENAI_BREAKER_SLOW_SECONDS", "90"))
+OPENAI_BREAKER_SLOW_RATE = float(os.getenv("OPENAI_BREAKER_SLOW_RATE", "0.8"))
+OPENAI_BREAKER_OPEN_SECONDS = float(os.getenv("OPENAI_BREAKER_OPEN_SECONDS", "30"))
+OPENAI_BREAKER_HALF_OPEN_CALLS = int(os.getenv("OPENAI_BREAKER_HALF_OPEN_CALLS", "1"))
+
+# Input preprocessing before every OpenAI edit: EXIF orientation, downscale, compact re-encode
+PREPROCESS_ENABLED = os.getenv("PREPROCESS_ENABLED", "true").strip().lower() == "true"
+PREPROCESS_MAX_EDGE = int(os.getenv("PREPROCESS_MAX_EDGE", "1536"))  # px, 0 = keep resolution
+PREPROCESS_FORMAT = os.getenv("PREPROCESS_FORMAT", "auto").strip().lower()  # auto|png|jpeg|webp
+PREPROCESS_JPEG_QUALITY = int(os.getenv("PREPROCESS_JPEG_QUALITY", "90"))
+
+# Result cache keyed on (image, prompt, model, quality, output format, preprocessing)
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").strip().lower() == "true"
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+RESULT_CACHE_COS_ENABLED = os.getenv("RESULT_CACHE_COS_ENABLED", "false").strip().lower() == "true"
+RESULT_CACHE_PREFIX = os.getenv("RESULT_CACHE_PREFIX", "cache/edits").strip()
+
 
 def _require_openai_config() -> None:
     if not OPENAI_API_KEY:
@@ -169,340 +859,2715 @@ def _mime_from_output_format(fmt: str) -> str:
     return "application/octet-stream"
 
 
-def edit_image_with_openai(image_bytes: bytes, prompt: str) -> tuple[bytes, str, str]:
+def _openai_http_limits() -> httpx.Limits:
+    n = max(OPENAI_MAX_CONNECTIONS, 1)
+    return httpx.Limits(max_connections=n, max_keepalive_connections=n)
+
+
+# One client per event loop (long-lived, shared HTTP pool)
+_async_openai_client: Optional[AsyncOpenAI] = None
+_async_openai_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_async_openai_client() -> AsyncOpenAI:
     """
-    Returns (output_bytes, mime_type, output_ext)
+    AsyncOpenAI holds an httpx.AsyncClient bound to the running loop: rebuild it if the loop changed.
     """
+    global _async_openai_client, _async_openai_loop
     _require_openai_config()
-    if not prompt or not prompt.strip():
-        raise ValueError("prompt vide")
+    loop = asyncio.get_running_loop()
+    if _async_openai_client is None or _async_openai_loop is not loop:
+        old, old_loop = _async_openai_client, _async_openai_loop
+        if old is not None and old_loop is not None and old_loop.is_running():
+            # Its connection pool belongs to the other loop: closed there
+            asyncio.run_coroutine_threadsafe(old.close(), old_loop)
+        _async_openai_client = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            timeout=OPENAI_TIMEOUT_SECONDS,
+            max_retries=0 if OPENAI_LIMITER_ENABLED else OPENAI_MAX_RETRIES,
+            http_client=httpx.AsyncClient(limits=_openai_http_limits(), timeout=OPENAI_TIMEOUT_SECONDS),
+        )
+        _async_openai_loop = loop
+    return _async_openai_client
 
-    image_file = io.BytesIO(image_bytes)
-    image_file.name = "input.png"
 
-    client = OpenAI(api_key=OPENAI_API_KEY)
+async def close_async_openai_client() -> None:
+    # Lifespan / worker shutdown: release the HTTP pool on the loop that owns it
+    global _async_openai_client, _async_openai_loop
+    client, _async_openai_client, _async_openai_loop = _async_openai_client, None, None
+    if client is not None:
+        await client.close()
 
-    result = client.images.edit(
-        model=OPENAI_IMAGE_MODEL,
-        image=image_file,
-        prompt=prompt,
-        quality=OPENAI_IMAGE_QUALITY,
-        output_format=OPENAI_IMAGE_OUTPUT_FORMAT,
-    )
 
-    b64 = result.data[0].b64_json if result and result.data else None
-    if not b64:
-        raise RuntimeError("OpenAI returned empty b64_json")
+# ==================================================
+# OpenAI rate limiter: token bucket + AIMD concurrency, jittered retries
+# ==================================================
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
 
-    out_bytes = base64.b64decode(b64)
-    output_ext = (OPENAI_IMAGE_OUTPUT_FORMAT or "png").lower().strip()
-    if output_ext == "jpg":
-        output_ext = "jpeg"
-    mime = _mime_from_output_format(output_ext)
-    return out_bytes, mime, output_ext
 
+def _parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    # x-ratelimit-reset-requests: "1s", "6m0s", "120ms", "1h2m3.5s"
+    parts = _DURATION_PART.findall(value or "")
+    if not parts:
+        return None
+    return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts)
 
-# ==================================================
-# Fallback local (demo continuity)
-# ==================================================
-def local_fallback_process(image_bytes: bytes) -> tuple[bytes, str, str]:
-    img = Image.open(io.BytesIO(image_bytes)).convert("RGBA")
-    img = ImageOps.invert(img.convert("RGB")).convert("RGBA")
 
-    overlay = Image.new("RGBA", img.size, (0, 0, 0, 0))
-    draw = ImageDraw.Draw(overlay)
+def _parse_retry_after(headers) -> Optional[float]:
+    if headers is None:
+        return None
+    ms = headers.get("retry-after-ms")
+    if ms:
+        try:
+            return float(ms) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
 
-    text = "DEMO - FALLBACK (OpenAI unavailable / billing)"
-    draw.text((20, 20), text, fill=(255, 0, 0, 200))
 
-    img = Image.alpha_composite(img, overlay)
+def _header_int(headers, name: str) -> Optional[int]:
+    try:
+        return int(headers.get(name)) if headers is not None and headers.get(name) is not None else None
+    except ValueError:
+        return None
 
-    buf = io.BytesIO()
-    img.convert("RGB").save(buf, format="PNG")
-    return buf.getvalue(), "image/png", "png"
 
+class OpenAIRateLimiter:
+    """
+    Shared by every edit in the process (single and batch).
+    - Token bucket: OPENAI_RPM at start, then x-ratelimit-limit/remaining/reset-requests from each response
+    - AIMD: concurrency +1 per window of successes, halved on a 429 (once per congestion event)
+    - A 429 pauses every caller until Retry-After, so a burst does not turn into a retry storm
+    State is plain fields under a lock; waiters poll, which works from any event loop.
+    """
 
-# ==================================================
-# App
-# ==================================================
-app = FastAPI(title="WXO Async Image Tools", version="3.2.0-workshop")
+    _POLL_SECONDS = 0.05
+
+    def __init__(self, enabled: bool, rpm: float, min_concurrency: int, max_concurrency: int) -> None:
+        self.enabled = enabled
+        self.max_concurrency = max(max_concurrency, 1)
+        self.min_concurrency = min(max(min_concurrency, 1), self.max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.rate = rpm / 60 if rpm > 0 else 0.0  # tokens per second, 0 = no bucket
+        self.capacity = max(self.rate, 1.0)       # about one second of burst
+        self.tokens = self.capacity
+        self.refilled_at = time.monotonic()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def _try_acquire(self) -> float:
+        """
+        Take a slot + a token (returns 0.0), or return how long to wait before trying again.
+        """
+        with self._lock:
+            if self.enabled:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    return self.paused_until - now
+                if self.in_flight >= int(self.concurrency):
+                    return self._POLL_SECONDS
+                self._refill(now)
+                if self.rate > 0 and self.tokens < 1.0:
+                    return max((1.0 - self.tokens) / self.rate, self._POLL_SECONDS)
+                if self.rate > 0:
+                    self.tokens -= 1.0
+            self.in_flight += 1
+            self.requests += 1
+            return 0.0
+
+    async def acquire(self) -> float:
+        """Wait for a slot; returns the start timestamp to pass to release()."""
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                return time.monotonic()
+            await asyncio.sleep(min(wait, 1.0))
+
+    def _observe_headers(self, headers, now: float) -> None:
+        limit = _header_int(headers, "x-ratelimit-limit-requests")
+        remaining = _header_int(headers, "x-ratelimit-remaining-requests")
+        reset = _parse_reset_duration(headers.get("x-ratelimit-reset-requests") if headers is not None else None)
+        if limit:
+            self._refill(now)
+            self.rate = limit / 60
+            self.capacity = max(self.rate, 1.0)
+        if remaining is not None:
+            self.tokens = min(self.tokens, float(remaining))
+            if remaining <= 0 and reset:
+                self.paused_until = max(self.paused_until, now + reset)
+
+    def release(self, started: float, headers=None, outcome: str = "ok") -> float:
+        """
+        Give the slot back and learn from the response (outcome: ok | throttled | error).
+        For a 429, returns the pause applied to everyone.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.in_flight -= 1
+            if not self.enabled:
+                return 0.0
+            self._observe_headers(headers, now)
+            if outcome == "ok":
+                self.concurrency = min(self.concurrency + 1.0 / self.concurrency, float(self.max_concurrency))
+            if outcome != "throttled":
+                return 0.0
+            self.throttled += 1
+            if started >= self.last_decrease:
+                # Requests already in flight when the limit was hit do not halve it again
+                self.concurrency = max(self.concurrency / 2, float(self.min_concurrency))
+                self.last_decrease = now
+            pause = _parse_retry_after(headers)
+            if pause is None:
+                pause = OPENAI_RETRY_BASE_SECONDS
+            self.paused_until = max(self.paused_until, now + pause)
+            return pause
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "concurrency_limit": int(self.concurrency),
+                "in_flight": self.in_flight,
+                "requests_per_minute": round(self.rate * 60, 1) if self.rate > 0 else None,
+                "paused_seconds": round(max(self.paused_until - time.monotonic(), 0.0), 2),
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "retries": self.retries,
+            }
 
 
-# ==================================================
-# Workshop guard: optional shared token
-# ==================================================
-def _require_workshop_token(header_value: Optional[str]) -> None:
-    if not WORKSHOP_TOKEN:
-        return  # disabled
-    if not header_value or header_value.strip() != WORKSHOP_TOKEN:
-        raise HTTPException(status_code=401, detail="Unauthorized (missing/invalid x-workshop-token)")
+openai_limiter = OpenAIRateLimiter(OPENAI_LIMITER_ENABLED, OPENAI_RPM, OPENAI_MIN_CONCURRENCY, OPENAI_MAX_CONCURRENCY)
 
 
-# ==================================================
-# Input schemas
-# ==================================================
-class ProcessImageRequest(BaseModel):
-    prompt: str = Field(..., description="Instruction de retouche")
-    filename: Optional[str] = Field(None, description="Nom du fichier (corrélation)")
-    image_base64: str = Field(..., description="Image encodée en base64 (sans data:...)")
+def _is_quota_error(e: RateLimitError) -> bool:
+    # insufficient_quota / billing limits also come back as 429: waiting does not help
+    code = getattr(e, "code", None) or ""
+    return code in ("insufficient_quota", "billing_hard_limit_reached") or _looks_like_openai_billing_limit(str(e))
 
 
-class BatchProcessRequest(BaseModel):
-    prompt: str = Field(..., description="Instruction appliquée à toutes les images du bucket input")
+def _retry_delay(e: Exception, attempt: int, pause: float) -> Optional[float]:
+    """
+    Jittered delay before retrying an edit after `e`, or None if it must not be retried.
+    Throttles: up to OPENAI_THROTTLE_RETRIES. Connection errors / 5xx: up to OPENAI_MAX_RETRIES.
+    Limiter disabled: the SDK already retried, nothing more here.
+    """
+    if not OPENAI_LIMITER_ENABLED:
+        return None
+    if isinstance(e, RateLimitError):
+        if _is_quota_error(e) or attempt >= OPENAI_THROTTLE_RETRIES:
+            return None
+    elif isinstance(e, (APIConnectionError, InternalServerError)):
+        if attempt >= OPENAI_MAX_RETRIES:
+            return None
+    else:
+        return None
+    backoff = min(OPENAI_RETRY_BASE_SECONDS * (2 ** attempt), OPENAI_RETRY_MAX_SECONDS)
+    # Full jitter on top of the server's Retry-After: throttled callers do not come back in lockstep
+    return pause + random.uniform(0, backoff)
 
 
 # ==================================================
-# Callback helper (with retries)
+# OpenAI circuit breaker: closed -> open -> half-open -> closed
 # ==================================================
-async def post_callback(callback_url: str, payload: dict) -> None:
-    final_callback_url = rewrite_callback_url(callback_url)
+class OpenAICircuitOpenError(RuntimeError):
+    """Raised instead of calling OpenAI while the circuit is open."""
 
-    job_id = payload.get("job_id", "?")
-    print("=== CALLBACK ===")
-    print("job_id   :", job_id)
-    print("original :", callback_url)
-    print("final    :", final_callback_url)
-    print("status   :", payload.get("status"))
-    print("keys     :", list(payload.keys()))
 
-    last_err: Optional[Exception] = None
+def _is_provider_failure(e: BaseException) -> bool:
+    # Timeouts, connection errors and 5xx say something about OpenAI's health; 4xx and 429 do not
+    return isinstance(e, (APIConnectionError, InternalServerError))
 
-    # Attempt loop: e.g., 3 attempts total
-    for attempt in range(1, max(CALLBACK_MAX_RETRIES, 1) + 1):
-        try:
-            async with httpx.AsyncClient(timeout=CALLBACK_TIMEOUT_SECONDS) as client:
-                r = await client.post(final_callback_url, json=payload)
-                print(f"attempt  : {attempt}/{CALLBACK_MAX_RETRIES} -> HTTP {r.status_code}")
-                r.raise_for_status()
+
+class CircuitBreaker:
+    """
+    Closed: calls go through, outcomes are kept for the last `window` calls. Once `min_calls` are known,
+    an error rate >= `error_rate` or a slow-call rate (>= `slow_seconds`) >= `slow_rate` opens the circuit.
+    Open: calls are refused (OpenAICircuitOpenError) for `open_seconds`.
+    Half-open: `half_open_calls` probes go through; all fine -> closed, one failure or slow call -> open again.
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        window: int,
+        min_calls: int,
+        error_rate: float,
+        slow_seconds: float,
+        slow_rate: float,
+        open_seconds: float,
+        half_open_calls: int,
+    ) -> None:
+        self.enabled = enabled
+        self.min_calls = max(min_calls, 1)
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = max(half_open_calls, 1)
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.opened = 0
+        self.rejected = 0
+        self._outcomes: "deque[tuple[bool, bool]]" = deque(maxlen=max(window, self.min_calls))  # (failed, slow)
+        self._probes = 0
+        self._probes_ok = 0
+        self._lock = threading.Lock()
+
+    def _open(self, now: float, reason: str) -> None:
+        self.state = "open"
+        self.opened_at = now
+        self.opened += 1
+        print(f"[BREAKER] OpenAI circuit open for {self.open_seconds:.0f}s ({reason})")
+
+    def _rates(self) -> tuple[float, float]:
+        n = len(self._outcomes) or 1
+        return (
+            sum(1 for failed, _slow in self._outcomes if failed) / n,
+            sum(1 for _failed, slow in self._outcomes if slow) / n,
+        )
+
+    def allow(self) -> None:
+        """Call before each attempt: raises OpenAICircuitOpenError if the call must not be made."""
+        if not self.enabled:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open":
+                if now - self.opened_at < self.open_seconds:
+                    self.rejected += 1
+                    retry_in = self.open_seconds - (now - self.opened_at)
+                    raise OpenAICircuitOpenError(f"OpenAI indisponible (circuit ouvert), nouvel essai dans {retry_in:.0f}s")
+                self.state = "half_open"
+                self._probes = 0
+                self._probes_ok = 0
+            if self.state == "half_open":
+                if self._probes + self._probes_ok >= self.half_open_calls:
+                    self.rejected += 1
+                    raise OpenAICircuitOpenError("OpenAI indisponible (circuit semi-ouvert, test en cours)")
+                self._probes += 1
+
+    def cancel(self) -> None:
+        """Allowed call that was never sent (cancelled, deadline hit while waiting): frees its probe slot."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.state == "half_open":
+                self._probes = max(self._probes - 1, 0)
+
+    def record(self, duration: float, error: Optional[BaseException] = None) -> None:
+        """
+        Outcome of an allowed call. Errors that are not provider failures (4xx, 429) only free a probe slot.
+        """
+        if not self.enabled:
+            return
+        failed = error is not None and _is_provider_failure(error)
+        neutral = error is not None and not failed
+        slow = not neutral and duration >= self.slow_seconds
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "half_open":
+                self._probes = max(self._probes - 1, 0)
+                if neutral:
+                    return
+                if failed or slow:
+                    self._open(now, "échec du test semi-ouvert")
+                    return
+                self._probes_ok += 1
+                if self._probes_ok >= self.half_open_calls:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                    print("[BREAKER] OpenAI circuit closed")
                 return
-        except Exception as e:
-            last_err = e
-            # backoff (only if more attempts remain)
-            if attempt < CALLBACK_MAX_RETRIES:
-                backoff = CALLBACK_BACKOFF_LIST[min(attempt - 1, len(CALLBACK_BACKOFF_LIST) - 1)]
-                print(f"callback : attempt failed ({type(e).__name__}: {e}); retrying in {backoff}s")
-                await asyncio.sleep(backoff)
+            if self.state != "closed" or neutral:
+                return
+            self._outcomes.append((failed, slow))
+            if len(self._outcomes) < self.min_calls:
+                return
+            error_rate, slow_rate = self._rates()
+            if error_rate >= self.error_rate:
+                self._open(now, f"{error_rate:.0%} d'erreurs sur {len(self._outcomes)} appels")
+            elif slow_rate >= self.slow_rate:
+                self._open(now, f"{slow_rate:.0%} d'appels > {self.slow_seconds:.0f}s sur {len(self._outcomes)} appels")
+
+    def stats(self) -> dict:
+        with self._lock:
+            error_rate, slow_rate = self._rates()
+            retry_in = self.open_seconds - (time.monotonic() - self.opened_at) if self.state == "open" else 0.0
+            return {
+                "enabled": self.enabled,
+                "state": self.state,
+                "policy": OPENAI_BREAKER_POLICY,
+                "calls": len(self._outcomes),
+                "error_rate": round(error_rate, 3),
+                "slow_rate": round(slow_rate, 3),
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "retry_in_seconds": round(max(retry_in, 0.0), 1),
+            }
 
-    # All attempts failed
-    raise RuntimeError(f"Callback failed after {CALLBACK_MAX_RETRIES} attempts: {type(last_err).__name__}: {last_err}")
 
+openai_breaker = CircuitBreaker(
+    OPENAI_BREAKER_ENABLED,
+    OPENAI_BREAKER_WINDOW,
+    OPENAI_BREAKER_MIN_CALLS,
+    OPENAI_BREAKER_ERROR_RATE,
+    OPENAI_BREAKER_SLOW_SECONDS,
+    OPENAI_BREAKER_SLOW_RATE,
+    OPENAI_BREAKER_OPEN_SECONDS,
+    OPENAI_BREAKER_HALF_OPEN_CALLS,
+)
 
-# ==================================================
-# Helpers: naming
-# ==================================================
-def _safe_stem_from_filename(filename: str) -> str:
-    stem, _ = os.path.splitext(filename)
-    stem = stem.strip().replace(" ", "_")
-    stem = re.sub(r"[^a-zA-Z0-9_\-\.]+", "_", stem)
-    stem = stem.strip("._-") or "image"
-    return stem
 
+def _openai_attempt_failed(
+    e: Exception, attempt: int, started: float, quality: str, cut_short: bool = False
+) -> Optional[float]:
+    """
+    Book a failed images.edit attempt (limiter, breaker); returns the delay before a retry, or None to give up.
+    Raises DeadlineExceededError when the job deadline leaves no room for a retry.
+    `cut_short`: the call timeout was lowered to fit the deadline.
+    """
+    outcome = "throttled" if isinstance(e, RateLimitError) else "error"
+    pause = openai_limiter.release(started, getattr(getattr(e, "response", None), "headers", None), outcome)
+    if cut_short and isinstance(e, APITimeoutError):
+        # Timed out on the job's budget, not on OpenAI's health: no breaker failure, no retry
+        openai_breaker.record(0.0, DeadlineExceededError())
+        DEADLINE_ACTIONS_TOTAL.labels(action="aborted", stage="openai_edit").inc()
+        raise DeadlineExceededError("délai du job dépassé pendant l'appel OpenAI") from e
+    openai_breaker.record(time.monotonic() - started, e)
+    delay = _retry_delay(e, attempt, pause)
+    if delay is not None:
+        _check_openai_retry(quality, delay)
+        openai_limiter.retries += 1
+        print(f"[OPENAI] {type(e).__name__}: retry {attempt + 1} in {delay:.1f}s")
+    return delay
+
+
+def _openai_attempt_succeeded(started: float, headers, quality: str) -> None:
+    openai_limiter.release(started, headers)
+    openai_breaker.record(time.monotonic() - started)
+    openai_latency.observe(quality, time.monotonic() - started)
+
+
+def _openai_attempt_cancelled(started: float) -> None:
+    # Cancelled (shutdown...): free the slots without learning anything
+    openai_limiter.release(started, outcome="error")
+    openai_breaker.record(0.0, asyncio.CancelledError())
+
+
+class OpenAILatency:
+    """
+    Expected duration of one images.edit call per quality (EWMA of successful calls), seeded with
+    OPENAI_EXPECTED_SECONDS (a third of it for "low"): what a job deadline has to leave room for.
+    """
 
-def make_object_key(job_id: str, filename: Optional[str], output_ext: str) -> str:
-    stem = _safe_stem_from_filename(filename) if filename else f"image_{job_id[:8]}"
-    return f"results/{job_id}/{stem}_modified.{output_ext}"
+    def __init__(self, expected_seconds: float, alpha: float = 0.2) -> None:
+        self.expected_seconds = expected_seconds
+        self.alpha = alpha
+        self._ewma: dict = {}
+        self._lock = threading.Lock()
 
+    def estimate(self, quality: str) -> float:
+        with self._lock:
+            seed = self.expected_seconds / 3 if quality == "low" else self.expected_seconds
+            return self._ewma.get(quality, seed)
 
-def make_batch_output_key(job_id: str, input_key: str, output_ext: str) -> str:
-    filename = os.path.basename(input_key)
-    stem = _safe_stem_from_filename(filename)
-    return f"{COS_OUTPUT_PREFIX}/{job_id}/{stem}_modified.{output_ext}"
+    def observe(self, quality: str, seconds: float) -> None:
+        with self._lock:
+            prev = self._ewma.get(quality)
+            self._ewma[quality] = seconds if prev is None else prev + self.alpha * (seconds - prev)
 
+    def stats(self) -> dict:
+        # Learned values, plus the seeds of the two qualities a deadline can pick
+        with self._lock:
+            learned = list(self._ewma)
+        qualities = {OPENAI_IMAGE_QUALITY, DEADLINE_FALLBACK_QUALITY, *learned} - {""}
+        return {q: round(self.estimate(q), 1) for q in sorted(qualities)}
 
-# ==================================================
-# COS helpers
-# ==================================================
-def upload_and_presign(result_bytes: bytes, object_key: str, content_type: str, bucket: str) -> str:
-    s3 = make_s3_client()
 
-    try:
-        s3.put_object(
-            Bucket=bucket,
-            Key=object_key,
-            Body=result_bytes,
-            ContentType=content_type,
-        )
-    except (BotoCoreError, ClientError) as e:
-        raise RuntimeError(f"COS put_object failed: {type(e).__name__}: {e}")
+openai_latency = OpenAILatency(OPENAI_EXPECTED_SECONDS)
 
-    try:
-        url = s3.generate_presigned_url(
-            ClientMethod="get_object",
-            Params={"Bucket": bucket, "Key": object_key},
-            ExpiresIn=COS_PRESIGN_EXPIRES,
-        )
-        return url
-    except (BotoCoreError, ClientError) as e:
-        raise RuntimeError(f"COS presign failed: {type(e).__name__}: {e}")
 
+def plan_openai_quality() -> str:
+    """
+    Quality for the next edit of the running job: OPENAI_IMAGE_QUALITY if the expected call fits in the time
+    left (minus DEADLINE_RESERVE_SECONDS), else DEADLINE_FALLBACK_QUALITY if that fits, else DeadlineExceededError.
+    """
+    left = time_left()
+    if left is None:
+        return OPENAI_IMAGE_QUALITY
+    budget = left - DEADLINE_RESERVE_SECONDS
+    if budget >= openai_latency.estimate(OPENAI_IMAGE_QUALITY):
+        return OPENAI_IMAGE_QUALITY
+    cheaper = DEADLINE_FALLBACK_QUALITY
+    if cheaper and cheaper != OPENAI_IMAGE_QUALITY and budget >= openai_latency.estimate(cheaper):
+        DEADLINE_ACTIONS_TOTAL.labels(action="downgraded", stage="openai_edit").inc()
+        print(f"[DEADLINE] {left:.0f}s left: OpenAI quality {OPENAI_IMAGE_QUALITY} -> {cheaper}")
+        return cheaper
+    DEADLINE_ACTIONS_TOTAL.labels(action="aborted", stage="openai_edit").inc()
+    raise DeadlineExceededError(
+        f"délai du job insuffisant pour OpenAI ({max(left, 0.0):.0f}s restantes, "
+        f"~{openai_latency.estimate(cheaper or OPENAI_IMAGE_QUALITY):.0f}s nécessaires)"
+    )
 
-def list_input_objects(prefix: str = "") -> List[str]:
-    if not COS_INPUT_BUCKET:
-        raise RuntimeError("Missing env var: COS_INPUT_BUCKET")
 
-    s3 = make_s3_client()
-    keys: List[str] = []
-    token = None
+def _check_openai_retry(quality: str, delay: float) -> None:
+    # A retry is only worth it if the pause + another call still fit before the deadline
+    check_deadline("openai_retry", needed=delay + openai_latency.estimate(quality) + DEADLINE_RESERVE_SECONDS)
 
-    while True:
-        kwargs = {"Bucket": COS_INPUT_BUCKET}
-        if prefix:
-            kwargs["Prefix"] = prefix
-        if token:
-            kwargs["ContinuationToken"] = token
-
-        resp = s3.list_objects_v2(**kwargs)
-        for obj in resp.get("Contents", []):
-            k = obj.get("Key")
-            if k and not k.endswith("/"):
-                keys.append(k)
-
-        if resp.get("IsTruncated"):
-            token = resp.get("NextContinuationToken")
-        else:
-            break
 
-    return keys
+async def _acquire_openai_slot(quality: str) -> float:
+    """
+    openai_limiter.acquire(), waiting no longer than the job deadline allows for a call of this quality.
+    """
+    left = time_left()
+    if left is None:
+        return await openai_limiter.acquire()
+    slack = left - DEADLINE_RESERVE_SECONDS - openai_latency.estimate(quality)
+    try:
+        return await asyncio.wait_for(openai_limiter.acquire(), timeout=max(slack, 0.1))
+    except asyncio.TimeoutError:
+        DEADLINE_ACTIONS_TOTAL.labels(action="aborted", stage="openai_wait").inc()
+        raise DeadlineExceededError("délai du job dépassé en attente du limiteur OpenAI")
 
 
-def get_object_bytes(bucket: str, key: str) -> bytes:
-    s3 = make_s3_client()
-    resp = s3.get_object(Bucket=bucket, Key=key)
-    return resp["Body"].read()
+def _prepare_openai_edit(image_bytes: bytes, prompt: str) -> tuple[str, bytes, str]:
+    """
+    Validate, then preprocess the input: (filename, bytes, mime) as accepted by the SDK.
+    """
+    _require_openai_config()
+    if not prompt or not prompt.strip():
+        raise ValueError("prompt vide")
 
+    with track_stage("preprocess"):
+        return input_preprocessor.process(image_bytes)
 
-def put_object_bytes(bucket: str, key: str, data: bytes, content_type: str) -> None:
-    s3 = make_s3_client()
-    s3.put_object(Bucket=bucket, Key=key, Body=data, ContentType=content_type)
 
+def _decode_openai_edit_result(result) -> tuple[bytes, str, str]:
+    b64 = result.data[0].b64_json if result and result.data else None
+    if not b64:
+        raise RuntimeError("OpenAI returned empty b64_json")
 
-# ==================================================
-# Utilities
-# ==================================================
-def _validate_image_base64_payload(b64_str: str) -> None:
-    if not b64_str or not b64_str.strip():
-        raise ValueError("image_base64 vide")
-    if len(b64_str) > MAX_IMAGE_BASE64_CHARS:
-        raise ValueError(f"image_base64 trop grand (>{MAX_IMAGE_BASE64_CHARS} chars)")
+    out_bytes = base64.b64decode(b64)
+    output_ext = (OPENAI_IMAGE_OUTPUT_FORMAT or "png").lower().strip()
+    if output_ext == "jpg":
+        output_ext = "jpeg"
+    mime = _mime_from_output_format(output_ext)
+    return out_bytes, mime, output_ext
 
-    # Quick check for "data:" prefix (common workshop issue)
-    if b64_str.strip().lower().startswith("data:"):
-        raise ValueError("image_base64 contient un préfixe data:... ; envoyer uniquement la partie base64")
 
+async def edit_image_with_openai_async(
+    image_bytes: bytes, prompt: str, quality: Optional[str] = None, image_file: Optional[tuple] = None
+) -> tuple[bytes, str, str]:
+    """
+    Returns (output_bytes, mime_type, output_ext). Concurrent edits share warm connections without
+    holding a thread each. Waits, call timeouts and retries stay within the job deadline.
+    `image_file`: output of _prepare_openai_edit when several prompts share one input.
+    """
+    quality = quality or OPENAI_IMAGE_QUALITY
+    if image_file is None:
+        # Decode / resize / re-encode off the loop
+        image_file = await run_blocking(_prepare_openai_edit, image_bytes, prompt)
+    edit_kwargs = dict(
+        model=OPENAI_IMAGE_MODEL,
+        image=image_file,
+        prompt=prompt,
+        quality=quality,
+        output_format=OPENAI_IMAGE_OUTPUT_FORMAT,
+    )
 
-def _looks_like_openai_billing_limit(msg: str) -> bool:
-    m = (msg or "")
-    return ("billing_hard_limit_reached" in m) or ("Billing hard limit has been reached" in m)
+    attempt = 0
+    while True:
+        openai_breaker.allow()
+        try:
+            with track_stage("openai_wait"):
+                started = await _acquire_openai_slot(quality)
+        except BaseException:
+            # Every allowed call ends in record() or cancel(): a lost half-open probe would keep the circuit stuck
+            openai_breaker.cancel()
+            raise
+        timeout = budget_timeout(OPENAI_TIMEOUT_SECONDS, DEADLINE_RESERVE_SECONDS)
+        try:
+            with track_stage("openai_edit"):
+                raw = await get_async_openai_client().images.with_raw_response.edit(**edit_kwargs, timeout=timeout)
+        except Exception as e:
+            delay = _openai_attempt_failed(e, attempt, started, quality, timeout < OPENAI_TIMEOUT_SECONDS)
+            if delay is None:
+                raise
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            _openai_attempt_cancelled(started)
+            raise
+        _openai_attempt_succeeded(started, raw.headers, quality)
+        result = raw.parse()
+        break
+
+    IMAGES_TOTAL.labels(engine="openai").inc()
+    # b64_json of a large image: decode off the loop
+    return await run_blocking(_decode_openai_edit_result, result)
 
 
 # ==================================================
-# Background job A: single image -> COS URL
+# Input preprocessing (runs before every OpenAI edit, single and batch)
 # ==================================================
-async def process_and_callback_url(job_id: str, req: ProcessImageRequest, callback_url: str) -> None:
-    async with _job_semaphore:
-        try:
-            # Validate size/prefix
-            _validate_image_base64_payload(req.image_base64)
+# Formats the images.edit endpoint accepts as-is
+_OPENAI_INPUT_FORMATS = {"PNG": ("png", "image/png"), "JPEG": ("jpeg", "image/jpeg"), "WEBP": ("webp", "image/webp")}
 
-            try:
-                image_bytes = base64.b64decode(req.image_base64, validate=True)
-            except Exception:
-                payload = {
-                    "status": "failed",
-                    "job_id": job_id,
-                    "filename": req.filename,
-                    "error": "ValueError: image_base64 invalide (base64 attendu, sans préfixe data:...)",
-                }
-                await post_callback(callback_url, payload)
-                return
 
-            try:
-                result_bytes, result_mime, output_ext = edit_image_with_openai(image_bytes, req.prompt)
-            except Exception as e:
-                # Workshop continuity: optional fallback for single endpoints too
-                msg = f"{type(e).__name__}: {e}"
-                if ENABLE_FALLBACK_SINGLE and _looks_like_openai_billing_limit(msg):
-                    result_bytes, result_mime, output_ext = local_fallback_process(image_bytes)
-                else:
+def preprocess_signature() -> str:
+    # Part of every key that identifies an edit output (result cache, batch manifest)
+    if not PREPROCESS_ENABLED:
+        return "raw"
+    return f"{PREPROCESS_MAX_EDGE}:{PREPROCESS_FORMAT}:{PREPROCESS_JPEG_QUALITY}"
+
+
+class InputPreprocessor:
+    """
+    Camera JPEGs are often several times larger than what the model works at: draft-mode
+    decoding (JPEG DCT scaling), EXIF orientation fix, downscale to max_edge, compact re-encode.
+    Images already small, upright and in an accepted format are sent unchanged.
+    """
+
+    def __init__(self, enabled: bool, max_edge: int, fmt: str, jpeg_quality: int) -> None:
+        self.enabled = enabled
+        self.max_edge = max(max_edge, 0)
+        self.fmt = fmt if fmt in ("auto", "png", "jpeg", "webp") else "auto"
+        self.jpeg_quality = min(max(jpeg_quality, 1), 95)
+        self._lock = threading.Lock()
+        self.images = 0
+        self.passthrough = 0
+        self.resized = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @staticmethod
+    def _to_8bit(img: Image.Image) -> Image.Image:
+        # 16/32-bit grayscale (I;16 PNG, TIFF): LANCZOS resampling and the encoders want 8 bits per channel
+        if img.mode == "I" or img.mode.startswith("I;16"):
+            scale = 1 / 256 if img.getextrema()[1] > 255 else 1
+            return img.convert("I").point(lambda v: v * scale).convert("L")
+        if img.mode == "F":
+            scale = 255 if img.getextrema()[1] <= 1.0 else 1  # 0..1 floats
+            return img.point(lambda v: v * scale).convert("L")
+        return img
+
+    def _target_format(self, img: Image.Image) -> str:
+        if self.fmt != "auto":
+            return self.fmt.upper()
+        has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+        return "PNG" if has_alpha else "JPEG"
+
+    def _encode(self, img: Image.Image, fmt: str) -> bytes:
+        buf = io.BytesIO()
+        if fmt == "JPEG":
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.save(buf, format="JPEG", quality=self.jpeg_quality, optimize=True)
+        elif fmt == "WEBP":
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+            img.save(buf, format="WEBP", quality=self.jpeg_quality, method=4)
+        else:
+            if img.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+                img = img.convert("RGBA")
+            img.save(buf, format="PNG", optimize=False)
+        return buf.getvalue()
+
+    def _record(self, size_in: int, size_out: int, passthrough: bool, resized: bool) -> None:
+        with self._lock:
+            self.images += 1
+            self.bytes_in += size_in
+            self.bytes_out += size_out
+            if passthrough:
+                self.passthrough += 1
+            if resized:
+                self.resized += 1
+
+    def process(self, data: bytes) -> tuple[str, bytes, str]:
+        """
+        Returns (filename, bytes, mime). Raises ValueError on unreadable images.
+        """
+        try:
+            img = Image.open(io.BytesIO(data))
+        except Exception as e:
+            if not self.enabled:
+                return "input.png", data, "image/png"  # let OpenAI judge, as before preprocessing existed
+            raise ValueError(f"Image illisible : {type(e).__name__}: {e}")
+
+        with img:
+            accepted = _OPENAI_INPUT_FORMATS.get(img.format or "")
+            if not self.enabled:
+                ext, mime = accepted or ("png", "image/png")
+                return f"input.{ext}", data, mime
+
+            orientation = img.getexif().get(0x0112, 1)
+            too_large = bool(self.max_edge) and max(img.size) > self.max_edge
+            if accepted and not too_large and orientation in (0, 1):
+                self._record(len(data), len(data), passthrough=True, resized=False)
+                return f"input.{accepted[0]}", data, accepted[1]
+
+            if too_large:
+                # JPEG: decode at 1/2, 1/4 or 1/8 scale directly, never below the target size
+                ratio = self.max_edge / max(img.size)
+                img.draft(None, (max(int(img.width * ratio), 1), max(int(img.height * ratio), 1)))
+            img = self._to_8bit(ImageOps.exif_transpose(img))
+            if self.max_edge:
+                img.thumbnail((self.max_edge, self.max_edge), Image.Resampling.LANCZOS)
+
+            fmt = self._target_format(img)
+            out = self._encode(img, fmt)
+
+        ext, mime = _OPENAI_INPUT_FORMATS[fmt]
+        self._record(len(data), len(out), passthrough=False, resized=too_large)
+        return f"input.{ext}", out, mime
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "max_edge": self.max_edge,
+                "format": self.fmt,
+                "images": self.images,
+                "passthrough": self.passthrough,
+                "resized": self.resized,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "bytes_saved": self.bytes_in - self.bytes_out,
+            }
+
+
+input_preprocessor = InputPreprocessor(
+    PREPROCESS_ENABLED, PREPROCESS_MAX_EDGE, PREPROCESS_FORMAT, PREPROCESS_JPEG_QUALITY
+)
+
+
+# ==================================================
+# Result cache (identical image + prompt + output settings -> same edit)
+# ==================================================
+class ResultCache:
+    """
+    Content-addressed cache of OpenAI edits.
+    - memory tier: LRU bounded by total bytes
+    - optional COS tier: one object per key under RESULT_CACHE_PREFIX in COS_OUTPUT_BUCKET
+    """
+
+    def __init__(self, max_bytes: int, cos_enabled: bool, cos_prefix: str) -> None:
+        self.max_bytes = max(max_bytes, 0)
+        self.cos_enabled = cos_enabled
+        self.cos_prefix = cos_prefix.strip("/")
+        self._entries: "OrderedDict[str, tuple[bytes, str, str]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.cos_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._miss_seconds = 0.0
+
+    @staticmethod
+    def key_for(image_bytes: bytes, prompt: str) -> str:
+        h = hashlib.sha256()
+        h.update(hashlib.sha256(image_bytes).digest())
+        for part in (prompt, OPENAI_IMAGE_MODEL, OPENAI_IMAGE_QUALITY, OPENAI_IMAGE_OUTPUT_FORMAT, preprocess_signature()):
+            h.update(b"\0")
+            h.update((part or "").encode("utf-8"))
+        return h.hexdigest()
+
+    def _cos_key(self, key: str) -> str:
+        return f"{self.cos_prefix}/{key}"
+
+    def _memory_get(self, key: str) -> Optional[tuple[bytes, str, str]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _memory_put(self, key: str, entry: tuple[bytes, str, str]) -> None:
+        size = len(entry[0])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = entry
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[0])
+                self.evictions += 1
+
+    def _cos_get(self, key: str) -> Optional[tuple[bytes, str, str]]:
+        try:
+            resp = get_s3_client().get_object(Bucket=COS_OUTPUT_BUCKET, Key=self._cos_key(key))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        mime = resp.get("ContentType") or "application/octet-stream"
+        ext = (resp.get("Metadata") or {}).get("ext") or "png"
+        return resp["Body"].read(), mime, ext
+
+    def _cos_put(self, key: str, entry: tuple[bytes, str, str]) -> None:
+        data, mime, ext = entry
+        put_object_bytes(COS_OUTPUT_BUCKET, self._cos_key(key), data, mime, metadata={"ext": ext})
+
+    async def get(self, key: str) -> Optional[tuple[bytes, str, str]]:
+        entry = self._memory_get(key)
+        if entry is not None:
+            self.memory_hits += 1
+            return entry
+        if self.cos_enabled:
+            try:
+                entry = await run_blocking(self._cos_get, key)
+            except Exception as e:
+                print(f"result cache: COS lookup failed ({type(e).__name__}: {e})")
+                entry = None
+            if entry is not None:
+                self.cos_hits += 1
+                self._memory_put(key, entry)
+                return entry
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, entry: tuple[bytes, str, str], miss_seconds: float) -> None:
+        self._miss_seconds += miss_seconds
+        self._memory_put(key, entry)
+        if self.cos_enabled:
+            try:
+                await run_blocking(self._cos_put, key, entry)
+            except Exception as e:
+                print(f"result cache: COS store failed ({type(e).__name__}: {e})")
+
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.cos_hits
+        avg_miss = (self._miss_seconds / self.misses) if self.misses else 0.0
+        return {
+            "enabled": RESULT_CACHE_ENABLED,
+            "cos_tier_enabled": self.cos_enabled,
+            "memory_hits": self.memory_hits,
+            "cos_hits": self.cos_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / (hits + self.misses), 3) if (hits + self.misses) else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            # Each hit skips one model call: estimate from the average miss latency
+            "estimated_seconds_saved": round(hits * avg_miss, 1),
+        }
+
+
+result_cache = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_COS_ENABLED, RESULT_CACHE_PREFIX)
+
+
+async def edit_image_cached(image_bytes: bytes, prompt: str, image_file: Optional[tuple] = None) -> tuple[bytes, str, str]:
+    """
+    edit_image_with_openai_async behind the result cache (single-URL, single-b64 and batch paths).
+    A hit is served whatever the deadline; a miss runs at the quality the deadline allows (plan_openai_quality).
+    """
+    if not RESULT_CACHE_ENABLED:
+        return await edit_image_with_openai_async(image_bytes, prompt, plan_openai_quality(), image_file)
+
+    key = await run_blocking(ResultCache.key_for, image_bytes, prompt)
+    cached = await result_cache.get(key)
+    if cached is not None:
+        IMAGES_TOTAL.labels(engine="cache").inc()
+        return cached
+
+    quality = plan_openai_quality()
+    start = time.perf_counter()
+    result = await edit_image_with_openai_async(image_bytes, prompt, quality, image_file)
+    # The key is for OPENAI_IMAGE_QUALITY: a downgraded result is not cached under it
+    if quality == OPENAI_IMAGE_QUALITY:
+        await result_cache.put(key, result, miss_seconds=time.perf_counter() - start)
+    return result
+
+
+# ==================================================
+# Fallback local (demo continuity)
+# ==================================================
+_fallback_pool: Optional[ProcessPoolExecutor] = None
+_fallback_pool_lock = threading.Lock()
+
+
+def _get_fallback_pool() -> ProcessPoolExecutor:
+    """
+    Lazily start the fallback process pool (spawn: no fork of a process running threads and an event loop).
+    Spawned processes re-import the parent's __main__: uvicorn or worker.py, which leave main.py alone.
+    """
+    global _fallback_pool
+    with _fallback_pool_lock:
+        if _fallback_pool is None:
+            _fallback_pool = ProcessPoolExecutor(
+                max_workers=max(FALLBACK_PROCESS_WORKERS, 1),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _fallback_pool
+
+
+def shutdown_fallback_pool() -> None:
+    global _fallback_pool
+    with _fallback_pool_lock:
+        pool, _fallback_pool = _fallback_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def local_fallback_process(image_bytes: bytes) -> tuple[bytes, str, str]:
+    """
+    Negative image + "DEMO - FALLBACK" banner, rendered in the fallback process pool.
+    """
+    global _fallback_pool
+    if FALLBACK_PROCESS_WORKERS <= 0:
+        with track_stage("fallback"):
+            result = await run_blocking(render_fallback, image_bytes, FALLBACK_PNG_COMPRESS_LEVEL)
+        IMAGES_TOTAL.labels(engine="fallback").inc()
+        return result
+
+    pool = _get_fallback_pool()
+    loop = asyncio.get_running_loop()
+    try:
+        with track_stage("fallback"):
+            result = await loop.run_in_executor(pool, render_fallback, image_bytes, FALLBACK_PNG_COMPRESS_LEVEL)
+        IMAGES_TOTAL.labels(engine="fallback").inc()
+        return result
+    except BrokenProcessPool:
+        # A worker died (OOM kill...): drop the pool so the next fallback starts a fresh one
+        with _fallback_pool_lock:
+            if _fallback_pool is pool:
+                _fallback_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+
+# ==================================================
+# App
+# ==================================================
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # Resume callbacks persisted by a previous run, then drain in the background
+    await callback_dispatcher.start()
+    yield
+    job_scheduler.close()
+    shutdown_fallback_pool()
+    await callback_dispatcher.stop()
+    await close_async_openai_client()
+
+
+app = FastAPI(title="WXO Async Image Tools", version="3.2.0-workshop", lifespan=lifespan)
+
+
+# ==================================================
+# Workshop guard: optional shared token
+# ==================================================
+def _require_workshop_token(header_value: Optional[str]) -> None:
+    if not WORKSHOP_TOKEN:
+        return  # disabled
+    if not header_value or header_value.strip() != WORKSHOP_TOKEN:
+        raise HTTPException(status_code=401, detail="Unauthorized (missing/invalid x-workshop-token)")
+
+
+# ==================================================
+# Input schemas
+# ==================================================
+class ProcessImageRequest(BaseModel):
+    prompt: str = Field(..., description="Instruction de retouche")
+    filename: Optional[str] = Field(None, description="Nom du fichier (corrélation)")
+    image_base64: str = Field(..., description="Image encodée en base64 (sans data:...)")
+
+
+class UploadImageRequest(BaseModel):
+    """
+    Internal job request for the binary upload endpoints: the image already sits in a temp file.
+    """
+    prompt: str
+    filename: Optional[str] = None
+    upload_path: str
+
+
+class CosImageRequest(BaseModel):
+    prompt: str = Field(..., description="Instruction de retouche")
+    object_key: str = Field(..., min_length=1, description="Clé de l'image dans COS_INPUT_BUCKET (voir /uploads/presign)")
+    filename: Optional[str] = Field(None, description="Nom du fichier (corrélation)")
+
+
+class UploadPresignRequest(BaseModel):
+    filename: Optional[str] = Field(None, description="Nom du fichier (sert à construire la clé)")
+    content_type: str = Field("application/octet-stream", description="Content-Type envoyé par le client à COS")
+    method: Literal["put", "post"] = Field(
+        "put",
+        description="put : URL pré-signée PUT ; post : formulaire POST pré-signé (taille bornée par COS)",
+    )
+
+
+SingleImageRequest = Union[ProcessImageRequest, UploadImageRequest, CosImageRequest]
+
+
+class BatchProcessRequest(BaseModel):
+    prompt: Optional[str] = Field(None, description="Instruction appliquée à toutes les images du bucket input")
+    prompts: Optional[List[str]] = Field(
+        None,
+        description="Plusieurs instructions (remplace prompt) : une variante par prompt, chaque image n'est lue qu'une fois",
+    )
+    output_formats: Optional[List[Literal["png", "jpeg", "webp"]]] = Field(
+        None,
+        description="Formats de sortie, réencodés localement : une variante par format et par prompt (défaut : format de l'édition)",
+    )
+    incremental: bool = Field(
+        False,
+        description="Ne traiter que les images nouvelles ou modifiées depuis le dernier lot (manifest COS)",
+    )
+    modified_after: Optional[datetime] = Field(None, description="Ignorer les objets modifiés avant cette date (ISO 8601)")
+    modified_before: Optional[datetime] = Field(None, description="Ignorer les objets modifiés après cette date (ISO 8601)")
+
+
+# ==================================================
+# Callback dispatcher (pooled client + durable retry queue)
+# ==================================================
+class CallbackQueue(ABC):
+    """
+    Pending callbacks. Entries are claimed with a lease, so a crashed or restarted
+    process (or another process sharing the SQLite file) picks them up again.
+    Entry: {id, job_id, label, callback_url, payload, attempts, due_at}
+    """
+
+    @abstractmethod
+    def put(self, entry: dict) -> None:
+        ...
+
+    @abstractmethod
+    def claim_due(self, now: float, limit: int, lease_seconds: float) -> List[dict]:
+        ...
+
+    @abstractmethod
+    def reschedule(self, entry_id: str, attempts: int, due_at: float) -> None:
+        ...
+
+    @abstractmethod
+    def remove(self, entry_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def next_due(self) -> Optional[float]:
+        ...
+
+    @abstractmethod
+    def pending(self) -> int:
+        ...
+
+
+class InMemoryCallbackQueue(CallbackQueue):
+    def __init__(self) -> None:
+        self._entries: dict = {}
+        self._claimed_until: dict = {}
+        self._lock = threading.Lock()
+
+    def put(self, entry: dict) -> None:
+        with self._lock:
+            self._entries[entry["id"]] = dict(entry)
+            self._claimed_until.pop(entry["id"], None)
+
+    def claim_due(self, now: float, limit: int, lease_seconds: float) -> List[dict]:
+        with self._lock:
+            due = [
+                e for e in self._entries.values()
+                if e["due_at"] <= now and self._claimed_until.get(e["id"], 0.0) <= now
+            ]
+            due.sort(key=lambda e: e["due_at"])
+            claimed = due[:limit]
+            for e in claimed:
+                self._claimed_until[e["id"]] = now + lease_seconds
+            return [dict(e) for e in claimed]
+
+    def reschedule(self, entry_id: str, attempts: int, due_at: float) -> None:
+        with self._lock:
+            if entry_id in self._entries:
+                self._entries[entry_id].update(attempts=attempts, due_at=due_at)
+                self._claimed_until.pop(entry_id, None)
+
+    def remove(self, entry_id: str) -> None:
+        with self._lock:
+            self._entries.pop(entry_id, None)
+            self._claimed_until.pop(entry_id, None)
+
+    def next_due(self) -> Optional[float]:
+        with self._lock:
+            times = [max(e["due_at"], self._claimed_until.get(e["id"], 0.0)) for e in self._entries.values()]
+            return min(times) if times else None
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+class SqliteCallbackQueue(CallbackQueue):
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS callbacks ("
+                " id TEXT PRIMARY KEY,"
+                " job_id TEXT,"
+                " label TEXT,"
+                " callback_url TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " due_at REAL NOT NULL,"
+                " claimed_until REAL NOT NULL DEFAULT 0,"
+                " deadline REAL)"
+            )
+            try:
+                # Queue files created before job deadlines
+                self._conn.execute("ALTER TABLE callbacks ADD COLUMN deadline REAL")
+            except sqlite3.OperationalError:
+                pass
+
+    def put(self, entry: dict) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO callbacks"
+                " (id, job_id, label, callback_url, payload, attempts, due_at, claimed_until, deadline)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)",
+                (
+                    entry["id"],
+                    entry["job_id"],
+                    entry["label"],
+                    entry["callback_url"],
+                    json.dumps(entry["payload"]),
+                    entry["attempts"],
+                    entry["due_at"],
+                    entry.get("deadline"),
+                ),
+            )
+
+    def claim_due(self, now: float, limit: int, lease_seconds: float) -> List[dict]:
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "SELECT id, job_id, label, callback_url, payload, attempts, due_at, deadline FROM callbacks"
+                " WHERE due_at <= ? AND claimed_until <= ? ORDER BY due_at LIMIT ?",
+                (now, now, limit),
+            ).fetchall()
+            claimed: List[dict] = []
+            for row in rows:
+                # Conditional update: another process may have claimed the row meanwhile
+                cur = self._conn.execute(
+                    "UPDATE callbacks SET claimed_until = ? WHERE id = ? AND claimed_until <= ?",
+                    (now + lease_seconds, row[0], now),
+                )
+                if cur.rowcount:
+                    claimed.append(
+                        {
+                            "id": row[0],
+                            "job_id": row[1],
+                            "label": row[2],
+                            "callback_url": row[3],
+                            "payload": json.loads(row[4]),
+                            "attempts": row[5],
+                            "due_at": row[6],
+                            "deadline": row[7],
+                        }
+                    )
+            return claimed
+
+    def reschedule(self, entry_id: str, attempts: int, due_at: float) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE callbacks SET attempts = ?, due_at = ?, claimed_until = 0 WHERE id = ?",
+                (attempts, due_at, entry_id),
+            )
+
+    def remove(self, entry_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM callbacks WHERE id = ?", (entry_id,))
+
+    def next_due(self) -> Optional[float]:
+        with self._lock:
+            row = self._conn.execute("SELECT MIN(MAX(due_at, claimed_until)) FROM callbacks").fetchone()
+        return row[0] if row and row[0] is not None else None
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM callbacks").fetchone()[0]
+
+
+def encode_callback_body(payload: dict) -> tuple[bytes, dict]:
+    """
+    JSON body + headers for a callback, compressed per CALLBACK_COMPRESSION above CALLBACK_COMPRESS_MIN_BYTES.
+    """
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if CALLBACK_COMPRESSION in ("gzip", "deflate") and len(body) >= CALLBACK_COMPRESS_MIN_BYTES:
+        # Base64 images still shrink by ~25%: the alphabet only uses 6 of every 8 bits
+        body = gzip.compress(body, compresslevel=6) if CALLBACK_COMPRESSION == "gzip" else zlib.compress(body, 6)
+        headers["Content-Encoding"] = CALLBACK_COMPRESSION
+    return body, headers
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class CallbackDispatcher:
+    """
+    Delivers callbacks with one shared, pooled AsyncClient (HTTP/2 when available).
+    Retries are scheduled in the queue (CALLBACK_BACKOFF_SECONDS), never slept in the job,
+    so job slots are freed as soon as the image work is done.
+    """
+
+    def __init__(self, queue: CallbackQueue) -> None:
+        self.queue = queue
+        self.http2 = CALLBACK_HTTP2 and _http2_available()
+        self.in_flight = 0
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._deliveries: set = set()
+
+    def _ensure_started(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._task is not None and self._loop is loop and not self._task.done():
+            return
+        self._loop = loop
+        self._client = httpx.AsyncClient(
+            timeout=CALLBACK_TIMEOUT_SECONDS,
+            http2=self.http2,
+            limits=httpx.Limits(max_connections=max(CALLBACK_CONCURRENCY, 1)),
+        )
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(max(CALLBACK_CONCURRENCY, 1))
+        self._task = loop.create_task(self._run())
+
+    async def start(self) -> None:
+        self._ensure_started()
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Unfinished deliveries keep their lease and are retried after restart
+        for t in list(self._deliveries):
+            t.cancel()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def enqueue(
+        self, job_id: str, callback_url: str, payload: dict, label: str, deadline: Optional[float] = None
+    ) -> None:
+        self._ensure_started()
+        entry = {
+            "id": str(uuid.uuid4()),
+            "job_id": job_id,
+            "label": label,
+            "callback_url": callback_url,
+            "payload": payload,
+            "attempts": 0,
+            "due_at": time.time(),
+            "deadline": deadline,
+        }
+        await run_blocking(self.queue.put, entry)
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        lease = CALLBACK_TIMEOUT_SECONDS + 30
+        while True:
+            try:
+                free = max(CALLBACK_CONCURRENCY, 1) - self.in_flight
+                entries = await run_blocking(self.queue.claim_due, time.time(), free, lease) if free > 0 else []
+                for entry in entries:
+                    self.in_flight += 1
+                    t = asyncio.create_task(self._deliver(entry))
+                    self._deliveries.add(t)
+                    t.add_done_callback(self._deliveries.discard)
+
+                next_due = await run_blocking(self.queue.next_due)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"callback dispatcher: queue error ({type(e).__name__}: {e})")
+                next_due = None
+
+            # Poll at least every CALLBACK_QUEUE_POLL_SECONDS (other processes may share the queue)
+            wait = CALLBACK_QUEUE_POLL_SECONDS
+            if next_due is not None:
+                wait = min(wait, max(next_due - time.time(), 0.0))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, entry: dict) -> None:
+        attempt = entry["attempts"] + 1
+        max_attempts = max(CALLBACK_MAX_RETRIES, 1)
+        try:
+            async with self._slots:
+                try:
+                    with track_stage("callback"):
+                        await self._send(entry, attempt)
+                except Exception:
+                    CALLBACK_ATTEMPTS_TOTAL.labels(result="error").inc()
                     raise
+                CALLBACK_ATTEMPTS_TOTAL.labels(result="ok").inc()
+        except Exception as e:
+            backoff = CALLBACK_BACKOFF_LIST[min(attempt - 1, len(CALLBACK_BACKOFF_LIST) - 1)]
+            # A retry landing after the job deadline would reach a caller that has given up
+            late = entry.get("deadline") is not None and time.time() + backoff >= entry["deadline"]
+            if attempt < max_attempts and not late:
+                print(f"callback : attempt failed ({type(e).__name__}: {e}); retrying in {backoff}s")
+                await run_blocking(self.queue.reschedule, entry["id"], attempt, time.time() + backoff)
+            else:
+                if late and attempt < max_attempts:
+                    DEADLINE_ACTIONS_TOTAL.labels(action="aborted", stage="callback_retry").inc()
+                    err = RuntimeError(f"Callback failed, no retry past the job deadline: {type(e).__name__}: {e}")
+                else:
+                    err = RuntimeError(f"Callback failed after {max_attempts} attempts: {type(e).__name__}: {e}")
+                await run_blocking(self.queue.remove, entry["id"])
+                await run_blocking(job_store.update, entry["job_id"], callback_delivered=False, callback_error=str(err))
+                CALLBACKS_TOTAL.labels(outcome="failed").inc()
+                print(f"!!! CALLBACK FAILED ({entry['label']}) !!!", repr(err))
+        else:
+            await run_blocking(self.queue.remove, entry["id"])
+            await run_blocking(job_store.update, entry["job_id"], callback_delivered=True, callback_error=None)
+            CALLBACKS_TOTAL.labels(outcome="delivered").inc()
+        finally:
+            self.in_flight -= 1
+            self._wakeup.set()
+
+    async def _send(self, entry: dict, attempt: int) -> None:
+        callback_url = entry["callback_url"]
+        payload = entry["payload"]
+        final_callback_url = rewrite_callback_url(callback_url)
+
+        print("=== CALLBACK ===")
+        print("job_id   :", payload.get("job_id", "?"))
+        print("original :", callback_url)
+        print("final    :", final_callback_url)
+        print("status   :", payload.get("status"))
+        print("keys     :", list(payload.keys()))
+
+        body, headers = await run_blocking(encode_callback_body, payload)
+        timeout = CALLBACK_TIMEOUT_SECONDS
+        if entry.get("deadline") is not None:
+            # Within the job deadline, but at least a second: the result is ready, the send costs nothing upstream
+            timeout = max(min(timeout, entry["deadline"] - time.time()), 1.0)
+        r = await self._client.post(final_callback_url, content=body, headers=headers, timeout=timeout)
+        print(
+            f"attempt  : {attempt}/{CALLBACK_MAX_RETRIES} -> HTTP {r.status_code} ({r.http_version}, "
+            f"{len(body)} bytes{', ' + headers['Content-Encoding'] if 'Content-Encoding' in headers else ''})"
+        )
+        r.raise_for_status()
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.queue.pending(),
+            "in_flight": self.in_flight,
+            "http2": self.http2,
+            "durable": isinstance(self.queue, SqliteCallbackQueue),
+            "compression": CALLBACK_COMPRESSION if CALLBACK_COMPRESSION in ("gzip", "deflate") else "none",
+        }
+
+
+def make_callback_queue() -> CallbackQueue:
+    if CALLBACK_QUEUE_PATH:
+        return SqliteCallbackQueue(CALLBACK_QUEUE_PATH)
+    return InMemoryCallbackQueue()
+
+
+callback_dispatcher = CallbackDispatcher(make_callback_queue())
+
+
+async def post_callback(callback_url: str, payload: dict, label: str = "CALLBACK") -> None:
+    """
+    Queue a callback for delivery and return immediately (retries handled by the dispatcher,
+    never past the deadline of the job running in this context).
+    """
+    await callback_dispatcher.enqueue(payload.get("job_id", "?"), callback_url, payload, label, _job_deadline.get())
+
+
+# ==================================================
+# Job store (status + result polling via GET /jobs/{job_id})
+# ==================================================
+JOB_STATES = ("accepted", "running", "completed", "failed")
+
+
+def _utc_now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+class JobStore(ABC):
+    """
+    Job registry: state, timestamps, batch progress counters and the final callback payload.
+    Records are plain dicts so both backends (and the HTTP response) share one shape.
+    """
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def _put(self, record: dict) -> None:
+        ...
+
+    @abstractmethod
+    def _modify(self, job_id: str, change: Callable[[dict], bool]) -> Optional[dict]:
+        """
+        Atomic read-modify-write: `change` edits the record in place and returns True to save it.
+        Returns the record as stored, or None for an unknown job_id.
+        """
+
+    def create(self, job_id: str, kind: str, deadline: Optional[float] = None) -> dict:
+        now = _utc_now_iso()
+        record = {
+            "job_id": job_id,
+            "kind": kind,
+            "state": "accepted",
+            "accepted_at": now,
+            "deadline_at": (
+                datetime.fromtimestamp(deadline, timezone.utc).isoformat(timespec="milliseconds") if deadline else None
+            ),
+            "started_at": None,
+            "finished_at": None,
+            "updated_at": now,
+            "progress": None,
+            "result": None,
+            "callback_delivered": None,
+            "callback_error": None,
+            "attached_callback_urls": [],
+        }
+        self._put(record)
+        return record
+
+    def update(self, job_id: str, **fields) -> Optional[dict]:
+        def change(record: dict) -> bool:
+            record.update(fields)
+            return True
+
+        return self._modify(job_id, change)
+
+    def attach_callback(self, job_id: str, callback_url: str) -> Optional[dict]:
+        """
+        Add a duplicate submission's callbackUrl to a job that has not finished, atomically with
+        mark_job_finished: either the URL is in the record the job finishes with, or the returned
+        record is already completed/failed.
+        """
+        def change(record: dict) -> bool:
+            attached = record.get("attached_callback_urls") or []
+            if record["state"] in ("completed", "failed") or callback_url in attached:
+                return False
+            record["attached_callback_urls"] = attached + [callback_url]
+            return True
+
+        return self._modify(job_id, change)
+
+
+def _record_bytes(record: dict) -> int:
+    # A b64 result dominates; the rest of a record is a few hundred bytes
+    return 1024 + len((record.get("result") or {}).get("result_image_base64") or "")
+
+
+class InMemoryJobStore(JobStore):
+    """
+    Per-process LRU (oldest jobs evicted beyond max_jobs or max_bytes). Lost on restart.
+    A result too large for max_bytes on its own is kept without its base64 image.
+    """
+
+    def __init__(self, max_jobs: int, max_bytes: int) -> None:
+        self.max_jobs = max(max_jobs, 1)
+        self.max_bytes = max(max_bytes, 0)
+        self.bytes = 0
+        self._records: "OrderedDict[str, dict]" = OrderedDict()
+        self._sizes: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            record = self._records.get(job_id)
+            if record is None:
+                return None
+            self._records.move_to_end(job_id)
+            return dict(record)
+
+    def _store(self, record: dict) -> None:
+        # Caller holds self._lock
+        record = dict(record)
+        size = _record_bytes(record)
+        if self.max_bytes and size > self.max_bytes:
+            record["result"] = {**record["result"], "result_image_base64": None, "result_image_omitted": True}
+            size = _record_bytes(record)
+        job_id = record["job_id"]
+        self.bytes += size - self._sizes.get(job_id, 0)
+        self._records[job_id] = record
+        self._sizes[job_id] = size
+        self._records.move_to_end(job_id)
+        while len(self._records) > 1 and (
+            len(self._records) > self.max_jobs or (self.max_bytes and self.bytes > self.max_bytes)
+        ):
+            evicted, _record = self._records.popitem(last=False)
+            self.bytes -= self._sizes.pop(evicted)
+
+    def _put(self, record: dict) -> None:
+        with self._lock:
+            self._store(record)
+
+    def _modify(self, job_id: str, change: Callable[[dict], bool]) -> Optional[dict]:
+        with self._lock:
+            record = self._records.get(job_id)
+            if record is None:
+                return None
+            record = dict(record)
+            if change(record):
+                record["updated_at"] = _utc_now_iso()
+                self._store(record)
+            else:
+                self._records.move_to_end(job_id)
+            return dict(record)
+
+
+class SqliteJobStore(JobStore):
+    """
+    File-backed store: survives restarts and can be shared by several processes on one host.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY,"
+                " state TEXT NOT NULL,"
+                " updated_at TEXT NOT NULL,"
+                " data TEXT NOT NULL)"
+            )
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _put(self, record: dict) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, state, updated_at, data) VALUES (?, ?, ?, ?)",
+                (record["job_id"], record["state"], record["updated_at"], json.dumps(record)),
+            )
+
+    def _modify(self, job_id: str, change: Callable[[dict], bool]) -> Optional[dict]:
+        with self._lock, self._conn:
+            # Write lock from the read on: the API (attach) and the workers (finish) cannot interleave
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            record = json.loads(row[0])
+            if change(record):
+                record["updated_at"] = _utc_now_iso()
+                self._conn.execute(
+                    "UPDATE jobs SET state = ?, updated_at = ?, data = ? WHERE job_id = ?",
+                    (record["state"], record["updated_at"], json.dumps(record), job_id),
+                )
+            return record
+
+
+def make_job_store() -> JobStore:
+    backend = JOB_STORE_BACKEND.lower()
+    if backend == "sqlite":
+        return SqliteJobStore(JOB_STORE_PATH)
+    if backend != "memory":
+        raise RuntimeError(f"Invalid JOB_STORE_BACKEND: {JOB_STORE_BACKEND} (memory|sqlite)")
+    return InMemoryJobStore(JOB_STORE_MAX_JOBS, JOB_STORE_MAX_BYTES)
+
+
+job_store = make_job_store()
+
+
+async def mark_job_running(job_id: str) -> None:
+    # Store calls go through the thread pool: SQLite writes (and MB-sized results) stay off the loop
+    await run_blocking(job_store.update, job_id, state="running", started_at=_utc_now_iso())
+
+
+def mark_job_finished(job_id: str, payload: dict) -> Optional[dict]:
+    # Batch "completed_with_errors" is still a completed job; the detail stays in result.status
+    state = "failed" if payload.get("status") == "failed" else "completed"
+    return job_store.update(job_id, state=state, finished_at=_utc_now_iso(), result=payload)
+
+
+async def deliver_job_result(job_id: str, callback_url: str, payload: dict, label: str) -> None:
+    """
+    Record the final payload first, so a lost callback never means redoing the edit.
+    Delivery (and its retries) then happens in the callback dispatcher, once per callbackUrl
+    (duplicate submissions attached to this job get the same payload).
+    """
+    record = await run_blocking(mark_job_finished, job_id, payload)
+    job_coalescer.release(job_id)
+
+    callback_urls = [callback_url]
+    for url in (record or {}).get("attached_callback_urls") or []:
+        if url not in callback_urls:
+            callback_urls.append(url)
+
+    for url in callback_urls:
+        try:
+            await post_callback(url, payload, label=label if url == callback_url else f"{label} (attached)")
+        except Exception as cb_err:
+            await run_blocking(
+                job_store.update, job_id, callback_delivered=False, callback_error=f"{type(cb_err).__name__}: {cb_err}"
+            )
+            print(f"!!! CALLBACK FAILED ({label}) !!!", repr(cb_err))
+
+
+# ==================================================
+# Job queue (JOB_EXECUTION_MODE=queue): durable hand-off from the API to worker processes
+# ==================================================
+class JobQueue(ABC):
+    """
+    Accepted jobs waiting for a worker. A claim takes a lease that the worker renews while
+    the job runs; a crashed worker's lease expires and the job is claimed again.
+    Entry: {job_id, lane, kind, callback_url, request, enqueued_at, attempts, deadline}
+    """
+
+    @abstractmethod
+    def put(self, entry: dict) -> None:
+        ...
+
+    @abstractmethod
+    def claim(self, lane: str, worker_id: str, now: float, lease_seconds: float) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    def renew(self, job_id: str, worker_id: str, until: float) -> bool:
+        ...
+
+    @abstractmethod
+    def ack(self, job_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def stats(self, now: float) -> dict:
+        """
+        Per lane: {"queued": waiting or lease expired, "running": currently leased}.
+        """
+        ...
+
+
+class SqliteJobQueue(JobQueue):
+    """
+    On-disk queue shared by the API and the workers of one host (WAL mode).
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_queue ("
+                " job_id TEXT PRIMARY KEY,"
+                " lane TEXT NOT NULL,"
+                " kind TEXT NOT NULL,"
+                " callback_url TEXT NOT NULL,"
+                " request TEXT NOT NULL,"
+                " enqueued_at REAL NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " claimed_by TEXT,"
+                " claimed_until REAL NOT NULL DEFAULT 0,"
+                " deadline REAL)"
+            )
+            try:
+                # Queue files created before job deadlines
+                self._conn.execute("ALTER TABLE job_queue ADD COLUMN deadline REAL")
+            except sqlite3.OperationalError:
+                pass
+            self._conn.execute("CREATE INDEX IF NOT EXISTS job_queue_lane ON job_queue (lane, enqueued_at)")
+
+    def put(self, entry: dict) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO job_queue (job_id, lane, kind, callback_url, request, enqueued_at, deadline)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    entry["job_id"],
+                    entry["lane"],
+                    entry["kind"],
+                    entry["callback_url"],
+                    json.dumps(entry["request"]),
+                    entry["enqueued_at"],
+                    entry.get("deadline"),
+                ),
+            )
+
+    def claim(self, lane: str, worker_id: str, now: float, lease_seconds: float) -> Optional[dict]:
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "SELECT job_id, lane, kind, callback_url, request, enqueued_at, attempts, deadline FROM job_queue"
+                " WHERE lane = ? AND claimed_until <= ? ORDER BY enqueued_at LIMIT 5",
+                (lane, now),
+            ).fetchall()
+            for row in rows:
+                # Conditional update: another worker may have claimed the row meanwhile
+                cur = self._conn.execute(
+                    "UPDATE job_queue SET claimed_by = ?, claimed_until = ?, attempts = attempts + 1"
+                    " WHERE job_id = ? AND claimed_until <= ?",
+                    (worker_id, now + lease_seconds, row[0], now),
+                )
+                if cur.rowcount:
+                    return {
+                        "job_id": row[0],
+                        "lane": row[1],
+                        "kind": row[2],
+                        "callback_url": row[3],
+                        "request": json.loads(row[4]),
+                        "enqueued_at": row[5],
+                        "attempts": row[6] + 1,
+                        "deadline": row[7],
+                    }
+            return None
+
+    def renew(self, job_id: str, worker_id: str, until: float) -> bool:
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "UPDATE job_queue SET claimed_until = ? WHERE job_id = ? AND claimed_by = ?",
+                (until, job_id, worker_id),
+            )
+            return bool(cur.rowcount)
+
+    def ack(self, job_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM job_queue WHERE job_id = ?", (job_id,))
+
+    def stats(self, now: float) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT lane, SUM(claimed_until <= ?), SUM(claimed_until > ?) FROM job_queue GROUP BY lane",
+                (now, now),
+            ).fetchall()
+        return {lane: {"queued": int(queued or 0), "running": int(running or 0)} for lane, queued, running in rows}
+
+
+def make_job_queue() -> Optional[JobQueue]:
+    if JOB_EXECUTION_MODE == "inprocess":
+        return None
+    if JOB_EXECUTION_MODE != "queue":
+        raise RuntimeError(f"Invalid JOB_EXECUTION_MODE: {JOB_EXECUTION_MODE} (inprocess|queue)")
+    if JOB_QUEUE_BACKEND != "sqlite":
+        raise RuntimeError(f"Invalid JOB_QUEUE_BACKEND: {JOB_QUEUE_BACKEND} (sqlite)")
+    if JOB_STORE_BACKEND.lower() != "sqlite":
+        # Workers record job states and attached callbacks in the store: the API must see them
+        # (GET /jobs, duplicate coalescing), a per-process memory store would not
+        raise RuntimeError("JOB_EXECUTION_MODE=queue requires JOB_STORE_BACKEND=sqlite (store shared with the workers)")
+    return SqliteJobQueue(JOB_QUEUE_PATH)
+
+
+job_queue = make_job_queue()
+
+
+# ==================================================
+# Helpers: naming
+# ==================================================
+def _safe_stem_from_filename(filename: str) -> str:
+    stem, _ = os.path.splitext(filename)
+    stem = stem.strip().replace(" ", "_")
+    stem = re.sub(r"[^a-zA-Z0-9_\-\.]+", "_", stem)
+    stem = stem.strip("._-") or "image"
+    return stem
+
+
+def make_object_key(job_id: str, filename: Optional[str], output_ext: str) -> str:
+    stem = _safe_stem_from_filename(filename) if filename else f"image_{job_id[:8]}"
+    return f"results/{job_id}/{stem}_modified.{output_ext}"
+
+
+def make_batch_output_key(job_id: str, input_key: str, output_ext: str, variant: str = "") -> str:
+    filename = os.path.basename(input_key)
+    stem = _safe_stem_from_filename(filename)
+    if variant:
+        return f"{COS_OUTPUT_PREFIX}/{job_id}/{variant}/{stem}_modified.{output_ext}"
+    return f"{COS_OUTPUT_PREFIX}/{job_id}/{stem}_modified.{output_ext}"
+
+
+# ==================================================
+# COS helpers
+# ==================================================
+def upload_and_presign(result_bytes: bytes, object_key: str, content_type: str, bucket: str) -> str:
+    s3 = get_s3_client()
+
+    try:
+        put_object_bytes(bucket, object_key, result_bytes, content_type)
+    except (BotoCoreError, ClientError, S3UploadFailedError) as e:
+        raise RuntimeError(f"COS put_object failed: {type(e).__name__}: {e}")
+
+    try:
+        with track_stage("presign"):
+            url = s3.generate_presigned_url(
+                ClientMethod="get_object",
+                Params={"Bucket": bucket, "Key": object_key},
+                ExpiresIn=COS_PRESIGN_EXPIRES,
+            )
+        return url
+    except (BotoCoreError, ClientError) as e:
+        raise RuntimeError(f"COS presign failed: {type(e).__name__}: {e}")
+
+
+def make_upload_key(filename: Optional[str], content_type: str) -> str:
+    ext = os.path.splitext(filename or "")[1].lower() or (mimetypes.guess_extension(content_type) or "")
+    ext = re.sub(r"[^a-z0-9.]+", "", ext)
+    return f"{COS_UPLOAD_PREFIX}/{uuid.uuid4()}/{_safe_stem_from_filename(filename or 'image')}{ext}"
+
+
+def presign_input_upload(req: UploadPresignRequest) -> dict:
+    """
+    Presigned PUT URL or POST policy for one new object in COS_INPUT_BUCKET.
+    POST lets COS enforce MAX_UPLOAD_BYTES; PUT sizes are checked when the job reads the object.
+    """
+    s3 = get_s3_client()
+    object_key = make_upload_key(req.filename, req.content_type)
+    out = {
+        "bucket": COS_INPUT_BUCKET,
+        "object_key": object_key,
+        "expires_in": COS_PRESIGN_EXPIRES,
+        "max_bytes": MAX_UPLOAD_BYTES,
+    }
+
+    try:
+        with track_stage("presign"):
+            if req.method == "post":
+                post = s3.generate_presigned_post(
+                    Bucket=COS_INPUT_BUCKET,
+                    Key=object_key,
+                    Fields={"Content-Type": req.content_type},
+                    Conditions=[{"Content-Type": req.content_type}, ["content-length-range", 1, MAX_UPLOAD_BYTES]],
+                    ExpiresIn=COS_PRESIGN_EXPIRES,
+                )
+                out.update(method="POST", url=post["url"], fields=post["fields"])
+            else:
+                url = s3.generate_presigned_url(
+                    ClientMethod="put_object",
+                    Params={"Bucket": COS_INPUT_BUCKET, "Key": object_key, "ContentType": req.content_type},
+                    ExpiresIn=COS_PRESIGN_EXPIRES,
+                )
+                out.update(method="PUT", url=url, headers={"Content-Type": req.content_type})
+    except (BotoCoreError, ClientError) as e:
+        raise RuntimeError(f"COS presign failed: {type(e).__name__}: {e}")
+    return out
+
+
+def batch_excluded_prefixes() -> List[str]:
+    # Ad-hoc uploads land in the input bucket too: keep them out of batches, unless the batch targets them
+    upload_prefix = f"{COS_UPLOAD_PREFIX}/"
+    if not COS_UPLOAD_PREFIX or COS_INPUT_PREFIX.startswith(upload_prefix):
+        return []
+    return [upload_prefix]
+
+
+class ListingFilter:
+    """
+    Filters applied to listing metadata (no extra HEAD request per object).
+    Content type is guessed from the key suffix: list_objects_v2 does not return it.
+    """
+
+    def __init__(
+        self,
+        suffixes: Optional[List[str]] = None,
+        images_only: bool = False,
+        min_size: int = 0,
+        max_size: int = 0,
+        modified_after: Optional[datetime] = None,
+        modified_before: Optional[datetime] = None,
+        exclude_prefixes: Optional[List[str]] = None,
+    ) -> None:
+        self.suffixes = tuple(s.lower() for s in (suffixes or []) if s)
+        self.exclude_prefixes = tuple(p for p in (exclude_prefixes or []) if p)
+        self.images_only = images_only
+        self.min_size = min_size
+        self.max_size = max_size
+        # LastModified is timezone-aware: naive bounds are taken as UTC
+        self.modified_after = self._as_utc(modified_after)
+        self.modified_before = self._as_utc(modified_before)
+
+    @staticmethod
+    def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+        if value is not None and value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value
+
+    def matches(self, info: dict) -> bool:
+        key = info["key"]
+        if self.exclude_prefixes and key.startswith(self.exclude_prefixes):
+            return False
+        if self.suffixes and not key.lower().endswith(self.suffixes):
+            return False
+        if self.images_only and not (mimetypes.guess_type(key)[0] or "").startswith("image/"):
+            return False
+        size = info.get("size") or 0
+        if self.min_size and size < self.min_size:
+            return False
+        if self.max_size and size > self.max_size:
+            return False
+        modified = info.get("last_modified")
+        if modified is not None:
+            if self.modified_after and modified <= self.modified_after:
+                return False
+            if self.modified_before and modified >= self.modified_before:
+                return False
+        return True
+
+
+def _list_input_page(prefix: str, token: Optional[str]) -> tuple[List[dict], Optional[str]]:
+    """
+    One list_objects_v2 page: (infos, next continuation token or None).
+    """
+    if not COS_INPUT_BUCKET:
+        raise RuntimeError("Missing env var: COS_INPUT_BUCKET")
+
+    kwargs = {"Bucket": COS_INPUT_BUCKET}
+    if prefix:
+        kwargs["Prefix"] = prefix
+    if token:
+        kwargs["ContinuationToken"] = token
+
+    resp = get_s3_client().list_objects_v2(**kwargs)
+    infos: List[dict] = []
+    for obj in resp.get("Contents", []):
+        k = obj.get("Key")
+        if k and not k.endswith("/"):
+            infos.append(
+                {
+                    "key": k,
+                    "etag": obj.get("ETag", ""),
+                    "size": obj.get("Size", 0),
+                    "last_modified": obj.get("LastModified"),
+                }
+            )
+
+    next_token = resp.get("NextContinuationToken") if resp.get("IsTruncated") else None
+    return infos, next_token
+
+
+async def aiter_input_object_infos(
+    prefix: str = "", listing_filter: Optional[ListingFilter] = None
+) -> AsyncIterator[dict]:
+    """
+    Listing with the metadata list_objects_v2 already returns: key, etag, size, last_modified.
+    Page by page: the next page is fetched in the pool while the current one is being consumed,
+    so processing starts after the first page instead of materializing the whole bucket.
+    """
+    infos, token = await run_blocking(_list_input_page, prefix, None)
+    while True:
+        next_page = asyncio.ensure_future(run_blocking(_list_input_page, prefix, token)) if token else None
+        try:
+            for info in infos:
+                if listing_filter is None or listing_filter.matches(info):
+                    yield info
+        except BaseException:
+            # Consumer stopped early (or failed): drop the prefetch
+            if next_page is not None:
+                next_page.cancel()
+            raise
+        if next_page is None:
+            return
+        infos, token = await next_page
+
+
+def download_object_to_spool(bucket: str, key: str, max_bytes: int = 0) -> tempfile.SpooledTemporaryFile:
+    """
+    Stream an object into a spooled buffer (rewound, caller closes it).
+    The body is copied chunk by chunk, so objects above COS_SPOOL_MAX_BYTES end up on disk, not in RAM.
+    max_bytes > 0: refuse larger objects before reading the body.
+    """
+    s3 = get_s3_client()
+    with track_stage("cos_get"):
+        resp = s3.get_object(Bucket=bucket, Key=key)
+        size = resp.get("ContentLength")
+        if max_bytes and size is not None and size > max_bytes:
+            resp["Body"].close()
+            raise ValueError(f"Objet trop grand ({size} > {max_bytes} octets) : {key}")
+        spool = tempfile.SpooledTemporaryFile(max_size=max(COS_SPOOL_MAX_BYTES, 0))
+        try:
+            with resp["Body"] as body:
+                shutil.copyfileobj(body, spool, length=1024 * 1024)
+            spool.seek(0)
+        except BaseException:
+            spool.close()
+            raise
+    return spool
+
+
+def get_object_bytes(bucket: str, key: str, max_bytes: int = 0) -> bytes:
+    with download_object_to_spool(bucket, key, max_bytes=max_bytes) as spool:
+        return spool.read()
+
+
+def upload_fileobj(bucket: str, key: str, fileobj, content_type: str, metadata: Optional[dict] = None) -> None:
+    """
+    Single PUT below COS_MULTIPART_THRESHOLD_BYTES, concurrent multipart upload above it.
+    """
+    extra_args = {"ContentType": content_type}
+    if metadata:
+        extra_args["Metadata"] = metadata
+    with track_stage("cos_put"):
+        get_s3_client().upload_fileobj(fileobj, bucket, key, ExtraArgs=extra_args, Config=COS_TRANSFER_CONFIG)
+
+
+def put_object_bytes(bucket: str, key: str, data: bytes, content_type: str, metadata: Optional[dict] = None) -> None:
+    # BytesIO shares the bytes buffer: parts are sliced from it, the result is not copied up front
+    upload_fileobj(bucket, key, io.BytesIO(data), content_type, metadata=metadata)
+
+
+# ==================================================
+# Utilities
+# ==================================================
+def _validate_image_base64_payload(b64_str: str) -> None:
+    if not b64_str or not b64_str.strip():
+        raise ValueError("image_base64 vide")
+    if len(b64_str) > MAX_IMAGE_BASE64_CHARS:
+        raise ValueError(f"image_base64 trop grand (>{MAX_IMAGE_BASE64_CHARS} chars)")
+
+    # Quick check for "data:" prefix (common workshop issue)
+    if b64_str.strip().lower().startswith("data:"):
+        raise ValueError("image_base64 contient un préfixe data:... ; envoyer uniquement la partie base64")
+
+
+def _read_file_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def load_request_image(req: SingleImageRequest) -> bytes:
+    """
+    Image bytes of a single-image job: uploaded temp file, COS input object, or validated + decoded base64.
+    """
+    check_deadline("load_input")
+    if isinstance(req, UploadImageRequest):
+        return await run_blocking(_read_file_bytes, req.upload_path)
+    if isinstance(req, CosImageRequest):
+        return await run_blocking(get_object_bytes, COS_INPUT_BUCKET, req.object_key, MAX_UPLOAD_BYTES)
+
+    # Validate size/prefix
+    _validate_image_base64_payload(req.image_base64)
+
+    try:
+        with track_stage("b64_decode"):
+            image_bytes = await run_blocking(base64.b64decode, req.image_base64, validate=True)
+    except Exception:
+        raise ValueError("image_base64 invalide (base64 attendu, sans préfixe data:...)")
+    # The request object lives as long as the job: drop its copy of the image as text
+    req.image_base64 = ""
+    return image_bytes
+
+
+def discard_request_upload(req: SingleImageRequest) -> None:
+    # Removed once the job is done (not on read), so a queue-mode retry still finds the file
+    if isinstance(req, UploadImageRequest):
+        try:
+            os.remove(req.upload_path)
+        except FileNotFoundError:
+            pass
+
+
+def _looks_like_openai_billing_limit(msg: str) -> bool:
+    m = (msg or "")
+    return ("billing_hard_limit_reached" in m) or ("Billing hard limit has been reached" in m)
+
+
+def _fallback_reason(e: Exception) -> Optional[str]:
+    """
+    Why the local fallback replaces OpenAI for this error, or None to report the error as is.
+    """
+    if _looks_like_openai_billing_limit(f"{type(e).__name__}: {e}"):
+        return "OpenAI billing limit"
+    if isinstance(e, OpenAICircuitOpenError) and OPENAI_BREAKER_POLICY == "fallback":
+        return "OpenAI circuit open"
+    if isinstance(e, DeadlineExceededError) and (time_left() or 0.0) > 0:
+        # A local render takes well under a second: still worth delivering instead of nothing
+        DEADLINE_ACTIONS_TOTAL.labels(action="fallback", stage="openai_edit").inc()
+        return "OpenAI too slow for the job deadline"
+    return None
+
+
+# ==================================================
+# Background job A: single image -> COS URL
+# ==================================================
+async def process_and_callback_url(job_id: str, req: SingleImageRequest, callback_url: str) -> None:
+    await mark_job_running(job_id)
+    try:
+        image_bytes = await load_request_image(req)
+
+        try:
+            result_bytes, result_mime, output_ext = await edit_image_cached(image_bytes, req.prompt)
+        except Exception as e:
+            # Workshop continuity: optional fallback for single endpoints too
+            if ENABLE_FALLBACK_SINGLE and _fallback_reason(e):
+                result_bytes, result_mime, output_ext = await local_fallback_process(image_bytes)
+            else:
+                raise
+        del image_bytes
+
+        check_deadline("cos_put")
+        object_key = make_object_key(job_id, req.filename, output_ext=output_ext)
+        presigned_url = await within_deadline(
+            "cos_put",
+            run_blocking(upload_and_presign, result_bytes, object_key, result_mime, bucket=COS_OUTPUT_BUCKET),
+        )
+
+        payload = {
+            "status": "completed",
+            "job_id": job_id,
+            "filename": req.filename,
+            "object_key": object_key,
+            "result_url": presigned_url,
+            "expires_in": COS_PRESIGN_EXPIRES,
+        }
+
+    except Exception as e:
+        payload = {
+            "status": "failed",
+            "job_id": job_id,
+            "filename": req.filename,
+            "error": f"{type(e).__name__}: {e}",
+        }
+
+    discard_request_upload(req)
+    await deliver_job_result(job_id, callback_url, payload, label="SINGLE URL")
+
+
+# ==================================================
+# Size-aware result delivery (base64 endpoint)
+# ==================================================
+_REENCODE_FORMATS = {"WEBP": ("webp", "image/webp"), "JPEG": ("jpeg", "image/jpeg")}
+
+
+class B64DeliveryPolicy:
+    """
+    Keeps /process-image-async-b64 callbacks small. A result over `budget` bytes is re-encoded
+    (JPEG or WebP, down a quality ladder until it fits); one still over `reference_min` bytes is
+    uploaded to COS and delivered as a presigned URL, like /process-image-async.
+    """
+
+    def __init__(self, budget: int, fmt: str, qualities: List[int], reference_min: int) -> None:
+        self.budget = max(budget, 0)
+        self.fmt = "WEBP" if fmt == "webp" else "JPEG"
+        self.qualities = [min(max(q, 1), 95) for q in qualities] or [80]
+        self.reference_min = max(reference_min, 0)
+        self._lock = threading.Lock()
+        self.inline = 0
+        self.reference = 0
+        self.reencoded = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def reencode(self, data: bytes, mime: str, ext: str) -> tuple[bytes, str, str]:
+        """
+        Smallest encoding that fits the budget (or the smallest tried). Returns the input unchanged
+        if nothing beats it or it cannot be decoded.
+        """
+        try:
+            img = Image.open(io.BytesIO(data))
+            img.load()
+        except Exception:
+            return data, mime, ext
+
+        fmt = self.fmt
+        has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+        if fmt == "JPEG" and has_alpha:
+            fmt = "WEBP"  # JPEG would drop the transparency
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if has_alpha else "RGB")
+
+        best = data
+        for quality in self.qualities:
+            buf = io.BytesIO()
+            if fmt == "JPEG":
+                img.save(buf, format="JPEG", quality=quality)
+            else:
+                img.save(buf, format="WEBP", quality=quality, method=2)
+            if buf.tell() < len(best):
+                best = buf.getvalue()
+            if len(best) <= self.budget:
+                break
+
+        if best is data:
+            return data, mime, ext
+        ext, out_mime = _REENCODE_FORMATS[fmt]
+        return best, out_mime, ext
+
+    def _record(self, size_in: int, size_out: int, by_reference: bool, reencoded: bool) -> None:
+        with self._lock:
+            self.bytes_in += size_in
+            self.bytes_out += size_out
+            if by_reference:
+                self.reference += 1
+            else:
+                self.inline += 1
+            if reencoded:
+                self.reencoded += 1
+
+    async def build_payload(self, job_id: str, filename: Optional[str], data: bytes, mime: str, ext: str) -> dict:
+        """
+        Result fields of a completed callback: inline base64, or a presigned URL above reference_min.
+        """
+        size_in = len(data)
+        reencoded = False
+        if self.budget and len(data) > self.budget:
+            with track_stage("reencode"):
+                data, mime, ext = await run_blocking(self.reencode, data, mime, ext)
+            reencoded = len(data) < size_in
+
+        if self.reference_min and len(data) > self.reference_min:
+            object_key = make_object_key(job_id, filename, output_ext=ext)
+            try:
+                _require_cos_config()
+                url = await within_deadline(
+                    "cos_put", run_blocking(upload_and_presign, data, object_key, mime, bucket=COS_OUTPUT_BUCKET)
+                )
+            except Exception as e:
+                # Still deliverable inline: a large callback beats a failed job
+                print(f"b64 delivery: by-reference upload failed ({type(e).__name__}: {e}); sending inline")
+            else:
+                self._record(size_in, len(data), by_reference=True, reencoded=reencoded)
+                return {
+                    "delivery": "reference",
+                    "object_key": object_key,
+                    "result_url": url,
+                    "expires_in": COS_PRESIGN_EXPIRES,
+                    "result_mime_type": mime,
+                    "result_size_bytes": len(data),
+                }
+
+        result_b64 = await run_blocking(lambda: base64.b64encode(data).decode("ascii"))
+        self._record(size_in, len(data), by_reference=False, reencoded=reencoded)
+        return {
+            "delivery": "inline",
+            "result_image_base64": result_b64,
+            "result_mime_type": mime,
+            "result_size_bytes": len(data),
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "budget_bytes": self.budget,
+                "reencode_format": self.fmt.lower(),
+                "reference_min_bytes": self.reference_min,
+                "inline": self.inline,
+                "reference": self.reference,
+                "reencoded": self.reencoded,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
+
+
+b64_delivery = B64DeliveryPolicy(
+    B64_RESULT_BUDGET_BYTES,
+    B64_REENCODE_FORMAT,
+    [int(q) for q in B64_REENCODE_QUALITIES.split(",") if q.strip().isdigit()],
+    B64_REFERENCE_MIN_BYTES,
+)
+
+
+# ==================================================
+# Background job B: single image -> Base64
+# ==================================================
+async def process_and_callback_b64(job_id: str, req: SingleImageRequest, callback_url: str) -> None:
+    await mark_job_running(job_id)
+    try:
+        image_bytes = await load_request_image(req)
+
+        try:
+            result_bytes, result_mime, output_ext = await edit_image_cached(image_bytes, req.prompt)
+        except Exception as e:
+            if ENABLE_FALLBACK_SINGLE and _fallback_reason(e):
+                result_bytes, result_mime, output_ext = await local_fallback_process(image_bytes)
+            else:
+                raise
+        del image_bytes
+
+        payload = {
+            "status": "completed",
+            "job_id": job_id,
+            "filename": req.filename,
+            **await b64_delivery.build_payload(job_id, req.filename, result_bytes, result_mime, output_ext),
+        }
+
+    except Exception as e:
+        payload = {
+            "status": "failed",
+            "job_id": job_id,
+            "filename": req.filename,
+            "error": f"{type(e).__name__}: {e}",
+        }
 
-            object_key = make_object_key(job_id, req.filename, output_ext=output_ext)
-            presigned_url = upload_and_presign(result_bytes, object_key, result_mime, bucket=COS_OUTPUT_BUCKET)
+    discard_request_upload(req)
+    await deliver_job_result(job_id, callback_url, payload, label="SINGLE B64")
 
-            payload = {
-                "status": "completed",
-                "job_id": job_id,
-                "filename": req.filename,
-                "object_key": object_key,
-                "result_url": presigned_url,
-                "expires_in": COS_PRESIGN_EXPIRES,
-            }
-            await post_callback(callback_url, payload)
 
-        except Exception as e:
-            payload = {
-                "status": "failed",
-                "job_id": job_id,
-                "filename": req.filename,
-                "error": f"{type(e).__name__}: {e}",
-            }
+# ==================================================
+# Incremental batch manifest (input key + ETag + prompt hash -> output key)
+# ==================================================
+def batch_prompt_hash(prompt: str) -> str:
+    # Everything that changes the output for a given input
+    parts = (prompt, OPENAI_IMAGE_MODEL, OPENAI_IMAGE_QUALITY, OPENAI_IMAGE_OUTPUT_FORMAT, preprocess_signature())
+    return hashlib.sha256("\0".join(p or "" for p in parts).encode("utf-8")).hexdigest()
+
+
+def batch_variants_hash(variants: List[dict]) -> str:
+    # A plain batch (one prompt, no output format asked for) keeps the hash manifests already hold
+    if len(variants) == 1 and variants[0]["output_format"] is None:
+        return batch_prompt_hash(variants[0]["prompt"])
+    parts = [f"{v['name']}:{v['output_format'] or ''}:{batch_prompt_hash(v['prompt'])}" for v in variants]
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+class BatchManifest:
+    """
+    One JSON object per (input bucket, input prefix) in COS_OUTPUT_BUCKET.
+    Entries are added as outputs land and flushed periodically, so a crashed or
+    partly failed run resumes from the last flush instead of starting over.
+    """
+
+    def __init__(self, input_bucket: str, input_prefix: str) -> None:
+        self.input_bucket = input_bucket
+        self.input_prefix = input_prefix
+        scope = hashlib.sha256(f"{input_bucket}/{input_prefix}".encode("utf-8")).hexdigest()[:16]
+        self.object_key = f"{COS_OUTPUT_PREFIX}/_manifests/{scope}.json"
+        self.entries: dict = {}
+        self._dirty = 0
+        self._flush_lock = asyncio.Lock()
+
+    def load(self) -> None:
+        try:
+            resp = get_s3_client().get_object(Bucket=COS_OUTPUT_BUCKET, Key=self.object_key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return
+            raise
+        data = json.loads(resp["Body"].read())
+        self.entries = data.get("entries", {})
+
+    async def flush(self) -> None:
+        # Snapshot on the event loop (entries keep changing), write in the pool; one flush at a time
+        async with self._flush_lock:
+            body = json.dumps(
+                {
+                    "input_bucket": self.input_bucket,
+                    "input_prefix": self.input_prefix,
+                    "updated_at": _utc_now_iso(),
+                    "entries": self.entries,
+                }
+            ).encode("utf-8")
+            flushed, self._dirty = self._dirty, 0
             try:
-                await post_callback(callback_url, payload)
-            except Exception as cb_err:
-                print("!!! CALLBACK FAILED (SINGLE URL) !!!", repr(cb_err))
+                await run_blocking(put_object_bytes, COS_OUTPUT_BUCKET, self.object_key, body, "application/json")
+            except BaseException:
+                self._dirty += flushed  # still pending: the next flush writes them
+                raise
+
+    def is_current(self, key: str, etag: str, prompt_hash: str) -> bool:
+        entry = self.entries.get(key)
+        return bool(entry) and entry.get("etag") == etag and entry.get("prompt_hash") == prompt_hash
+
+    def record(self, key: str, etag: str, prompt_hash: str, output_keys: List[str], job_id: str) -> bool:
+        """
+        Returns True when enough entries are pending to warrant a flush.
+        """
+        self.entries[key] = {
+            "etag": etag,
+            "prompt_hash": prompt_hash,
+            "output_key": output_keys[0],
+            "job_id": job_id,
+            "updated_at": _utc_now_iso(),
+        }
+        if len(output_keys) > 1:
+            self.entries[key]["output_keys"] = output_keys
+        self._dirty += 1
+        return self._dirty >= max(BATCH_MANIFEST_FLUSH_EVERY, 1)
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty > 0
 
 
 # ==================================================
-# Background job B: single image -> Base64
+# Batch engine: download -> edit -> upload pipeline
+# (stages joined by bounded queues, one concurrency setting per stage)
 # ==================================================
-async def process_and_callback_b64(job_id: str, req: ProcessImageRequest, callback_url: str) -> None:
-    async with _job_semaphore:
-        try:
-            _validate_image_base64_payload(req.image_base64)
+_STAGE_DONE = object()
 
-            try:
-                image_bytes = base64.b64decode(req.image_base64, validate=True)
-            except Exception:
-                payload = {
-                    "status": "failed",
-                    "job_id": job_id,
-                    "filename": req.filename,
-                    "error": "ValueError: image_base64 invalide (base64 attendu, sans préfixe data:...)",
-                }
-                await post_callback(callback_url, payload)
-                return
 
-            try:
-                result_bytes, result_mime, _ext = edit_image_with_openai(image_bytes, req.prompt)
-            except Exception as e:
-                msg = f"{type(e).__name__}: {e}"
-                if ENABLE_FALLBACK_SINGLE and _looks_like_openai_billing_limit(msg):
-                    result_bytes, result_mime, _ext = local_fallback_process(image_bytes)
-                else:
-                    raise
+def batch_variants(req: BatchProcessRequest) -> List[dict]:
+    """
+    Prompt x output format combinations of a batch: [{name, prompt, prompt_index, output_format}].
+    Names only carry what varies ("p2-webp", "p2", "webp"); a plain batch has one variant named ""
+    and keeps its outputs directly under COS_OUTPUT_PREFIX/<job_id>/.
+    output_format None: whatever the edit returns (OPENAI_IMAGE_OUTPUT_FORMAT, PNG for the fallback).
+    """
+    prompts = req.prompts if req.prompts else [req.prompt or ""]
+    if any(not p or not p.strip() for p in prompts):
+        raise ValueError("prompt vide")
+    formats = list(dict.fromkeys(req.output_formats or [None]))
+    if len(prompts) * len(formats) > max(BATCH_MAX_VARIANTS, 1):
+        raise ValueError(f"trop de variantes ({len(prompts)} prompts x {len(formats)} formats > {BATCH_MAX_VARIANTS})")
 
-            result_b64 = base64.b64encode(result_bytes).decode("ascii")
+    variants: List[dict] = []
+    for i, prompt in enumerate(prompts):
+        for fmt in formats:
+            parts = ([f"p{i + 1}"] if len(prompts) > 1 else []) + ([fmt] if len(formats) > 1 else [])
+            variants.append({"name": "-".join(parts), "prompt": prompt, "prompt_index": i, "output_format": fmt})
+    return variants
 
-            payload = {
-                "status": "completed",
-                "job_id": job_id,
-                "filename": req.filename,
-                "result_image_base64": result_b64,
-                "result_mime_type": result_mime,
-            }
-            await post_callback(callback_url, payload)
 
-        except Exception as e:
-            payload = {
-                "status": "failed",
-                "job_id": job_id,
-                "filename": req.filename,
-                "error": f"{type(e).__name__}: {e}",
-            }
+def transcode_variant(data: bytes, mime: str, ext: str, fmt: str) -> tuple[bytes, str, str]:
+    """
+    Edit result in a variant's output format: re-encoded locally instead of another model call.
+    """
+    if ext == fmt:
+        return data, mime, ext
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+    buf = io.BytesIO()
+    if fmt == "jpeg":
+        img.convert("RGB").save(buf, format="JPEG", quality=BATCH_VARIANT_QUALITY)
+    elif fmt == "webp":
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if has_alpha else "RGB")
+        img.save(buf, format="WEBP", quality=BATCH_VARIANT_QUALITY, method=2)
+    else:
+        img.save(buf, format="PNG")
+    return buf.getvalue(), _mime_from_output_format(fmt), fmt
+
+
+class BatchCounters:
+    """
+    Per-key accounting shared by the pipeline stages (all updates happen on the event loop).
+    Fan-out batches also count per variant; an input is processed once all its variants are.
+    """
+
+    def __init__(self, job_id: str, variant_names: Optional[List[str]] = None) -> None:
+        self.job_id = job_id
+        self.total_files = 0
+        self.processed = 0
+        self.failed = 0
+        self.fallback_local = 0
+        self.errors: List[str] = []
+        self.variants = {name: {"processed": 0, "failed": 0, "fallback_local": 0} for name in variant_names or [] if name}
+        self._published_at = 0.0
+        self._publishing: Optional[asyncio.Future] = None
+
+    def snapshot(self) -> dict:
+        snap = {
+            "total_files": self.total_files,
+            "processed": self.processed,
+            "failed": self.failed,
+            "fallback_local": self.fallback_local,
+        }
+        if self.variants:
+            snap["variants"] = {name: dict(c) for name, c in self.variants.items()}
+        return snap
+
+    def publish(self) -> None:
+        # Throttled: a streamed listing of 100k keys must not mean 100k store writes.
+        # Written from the thread pool, one write at a time (a later snapshot never lands first)
+        now = time.monotonic()
+        if now - self._published_at < JOB_PROGRESS_INTERVAL_SECONDS:
+            return
+        if self._publishing is not None and not self._publishing.done():
+            return
+        self._published_at = now
+        self._publishing = asyncio.ensure_future(run_blocking(job_store.update, self.job_id, progress=self.snapshot()))
+        self._publishing.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    async def flush(self) -> None:
+        # Final progress, after any write still in flight
+        if self._publishing is not None:
+            await asyncio.gather(self._publishing, return_exceptions=True)
+        await run_blocking(job_store.update, self.job_id, progress=self.snapshot())
+
+    def succeed(self) -> None:
+        self.processed += 1
+        self.publish()
+
+    def fail(self, message: Optional[str] = None) -> None:
+        self.failed += 1
+        if message:
+            self.errors.append(message)
+        self.publish()
+
+    def count_variant(self, name: str, outcome: str) -> None:
+        # outcome: processed | failed | fallback_local
+        if name in self.variants:
+            self.variants[name][outcome] += 1
+
+
+async def _run_stage(
+    name: str,
+    in_q: asyncio.Queue,
+    out_q: Optional[asyncio.Queue],
+    workers: int,
+    downstream_workers: int,
+    handler: Callable,
+    counters: BatchCounters,
+) -> None:
+    async def worker() -> None:
+        while True:
+            item = await in_q.get()
+            if item is _STAGE_DONE:
+                return
+            try:
+                result = await handler(item)
+            except Exception as e:
+                # Handlers do their own accounting; this only guards against pipeline deadlocks
+                counters.fail(f"{item[0]}: {name} stage error: {type(e).__name__}: {e}")
+                continue
+            if result is not None and out_q is not None:
+                await out_q.put(result)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+
+    # Tell every downstream worker that this stage is drained
+    if out_q is not None:
+        for _ in range(downstream_workers):
+            await out_q.put(_STAGE_DONE)
+
+
+async def run_batch_pipeline(
+    job_id: str,
+    keys: AsyncIterable[tuple[str, int]],
+    variants: List[dict],
+    counters: BatchCounters,
+    on_uploaded: Optional[Callable[[str, List[str]], Awaitable[None]]] = None,
+) -> None:
+    download_workers = max(BATCH_DOWNLOAD_CONCURRENCY, 1)
+    edit_workers = max(BATCH_EDIT_CONCURRENCY, 1)
+    upload_workers = max(BATCH_UPLOAD_CONCURRENCY, 1)
+
+    key_q: asyncio.Queue = asyncio.Queue(maxsize=BATCH_QUEUE_SIZE)
+    edit_q: asyncio.Queue = asyncio.Queue(maxsize=BATCH_QUEUE_SIZE)
+    upload_q: asyncio.Queue = asyncio.Queue(maxsize=BATCH_QUEUE_SIZE)
+
+    # Inputs dropped once the job deadline has passed: reported once, not one error per key
+    late = 0
+
+    def skip_late() -> bool:
+        nonlocal late
+        left = time_left()
+        if left is None or left > 0:
+            return False
+        late += 1
+        counters.fail()
+        return True
+
+    async def feed_keys() -> None:
+        # Bounded queue: listing pauses while the stages catch up
+        try:
+            async for k, size in keys:
+                if skip_late():
+                    # No more listing calls: the remaining keys could only fail one by one
+                    DEADLINE_ACTIONS_TOTAL.labels(action="aborted", stage="cos_list").inc()
+                    aclose = getattr(keys, "aclose", None)
+                    if aclose is not None:
+                        await aclose()
+                    break
+                await key_q.put((k, size))
+        finally:
+            # Drain the stages even if listing fails mid-way
+            for _ in range(download_workers):
+                await key_q.put(_STAGE_DONE)
+
+    # 1) Download input (spooled: items waiting in edit_q hold a buffer or temp file, not a bytes copy).
+    #    Memory is reserved from the listed size before the download: input bytes + preprocessed copy +
+    #    one result per variant, held until the results are uploaded
+    async def download(item: tuple) -> Optional[tuple]:
+        k, size = item
+        if skip_late():
+            return None
+        reserved = await memory_budget.reserve(2 * size + result_estimate(size) * len(variants), "batch")
+        try:
+            check_deadline("cos_get")
+            spool = await run_blocking(download_object_to_spool, COS_INPUT_BUCKET, k)
+        except BaseException as e:
+            memory_budget.release(reserved, "batch")
+            if not isinstance(e, Exception):
+                raise
+            counters.fail(f"{k}: {type(e).__name__}: {e}")
+            return None
+        return k, spool, reserved
+
+    prompts = list(dict.fromkeys(v["prompt"] for v in variants))
+
+    def label(k: str, names: List[str]) -> str:
+        return f"{k} [{', '.join(names)}]" if len(variants) > 1 else k
+
+    # 2) Try OpenAI, fallback local on billing hard limit, open circuit (OPENAI_BREAKER_POLICY=fallback)
+    #    or when an edit no longer fits in the job deadline.
+    #    Fan-out: one read and one preprocess per input, the prompts' edits run concurrently on that buffer.
+    async def edit_one(k: str, spool) -> List[tuple]:
+        with spool:
+            img_bytes = await run_blocking(spool.read)
+
+        image_file = None
+        if len(prompts) > 1:
             try:
-                await post_callback(callback_url, payload)
-            except Exception as cb_err:
-                print("!!! CALLBACK FAILED (SINGLE B64) !!!", repr(cb_err))
+                image_file = await run_blocking(_prepare_openai_edit, img_bytes, prompts[0])
+            except Exception as e:
+                image_file = e
+        if isinstance(image_file, Exception):
+            results = [image_file] * len(prompts)
+        else:
+            results = await asyncio.gather(
+                *(edit_image_cached(img_bytes, p, image_file) for p in prompts), return_exceptions=True
+            )
+        for r in results:
+            if isinstance(r, BaseException) and not isinstance(r, Exception):
+                raise r
+
+        # The fallback image does not depend on the prompt: rendered at most once per input
+        fallback: Optional[asyncio.Task] = None
+        fell_back = False
+        outputs: List[tuple] = []
+        for prompt, result in zip(prompts, results):
+            names = [v["name"] for v in variants if v["prompt"] == prompt]
+            if isinstance(result, Exception):
+                reason = _fallback_reason(result)
+                if reason is None:
+                    counters.errors.append(f"{label(k, names)}: {type(result).__name__}: {result}")
+                    for name in names:
+                        counters.count_variant(name, "failed")
+                    continue
+                if fallback is None:
+                    fallback = asyncio.ensure_future(local_fallback_process(img_bytes))
+                try:
+                    result = await asyncio.shield(fallback)
+                except Exception as e2:
+                    counters.errors.append(f"{label(k, names)}: fallback local failed: {type(e2).__name__}: {e2}")
+                    for name in names:
+                        counters.count_variant(name, "failed")
+                    continue
+                if not fell_back:
+                    # Top-level count is per image; the variant counters below are per prompt
+                    counters.fallback_local += 1
+                    fell_back = True
+                counters.errors.append(f"{label(k, names)}: {reason} -> fallback local applied")
+                for name in names:
+                    counters.count_variant(name, "fallback_local")
+
+            out_bytes, out_mime, out_ext = result
+            for v in variants:
+                if v["prompt"] != prompt:
+                    continue
+                if v["output_format"] in (None, out_ext):
+                    outputs.append((v["name"], out_bytes, out_mime, out_ext))
+                    continue
+                try:
+                    with track_stage("reencode"):
+                        encoded = await run_blocking(transcode_variant, out_bytes, out_mime, out_ext, v["output_format"])
+                except Exception as e3:
+                    counters.errors.append(f"{label(k, [v['name']])}: reencode failed: {type(e3).__name__}: {e3}")
+                    counters.count_variant(v["name"], "failed")
+                    continue
+                outputs.append((v["name"], *encoded))
+        return outputs
+
+    async def edit(item: tuple) -> Optional[tuple]:
+        k, spool, reserved = item
+        try:
+            outputs = await edit_one(k, spool)
+        except BaseException:
+            memory_budget.release(reserved, "batch")
+            raise
+        if len(outputs) < len(variants):
+            # Single variant: edit_one already logged why; the input counts as failed either way
+            counters.fail()
+            if not outputs:
+                memory_budget.release(reserved, "batch")
+                return None
+            # Partial fan-out: upload what succeeded, without counting the input twice
+            return k, outputs, reserved, False
+        return k, outputs, reserved, True
+
+    # 3) Upload results (one object per variant)
+    async def upload(item: tuple) -> None:
+        k, outputs, reserved, complete = item
+        try:
+            out_keys = [make_batch_output_key(job_id, k, ext, name) for name, _data, _mime, ext in outputs]
+            results = await asyncio.gather(
+                *(
+                    within_deadline("cos_put", run_blocking(put_object_bytes, COS_OUTPUT_BUCKET, out_key, data, mime))
+                    for out_key, (_name, data, mime, _ext) in zip(out_keys, outputs)
+                ),
+                return_exceptions=True,
+            )
+        finally:
+            memory_budget.release(reserved, "batch")
+
+        failed = [(name, r) for (name, *_rest), r in zip(outputs, results) if isinstance(r, BaseException)]
+        for name, *_rest in outputs:
+            counters.count_variant(name, "failed" if any(name == f for f, _r in failed) else "processed")
+        if not complete:
+            for name, e3 in failed:
+                counters.errors.append(f"{label(k, [name])}: upload failed: {type(e3).__name__}: {e3}")
+            return
+        if failed:
+            e3 = failed[0][1]
+            counters.fail(f"{label(k, [n for n, _e in failed])}: upload failed: {type(e3).__name__}: {e3}")
+            return
+        if on_uploaded is not None:
+            await on_uploaded(k, out_keys)
+        counters.succeed()
+
+    results = await asyncio.gather(
+        feed_keys(),
+        _run_stage("download", key_q, edit_q, download_workers, edit_workers, download, counters),
+        _run_stage("edit", edit_q, upload_q, edit_workers, upload_workers, edit, counters),
+        _run_stage("upload", upload_q, None, upload_workers, 0, upload, counters),
+        return_exceptions=True,
+    )
+    if late:
+        # First, so the callback's truncated errors[] still shows it
+        counters.errors.insert(0, f"délai du lot dépassé : {late} image(s) listée(s) non traitée(s), listing interrompu")
+    for r in results:
+        if isinstance(r, BaseException):
+            raise r
 
 
 # ==================================================
@@ -510,93 +3575,485 @@ async def process_and_callback_b64(job_id: str, req: ProcessImageRequest, callba
 # (one callback only + metrics + fallback local on billing hard limit)
 # ==================================================
 async def batch_process_and_callback(job_id: str, req: BatchProcessRequest, callback_url: str) -> None:
-    async with _job_semaphore:
-        start = time.perf_counter()
+    await mark_job_running(job_id)
+    start = time.perf_counter()
+
+    variants: List[dict] = []
+    counters = BatchCounters(job_id)
+    skipped = 0
+    manifest: Optional[BatchManifest] = None
+
+    status = "failed"
+    error_message: Optional[str] = None
+
+    try:
+        if not COS_INPUT_BUCKET:
+            raise RuntimeError("Missing env var: COS_INPUT_BUCKET")
+        variants = batch_variants(req)
+        counters = BatchCounters(job_id, [v["name"] for v in variants])
+
+        listing_filter = ListingFilter(
+            suffixes=BATCH_INCLUDE_SUFFIXES,
+            images_only=BATCH_IMAGES_ONLY,
+            min_size=BATCH_MIN_SIZE_BYTES,
+            max_size=BATCH_MAX_SIZE_BYTES,
+            modified_after=req.modified_after,
+            modified_before=req.modified_before,
+            exclude_prefixes=batch_excluded_prefixes(),
+        )
+
+        on_uploaded: Optional[Callable[[str, List[str]], Awaitable[None]]] = None
+        etags: dict = {}
+        prompt_hash = batch_variants_hash(variants)
+        if req.incremental:
+            manifest = BatchManifest(COS_INPUT_BUCKET, COS_INPUT_PREFIX)
+            await run_blocking(manifest.load)
 
-        processed = 0
-        failed = 0
-        total_files = 0
-        fallback_local = 0
-        errors: List[str] = []
+            async def record_output(k: str, out_keys: List[str]) -> None:
+                if manifest.record(k, etags.pop(k), prompt_hash, out_keys, job_id):
+                    try:
+                        await manifest.flush()
+                    except Exception as e:
+                        # The outputs are uploaded: not an item failure. Entries stay pending for the final flush
+                        print(f"[BATCH] manifest flush failed (retried at the end): {type(e).__name__}: {e}")
+
+            on_uploaded = record_output
+
+        async def pending_keys() -> AsyncIterator[tuple[str, int]]:
+            nonlocal skipped
+            async for info in aiter_input_object_infos(COS_INPUT_PREFIX, listing_filter):
+                counters.total_files += 1
+                counters.publish()
+                if manifest is not None:
+                    # Skip inputs whose ETag and prompt hash match an output already produced
+                    if manifest.is_current(info["key"], info["etag"], prompt_hash):
+                        skipped += 1
+                        continue
+                    etags[info["key"]] = info["etag"]
+                yield info["key"], info["size"]
+
+        # Processing starts with the first listed page; later pages are listed meanwhile
+        await run_batch_pipeline(job_id, pending_keys(), variants, counters, on_uploaded=on_uploaded)
+        status = "completed" if counters.failed == 0 else "completed_with_errors"
 
+    except Exception as e:
         status = "failed"
-        error_message: Optional[str] = None
+        error_message = f"{type(e).__name__}: {e}"
 
+    if manifest is not None and manifest.dirty:
         try:
-            if not COS_INPUT_BUCKET:
-                raise RuntimeError("Missing env var: COS_INPUT_BUCKET")
-            if not req.prompt or not req.prompt.strip():
-                raise ValueError("prompt vide")
+            await manifest.flush()
+        except Exception as e:
+            counters.errors.append(f"manifest flush failed: {type(e).__name__}: {e}")
 
-            keys = list_input_objects(prefix=COS_INPUT_PREFIX)
-            total_files = len(keys)
+    # Last progress write lands before the final state, never after it
+    try:
+        await counters.flush()
+    except Exception as e:
+        print(f"[BATCH] progress update failed: {type(e).__name__}: {e}")
+
+    duration_seconds = round(time.perf_counter() - start, 3)
+
+    payload = {
+        "status": status,
+        "job_id": job_id,
+        "total_files": counters.total_files,
+        "processed": counters.processed,
+        "failed": counters.failed,
+        "fallback_local": counters.fallback_local,
+        "duration_seconds": duration_seconds,
+        "total_files_processed": counters.processed,
+        "output_bucket": COS_OUTPUT_BUCKET,
+        "output_prefix": f"{COS_OUTPUT_PREFIX}/{job_id}/",
+        "errors": counters.errors[:20],
+    }
+    if req.incremental:
+        payload["skipped"] = skipped
+    if len(variants) > 1:
+        payload["variants"] = [
+            {
+                "name": v["name"],
+                "prompt": v["prompt"],
+                "output_format": v["output_format"],
+                "output_prefix": f"{COS_OUTPUT_PREFIX}/{job_id}/{v['name']}/",
+                **counters.variants[v["name"]],
+            }
+            for v in variants
+        ]
+    if error_message:
+        payload["error"] = error_message
 
-            if total_files == 0:
-                status = "completed"
-            else:
-                for k in keys:
-                    img_bytes = b""
-                    try:
-                        img_bytes = get_object_bytes(COS_INPUT_BUCKET, k)
+    await deliver_job_result(job_id, callback_url, payload, label="BATCH")
 
-                        # 1) Try OpenAI
-                        out_bytes, out_mime, out_ext = edit_image_with_openai(img_bytes, req.prompt)
 
-                    except Exception as e:
-                        msg = f"{type(e).__name__}: {e}"
-
-                        # 2) Fallback local on billing hard limit
-                        if _looks_like_openai_billing_limit(msg):
-                            try:
-                                out_bytes, out_mime, out_ext = local_fallback_process(img_bytes)
-                                fallback_local += 1
-                                errors.append(f"{k}: OpenAI billing limit -> fallback local applied")
-                            except Exception as e2:
-                                failed += 1
-                                errors.append(f"{k}: fallback local failed: {type(e2).__name__}: {e2}")
-                                continue
-                        else:
-                            failed += 1
-                            errors.append(f"{k}: {msg}")
-                            continue
-
-                    # 3) Upload result
-                    try:
-                        out_key = make_batch_output_key(job_id, k, out_ext)
-                        put_object_bytes(COS_OUTPUT_BUCKET, out_key, out_bytes, out_mime)
-                        processed += 1
-                    except Exception as e3:
-                        failed += 1
-                        errors.append(f"{k}: upload failed: {type(e3).__name__}: {e3}")
+# ==================================================
+# Binary uploads: stream multipart/form-data or a raw body to a temp file
+# ==================================================
+# Room for the multipart boundaries and the prompt/filename fields on top of the image itself
+_MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+_UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["image"],
+                    "properties": {
+                        "image": {"type": "string", "format": "binary"},
+                        "prompt": {"type": "string"},
+                        "filename": {"type": "string"},
+                    },
+                }
+            },
+            "application/octet-stream": {"schema": {"type": "string", "format": "binary"}},
+        },
+    }
+}
 
-                status = "completed" if failed == 0 else "completed_with_errors"
 
-        except Exception as e:
-            status = "failed"
-            error_message = f"{type(e).__name__}: {e}"
+def _upload_too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Image trop grande (>{MAX_UPLOAD_BYTES} octets)")
 
-        duration_seconds = round(time.perf_counter() - start, 3)
 
-        payload = {
-            "status": status,
-            "job_id": job_id,
-            "total_files": total_files,
-            "processed": processed,
-            "failed": failed,
-            "fallback_local": fallback_local,
-            "duration_seconds": duration_seconds,
-            "total_files_processed": processed,
-            "output_bucket": COS_OUTPUT_BUCKET,
-            "output_prefix": f"{COS_OUTPUT_PREFIX}/{job_id}/",
-            "errors": errors[:20],
+def _size_limited_receive(request: Request, max_bytes: int) -> Callable[[], Awaitable[dict]]:
+    # ASGI receive wrapper: aborts the form parser as soon as the body crosses max_bytes
+    received = 0
+
+    async def receive() -> dict:
+        nonlocal received
+        message = await request.receive()
+        if message["type"] == "http.request":
+            received += len(message.get("body", b""))
+            if received > max_bytes:
+                raise _upload_too_large()
+        return message
+
+    return receive
+
+
+async def receive_upload(request: Request, x_prompt: Optional[str], x_filename: Optional[str]) -> UploadImageRequest:
+    """
+    Stream the image to a temp file, rejecting oversized bodies early (Content-Length, then while reading).
+    multipart/form-data: file field "image", optional fields "prompt" / "filename".
+    Raw body (application/octet-stream or image/*): prompt/filename in x-prompt / x-filename (URL-encoded).
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    is_form = content_type == "multipart/form-data"
+    if not is_form and content_type != "application/octet-stream" and not content_type.startswith("image/"):
+        raise HTTPException(
+            status_code=415,
+            detail="Content-Type attendu : multipart/form-data, application/octet-stream ou image/*",
+        )
+
+    max_body = MAX_UPLOAD_BYTES + (_MULTIPART_OVERHEAD_BYTES if is_form else 0)
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > max_body:
+        raise _upload_too_large()
+
+    prompt = unquote(x_prompt) if x_prompt else None
+    filename = unquote(x_filename) if x_filename else None
+
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    out = tempfile.NamedTemporaryFile(dir=UPLOAD_TMP_DIR, prefix="upload-", delete=False)
+    try:
+        if is_form:
+            form = await Request(request.scope, _size_limited_receive(request, max_body)).form(max_files=1)
+            try:
+                image = form.get("image")
+                if image is None or isinstance(image, str):
+                    raise HTTPException(status_code=422, detail="Champ fichier 'image' manquant")
+                if image.size is not None and image.size > MAX_UPLOAD_BYTES:
+                    raise _upload_too_large()
+                prompt = form.get("prompt") or prompt
+                filename = form.get("filename") or image.filename or filename
+                await run_blocking(shutil.copyfileobj, image.file, out, 1024 * 1024)
+            finally:
+                await form.close()
+        else:
+            size = 0
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise _upload_too_large()
+                out.write(chunk)  # small chunks into the page cache: cheaper than an executor hop each
+        size = out.tell()
+        out.close()
+
+        if size == 0:
+            raise HTTPException(status_code=422, detail="Image vide")
+        if not prompt or not prompt.strip():
+            raise HTTPException(status_code=422, detail="prompt manquant (header x-prompt ou champ de formulaire prompt)")
+    except BaseException:
+        out.close()
+        os.remove(out.name)
+        raise
+
+    return UploadImageRequest(prompt=prompt, filename=filename, upload_path=out.name)
+
+
+# ==================================================
+# Duplicate submissions (Idempotency-Key + single-flight)
+# ==================================================
+def request_fingerprint(kind: str, body: BaseModel) -> str:
+    """
+    sha256 of everything that determines a job's result: endpoint kind, request fields and,
+    for binary uploads, the image bytes rather than the temp file path.
+    """
+    h = hashlib.sha256(kind.encode("utf-8"))
+    h.update(json.dumps(body.model_dump(mode="json", exclude={"upload_path"}), sort_keys=True).encode("utf-8"))
+    if isinstance(body, UploadImageRequest):
+        with open(body.upload_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class JobCoalescer:
+    """
+    Single-flight for job submissions: a dedup key (Idempotency-Key header or content fingerprint)
+    points at the job doing the work. Duplicates attach their callbackUrl to it instead of spending
+    a lane slot and an OpenAI edit. Job state is read from the job store, so with the sqlite store
+    jobs finished by queue-mode workers are seen too.
+    """
+
+    def __init__(self, enabled: bool, ttl_seconds: float) -> None:
+        self.enabled = enabled
+        self.ttl = max(ttl_seconds, 0.0)
+        # key -> {job_id, fingerprint, explicit, expires_at}; insertion order = expiry order
+        self._keys: OrderedDict = OrderedDict()
+        self.coalesced = 0
+        self.replayed = 0
+
+    def _purge(self, now: float) -> None:
+        while self._keys:
+            key, entry = next(iter(self._keys.items()))
+            if entry["expires_at"] > now:
+                break
+            del self._keys[key]
+
+    def attach(self, idempotency_key: Optional[str], fingerprint: str, callback_url: str) -> tuple[Optional[str], Optional[dict]]:
+        """
+        (job_id, None) if a running job already does this work (callback_url attached to it),
+        (job_id, payload) if it has finished and its result should be replayed, (None, None) otherwise.
+        """
+        if not self.enabled:
+            return None, None
+        self._purge(time.monotonic())
+
+        entry = self._keys.get(f"key:{idempotency_key}") if idempotency_key else None
+        if entry is not None and entry["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key déjà utilisée pour une requête différente")
+        if entry is None:
+            entry = self._keys.get(f"content:{fingerprint}")
+            if entry is None:
+                return None, None
+
+        job_id = entry["job_id"]
+        record = job_store.attach_callback(job_id, callback_url)
+        if record is not None:
+            if record["state"] not in ("completed", "failed"):
+                if idempotency_key and f"key:{idempotency_key}" not in self._keys:
+                    # Matched by content: the key now names this job too, for later replays
+                    self._keys[f"key:{idempotency_key}"] = {
+                        "job_id": job_id,
+                        "fingerprint": fingerprint,
+                        "explicit": True,
+                        "expires_at": time.monotonic() + self.ttl,
+                    }
+                self.coalesced += 1
+                return job_id, None
+            # Finished in another process meanwhile: replay rather than risk a missed callback
+
+        # A result kept without its image (JOB_STORE_MAX_BYTES) cannot be replayed
+        result = (record or {}).get("result")
+        if result is not None and not result.get("result_image_omitted") and entry["explicit"]:
+            self.replayed += 1
+            return job_id, result
+
+        # Content keys only cover work in flight: a finished (or forgotten) job means new work
+        self._keys.pop(f"content:{fingerprint}", None)
+        return None, None
+
+    def register(self, job_id: str, idempotency_key: Optional[str], fingerprint: str) -> None:
+        if not self.enabled:
+            return
+        expires_at = time.monotonic() + self.ttl
+        self._keys[f"content:{fingerprint}"] = {"job_id": job_id, "fingerprint": fingerprint, "explicit": False, "expires_at": expires_at}
+        if idempotency_key:
+            self._keys[f"key:{idempotency_key}"] = {"job_id": job_id, "fingerprint": fingerprint, "explicit": True, "expires_at": expires_at}
+
+    def release(self, job_id: str) -> None:
+        # Repeats of finished work are the result cache's job; Idempotency-Keys stay for replays
+        for key in [k for k, e in self._keys.items() if e["job_id"] == job_id and not e["explicit"]]:
+            del self._keys[key]
+
+    def forget(self, job_id: str) -> None:
+        # The submission failed before the job could run: no key may lead to it
+        for key in [k for k, e in self._keys.items() if e["job_id"] == job_id]:
+            del self._keys[key]
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "ttl_seconds": self.ttl,
+            "keys": len(self._keys),
+            "coalesced": self.coalesced,
+            "replayed": self.replayed,
         }
-        if error_message:
-            payload["error"] = error_message
 
+
+job_coalescer = JobCoalescer(COALESCE_DUPLICATES, IDEMPOTENCY_TTL_SECONDS)
+
+
+# ==================================================
+# Job submission: in-process BackgroundTasks or durable queue (JOB_EXECUTION_MODE)
+# ==================================================
+# kind -> (scheduler lane, request model, background job)
+JOB_KINDS = {
+    "url": ("single", ProcessImageRequest, process_and_callback_url),
+    "b64": ("single", ProcessImageRequest, process_and_callback_b64),
+    "url_upload": ("single", UploadImageRequest, process_and_callback_url),
+    "b64_upload": ("single", UploadImageRequest, process_and_callback_b64),
+    "url_cos": ("single", CosImageRequest, process_and_callback_url),
+    "b64_cos": ("single", CosImageRequest, process_and_callback_b64),
+    "batch": ("batch", BatchProcessRequest, batch_process_and_callback),
+}
+
+
+def job_footprint(kind: str, body: BaseModel) -> int:
+    """
+    Estimated peak bytes of a single-image job: request text, decoded input + preprocessed copy,
+    result (+ base64 text and callback JSON on the b64 paths). Batch jobs reserve per item instead.
+    """
+    if JOB_KINDS[kind][0] != "single":
+        return 0
+    body_bytes = 0
+    if isinstance(body, ProcessImageRequest):
+        body_bytes = len(body.image_base64)
+        input_bytes = body_bytes * 3 // 4
+    elif isinstance(body, UploadImageRequest):
         try:
-            await post_callback(callback_url, payload)
-        except Exception as cb_err:
-            print("!!! CALLBACK FAILED (BATCH) !!!", repr(cb_err))
+            input_bytes = os.path.getsize(body.upload_path)
+        except OSError:
+            input_bytes = 0  # the job fails on read anyway
+    else:
+        input_bytes = MAX_UPLOAD_BYTES  # COS object: size unknown until downloaded, assume the cap
+    result_bytes = result_estimate(None if isinstance(body, CosImageRequest) else input_bytes)
+    if kind.startswith("b64"):
+        result_bytes = result_bytes * 11 // 3  # + base64 text (4/3) + JSON body (4/3)
+    return body_bytes + 2 * input_bytes + result_bytes
+
+
+def job_deadline(lane: str, deadline_seconds: Optional[float]) -> Optional[float]:
+    """
+    Absolute deadline (epoch seconds) of a job accepted now: x-deadline-seconds, else the lane default; None if 0.
+    Capped at MAX_DEADLINE_SECONDS.
+    """
+    if deadline_seconds is None:
+        deadline_seconds = JOB_DEADLINE_SECONDS if lane == "single" else BATCH_JOB_DEADLINE_SECONDS
+    # NaN would read as "no deadline" and inf / 1e12 overflow the timestamps: refused, not guessed
+    if not math.isfinite(deadline_seconds) or deadline_seconds < 0:
+        raise HTTPException(status_code=422, detail="x-deadline-seconds doit être un nombre fini positif (0 = sans délai)")
+    if deadline_seconds == 0:
+        return None
+    return time.time() + min(deadline_seconds, MAX_DEADLINE_SECONDS)
+
+
+async def submit_job(
+    background_tasks: BackgroundTasks,
+    kind: str,
+    body: BaseModel,
+    callback_url: str,
+    idempotency_key: Optional[str] = None,
+    deadline_seconds: Optional[float] = None,
+) -> str:
+    """
+    Attach duplicates to the job already doing the work, otherwise admit the job (429/503 when its
+    lane is full), register it in the job store, then either schedule it in this process or hand it
+    to the job queue for a worker. The job deadline counts from acceptance. Returns the job_id.
+    """
+    lane, _model, fn = JOB_KINDS[kind]
+    deadline = job_deadline(lane, deadline_seconds)
+    idempotency_key = (idempotency_key or "").strip() or None
+    fingerprint = await run_blocking(request_fingerprint, kind, body) if job_coalescer.enabled else ""
+    queued = None
+    if job_queue is not None:
+        # Queue mode admits against the durable queue depth (read in the pool: SQLite)
+        queued = (await run_blocking(job_queue.stats, time.time())).get(lane, {}).get("queued", 0)
+
+    # No await from here on: lookup, admission and registration happen as one step on the event loop
+    job_id, replay = job_coalescer.attach(idempotency_key, fingerprint, callback_url)
+    if job_id is not None:
+        discard_request_upload(body)
+        if replay is not None:
+            await post_callback(callback_url, replay, label="REPLAY")
+        print(f"[COALESCED] {kind} -> job_id={job_id} ({'replayed' if replay is not None else 'attached'})")
+        return job_id
+
+    footprint = job_footprint(kind, body)
+    if not memory_budget.fits(footprint):
+        memory_budget.rejected_too_large += 1
+        raise HTTPException(
+            status_code=413,
+            detail=f"Requête trop volumineuse pour le budget mémoire (~{footprint} > {memory_budget.limit} octets)",
+        )
+
+    if job_queue is not None:
+        # The body goes to the queue file: workers reserve memory when they claim the job
+        admitted_at = job_scheduler.admit(lane, queued=queued)
+        reserved = 0
+    else:
+        # In-process, a waiting job already holds its body: reserve from admission on
+        reserved = memory_budget.try_reserve(footprint)
+        if reserved is None:
+            memory_budget.rejected_busy += 1
+            retry_after = job_scheduler.lanes[lane].retry_after_seconds()
+            print(f"[MEMORY] budget busy ({memory_budget.reserved}/{memory_budget.limit} bytes, job ~{footprint}) -> 429")
+            raise HTTPException(
+                status_code=429,
+                detail=f"Budget mémoire saturé, réessayez dans {retry_after}s",
+                headers={"Retry-After": str(retry_after)},
+            )
+        try:
+            admitted_at = job_scheduler.admit(lane)
+        except BaseException:
+            memory_budget.release(reserved)
+            raise
+
+    job_id = str(uuid.uuid4())
+    try:
+        job_store.create(job_id, kind=kind, deadline=deadline)
+        job_coalescer.register(job_id, idempotency_key, fingerprint)
+        if job_queue is not None:
+            # json.dumps of a base64 body (up to ~14 MB) + SQLite insert: in the pool, after registration
+            entry = {
+                "job_id": job_id,
+                "lane": lane,
+                "kind": kind,
+                "callback_url": callback_url,
+                "request": body.model_dump(mode="json"),
+                "enqueued_at": time.time(),
+                "deadline": deadline,
+            }
+            await run_blocking(job_queue.put, entry)
+        else:
+            background_tasks.add_task(
+                job_scheduler.run, lane, admitted_at, run_job, reserved, deadline, fn, job_id, body, callback_url
+            )
+    except BaseException:
+        # Nothing will run this job: give back its lane place and memory, drop its dedup keys
+        job_coalescer.forget(job_id)
+        if job_queue is None:
+            job_scheduler.withdraw(lane)
+        memory_budget.release(reserved)
+        try:
+            job_store.update(job_id, state="failed", finished_at=_utc_now_iso())
+        except Exception as e:
+            print(f"[JOB] could not mark job_id={job_id} failed: {e!r}")
+        raise
+    return job_id
 
 
 # ==================================================
@@ -608,6 +4065,8 @@ async def process_image_async(
     background_tasks: BackgroundTasks,
     callbackUrl: str = Header(...),
     x_workshop_token: Optional[str] = Header(default=None, alias="x-workshop-token"),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    x_deadline_seconds: Optional[float] = Header(default=None, alias="x-deadline-seconds"),
 ):
     _require_workshop_token(x_workshop_token)
 
@@ -617,9 +4076,8 @@ async def process_image_async(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    job_id = str(uuid.uuid4())
+    job_id = await submit_job(background_tasks, "url", body, callbackUrl, idempotency_key, x_deadline_seconds)
     print(f"[ACCEPTED] /process-image-async job_id={job_id} filename={body.filename}")
-    background_tasks.add_task(process_and_callback_url, job_id, body, callbackUrl)
     return {"accepted": True, "job_id": job_id}
 
 
@@ -629,6 +4087,8 @@ async def process_image_async_b64(
     background_tasks: BackgroundTasks,
     callbackUrl: str = Header(...),
     x_workshop_token: Optional[str] = Header(default=None, alias="x-workshop-token"),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    x_deadline_seconds: Optional[float] = Header(default=None, alias="x-deadline-seconds"),
 ):
     _require_workshop_token(x_workshop_token)
 
@@ -637,9 +4097,133 @@ async def process_image_async_b64(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    job_id = str(uuid.uuid4())
+    job_id = await submit_job(background_tasks, "b64", body, callbackUrl, idempotency_key, x_deadline_seconds)
     print(f"[ACCEPTED] /process-image-async-b64 job_id={job_id} filename={body.filename}")
-    background_tasks.add_task(process_and_callback_b64, job_id, body, callbackUrl)
+    return {"accepted": True, "job_id": job_id}
+
+
+@app.post("/process-image-upload", status_code=202, openapi_extra=_UPLOAD_OPENAPI)
+async def process_image_upload(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    callbackUrl: str = Header(...),
+    x_prompt: Optional[str] = Header(default=None, alias="x-prompt"),
+    x_filename: Optional[str] = Header(default=None, alias="x-filename"),
+    x_workshop_token: Optional[str] = Header(default=None, alias="x-workshop-token"),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    x_deadline_seconds: Optional[float] = Header(default=None, alias="x-deadline-seconds"),
+):
+    _require_workshop_token(x_workshop_token)
+
+    try:
+        _require_cos_config()
+        _require_openai_config()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    upload = await receive_upload(request, x_prompt, x_filename)
+    try:
+        job_id = await submit_job(background_tasks, "url_upload", upload, callbackUrl, idempotency_key, x_deadline_seconds)
+    except BaseException:
+        discard_request_upload(upload)
+        raise
+    print(f"[ACCEPTED] /process-image-upload job_id={job_id} filename={upload.filename}")
+    return {"accepted": True, "job_id": job_id}
+
+
+@app.post("/process-image-upload-b64", status_code=202, openapi_extra=_UPLOAD_OPENAPI)
+async def process_image_upload_b64(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    callbackUrl: str = Header(...),
+    x_prompt: Optional[str] = Header(default=None, alias="x-prompt"),
+    x_filename: Optional[str] = Header(default=None, alias="x-filename"),
+    x_workshop_token: Optional[str] = Header(default=None, alias="x-workshop-token"),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    x_deadline_seconds: Optional[float] = Header(default=None, alias="x-deadline-seconds"),
+):
+    _require_workshop_token(x_workshop_token)
+
+    try:
+        _require_openai_config()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    upload = await receive_upload(request, x_prompt, x_filename)
+    try:
+        job_id = await submit_job(background_tasks, "b64_upload", upload, callbackUrl, idempotency_key, x_deadline_seconds)
+    except BaseException:
+        discard_request_upload(upload)
+        raise
+    print(f"[ACCEPTED] /process-image-upload-b64 job_id={job_id} filename={upload.filename}")
+    return {"accepted": True, "job_id": job_id}
+
+
+@app.post("/uploads/presign")
+def presign_upload(
+    body: UploadPresignRequest,
+    x_workshop_token: Optional[str] = Header(default=None, alias="x-workshop-token"),
+):
+    _require_workshop_token(x_workshop_token)
+
+    try:
+        _require_cos_config()
+        if not COS_INPUT_BUCKET:
+            raise RuntimeError("Missing env var: COS_INPUT_BUCKET")
+        return presign_input_upload(body)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/process-image-from-cos", status_code=202)
+async def process_image_from_cos(
+    body: CosImageRequest,
+    background_tasks: BackgroundTasks,
+    callbackUrl: str = Header(...),
+    x_workshop_token: Optional[str] = Header(default=None, alias="x-workshop-token"),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    x_deadline_seconds: Optional[float] = Header(default=None, alias="x-deadline-seconds"),
+):
+    _require_workshop_token(x_workshop_token)
+
+    try:
+        _require_cos_config()
+        _require_openai_config()
+        if not COS_INPUT_BUCKET:
+            raise RuntimeError("Missing env var: COS_INPUT_BUCKET")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if not body.filename:
+        body.filename = os.path.basename(body.object_key)
+    job_id = await submit_job(background_tasks, "url_cos", body, callbackUrl, idempotency_key, x_deadline_seconds)
+    print(f"[ACCEPTED] /process-image-from-cos job_id={job_id} object_key={body.object_key}")
+    return {"accepted": True, "job_id": job_id}
+
+
+@app.post("/process-image-from-cos-b64", status_code=202)
+async def process_image_from_cos_b64(
+    body: CosImageRequest,
+    background_tasks: BackgroundTasks,
+    callbackUrl: str = Header(...),
+    x_workshop_token: Optional[str] = Header(default=None, alias="x-workshop-token"),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    x_deadline_seconds: Optional[float] = Header(default=None, alias="x-deadline-seconds"),
+):
+    _require_workshop_token(x_workshop_token)
+
+    try:
+        _require_cos_config()
+        _require_openai_config()
+        if not COS_INPUT_BUCKET:
+            raise RuntimeError("Missing env var: COS_INPUT_BUCKET")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if not body.filename:
+        body.filename = os.path.basename(body.object_key)
+    job_id = await submit_job(background_tasks, "b64_cos", body, callbackUrl, idempotency_key, x_deadline_seconds)
+    print(f"[ACCEPTED] /process-image-from-cos-b64 job_id={job_id} object_key={body.object_key}")
     return {"accepted": True, "job_id": job_id}
 
 
@@ -649,9 +4233,16 @@ async def batch_process_images(
     background_tasks: BackgroundTasks,
     callbackUrl: str = Header(...),
     x_workshop_token: Optional[str] = Header(default=None, alias="x-workshop-token"),
+    idempotency_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
+    x_deadline_seconds: Optional[float] = Header(default=None, alias="x-deadline-seconds"),
 ):
     _require_workshop_token(x_workshop_token)
 
+    try:
+        batch_variants(body)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
     try:
         _require_cos_config()
         _require_openai_config()
@@ -660,12 +4251,24 @@ async def batch_process_images(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-    job_id = str(uuid.uuid4())
+    job_id = await submit_job(background_tasks, "batch", body, callbackUrl, idempotency_key, x_deadline_seconds)
     print(f"[ACCEPTED] /batch-process-images job_id={job_id}")
-    background_tasks.add_task(batch_process_and_callback, job_id, body, callbackUrl)
     return {"accepted": True, "job_id": job_id}
 
 
+@app.get("/jobs/{job_id}")
+def get_job(
+    job_id: str,
+    x_workshop_token: Optional[str] = Header(default=None, alias="x-workshop-token"),
+):
+    _require_workshop_token(x_workshop_token)
+
+    record = job_store.get(job_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job_id: {job_id}")
+    return record
+
+
 # ==================================================
 # Health / Config
 # ==================================================
@@ -676,12 +4279,44 @@ def health():
         "mode": "workshop",
         "callback_rewrite_enabled": ENABLE_CALLBACK_REWRITE,
         "max_concurrent_jobs": MAX_CONCURRENT_JOBS,
+        "execution_mode": JOB_EXECUTION_MODE,
+        "job_queue": job_queue.stats(time.time()) if job_queue is not None else None,
+        "scheduler": job_scheduler.stats(),
+        "job_store_backend": JOB_STORE_BACKEND,
+        "result_cache": result_cache.stats(),
+        "preprocess": input_preprocessor.stats(),
+        "openai_limiter": openai_limiter.stats(),
+        "openai_breaker": openai_breaker.stats(),
+        "blocking_max_workers": BLOCKING_MAX_WORKERS,
         "callback_retries": CALLBACK_MAX_RETRIES,
+        "callback_queue": callback_dispatcher.stats(),
+        "b64_delivery": b64_delivery.stats(),
+        "coalescing": job_coalescer.stats(),
+        "memory_budget": memory_budget.stats(),
+        "deadlines": {
+            "single_seconds": JOB_DEADLINE_SECONDS,
+            "batch_seconds": BATCH_JOB_DEADLINE_SECONDS,
+            "reserve_seconds": DEADLINE_RESERVE_SECONDS,
+            "fallback_quality": DEADLINE_FALLBACK_QUALITY or None,
+            "openai_expected_seconds": openai_latency.stats(),
+        },
         "fallback_single_enabled": ENABLE_FALLBACK_SINGLE,
+        "fallback_process_workers": FALLBACK_PROCESS_WORKERS,
         "workshop_token_enabled": bool(WORKSHOP_TOKEN),
+        "metrics_enabled": METRICS_ENABLED,
     }
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """
+    Prometheus exposition: wxo_stage_seconds per stage, callbacks, lane/queue occupancy, process metrics.
+    """
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Métriques désactivées (METRICS_ENABLED=false)")
+    return Response(generate_latest(METRICS_REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/cos/config")
 def cos_config(
     x_workshop_token: Optional[str] = Header(default=None, alias="x-workshop-token"),
@@ -696,5 +4331,107 @@ def cos_config(
         "output_bucket": COS_OUTPUT_BUCKET,
         "input_prefix": COS_INPUT_PREFIX,
         "output_prefix": COS_OUTPUT_PREFIX,
+        "upload_prefix": COS_UPLOAD_PREFIX,
         "presign_expires": COS_PRESIGN_EXPIRES,
     }
+
+
+# ==================================================
+# Worker (JOB_EXECUTION_MODE=queue): run_worker(), started by worker.py
+# ==================================================
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+async def _keep_lease(job_id: str) -> None:
+    while True:
+        await asyncio.sleep(max(JOB_QUEUE_LEASE_SECONDS / 3, 0.5))
+        await run_blocking(job_queue.renew, job_id, WORKER_ID, time.time() + JOB_QUEUE_LEASE_SECONDS)
+
+
+async def run_queued_job(entry: dict) -> None:
+    """
+    Run one claimed job with the same background function as the in-process mode, then ack it.
+    If the worker dies mid-job the lease expires and another worker claims it again.
+    """
+    job_id = entry["job_id"]
+    lane_name, model, fn = JOB_KINDS[entry["kind"]]
+    lane = job_scheduler.lanes[lane_name]
+    lane.record_start(max(time.time() - entry["enqueued_at"], 0.0))
+    heartbeat = asyncio.create_task(_keep_lease(job_id))
+    start = time.monotonic()
+    try:
+        if entry["attempts"] > JOB_QUEUE_MAX_ATTEMPTS:
+            # The job keeps losing its worker: report it instead of claiming it forever
+            raise RuntimeError(f"Job abandonné après {entry['attempts'] - 1} tentatives (worker interrompu)")
+        req = model.model_validate(entry["request"])
+        reserved = await memory_budget.reserve(job_footprint(entry["kind"], req))
+        await run_job(reserved, entry.get("deadline"), fn, job_id, req, entry["callback_url"])
+    except Exception as e:
+        payload = {"status": "failed", "job_id": job_id, "error": f"{type(e).__name__}: {e}"}
+        await deliver_job_result(job_id, entry["callback_url"], payload, label="WORKER")
+    finally:
+        heartbeat.cancel()
+        lane.record_finish(time.monotonic() - start)
+    await run_blocking(job_queue.ack, job_id)
+
+
+async def _worker_slot(lane_name: str, stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        try:
+            entry = await run_blocking(job_queue.claim, lane_name, WORKER_ID, time.time(), JOB_QUEUE_LEASE_SECONDS)
+            if entry is not None:
+                print(f"[WORKER] claimed job_id={entry['job_id']} kind={entry['kind']} attempt={entry['attempts']}")
+                await run_queued_job(entry)
+                continue
+        except Exception as e:
+            # A transient store error (SQLite locked...) must not end the slot and, with it, the worker.
+            # A job whose ack failed keeps its lease until it expires, then runs again
+            print(f"[WORKER] {lane_name} slot: job queue error ({type(e).__name__}: {e})")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=JOB_QUEUE_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_worker() -> None:
+    """
+    One slot per lane capacity (MAX_CONCURRENT_JOBS / MAX_CONCURRENT_BATCH_JOBS per worker process).
+    SIGTERM/SIGINT: stop claiming and let running jobs finish.
+    """
+    if job_queue is None:
+        raise RuntimeError("JOB_EXECUTION_MODE=queue requis pour lancer un worker")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    if WORKER_METRICS_PORT > 0:
+        # The API's /metrics only sees its own process: each worker exposes its stages on its own port
+        start_http_server(WORKER_METRICS_PORT, registry=METRICS_REGISTRY)
+        print(f"[WORKER] metrics on :{WORKER_METRICS_PORT}/metrics")
+
+    await callback_dispatcher.start()
+    slots = [
+        asyncio.create_task(_worker_slot(lane.name, stop))
+        for lane in job_scheduler.lanes.values()
+        for _ in range(lane.limit)
+    ]
+    lanes = ", ".join(f"{name}={lane.limit}" for name, lane in job_scheduler.lanes.items())
+    print(f"[WORKER] {WORKER_ID} started ({lanes})")
+    try:
+        await asyncio.gather(*slots)
+    finally:
+        shutdown_fallback_pool()
+        await callback_dispatcher.stop()
+        await close_async_openai_client()
+        print(f"[WORKER] {WORKER_ID} stopped")
+
+
+if __name__ == "__main__":
+    # Not an entry point: as __main__, main.py would be re-imported by every spawned fallback process
+    print("Usage: uvicorn main:app (API) or python worker.py (queue-mode worker)")
+    sys.exit(2)
@@ -0,0 +1,33 @@
+"""
+Unit tests import main directly: its SQLite files go to a temp directory, and each test gets
+fresh module-level state (job store, coalescer, scheduler, memory budget).
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+_TMP = tempfile.mkdtemp(prefix="wxo-tests-")
+os.environ.setdefault("CALLBACK_QUEUE_PATH", os.path.join(_TMP, "callbacks.db"))
+os.environ.setdefault("JOB_STORE_PATH", os.path.join(_TMP, "jobs.db"))
+os.environ.setdefault("JOB_QUEUE_PATH", os.path.join(_TMP, "jobqueue.db"))
+os.environ.setdefault("UPLOAD_TMP_DIR", os.path.join(_TMP, "uploads"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setattr(main, "job_store", main.InMemoryJobStore(100, 0))
+    monkeypatch.setattr(main, "job_coalescer", main.JobCoalescer(True, 3600))
+    monkeypatch.setattr(main, "job_queue", None)
+    monkeypatch.setattr(main, "memory_budget", main.MemoryBudget(1_000_000, {"batch": 0.5}))
+    monkeypatch.setattr(main, "job_scheduler", main.JobScheduler([
+        main.SchedulerLane("single", 1, 2, expected_run_seconds=1.0),
+        main.SchedulerLane("batch", 1, 1, expected_run_seconds=1.0),
+    ]))
+    return main
@@ -0,0 +1,161 @@
+import asyncio
+import base64
+import math
+
+import pytest
+from fastapi import BackgroundTasks, HTTPException
+
+
+def b64_request(main, prompt="p", size=300):
+    image = base64.b64encode(b"x" * size).decode()
+    return main.ProcessImageRequest(prompt=prompt, image_base64=image, filename="a.png")
+
+
+# ==================================================
+# MemoryBudget
+# ==================================================
+def test_try_reserve_refuses_when_full_and_release_frees(service):
+    budget = service.MemoryBudget(100)
+    assert budget.try_reserve(60) == 60
+    assert budget.try_reserve(60) is None
+    budget.release(60)
+    assert budget.try_reserve(60) == 60
+    assert budget.stats()["reserved_bytes"] == 60
+
+
+def test_oversized_reservation_is_clamped_to_lane_limit(service):
+    budget = service.MemoryBudget(100, {"batch": 0.5})
+    assert not budget.fits(150)
+    assert budget.fits(150, "single") is False
+    assert budget.try_reserve(500, "batch") == 50
+
+
+def test_batch_waiters_do_not_block_single_lane(service):
+    budget = service.MemoryBudget(100, {"batch": 0.5})
+
+    async def scenario():
+        first = await budget.reserve(50, "batch")
+        waiter = asyncio.ensure_future(budget.reserve(30, "batch"))
+        await asyncio.sleep(0)
+        assert budget.stats()["waiting"] == 1
+        # The batch lane is at its share: single-image jobs still get the rest
+        assert budget.try_reserve(40) == 40
+        budget.release(first, "batch")
+        assert await waiter == 30
+        return budget.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["lanes"]["batch"]["reserved_bytes"] == 30
+    assert stats["lanes"]["single"]["reserved_bytes"] == 40
+    assert stats["waiting"] == 0
+
+
+def test_cancelled_waiter_leaves_nothing_reserved(service):
+    budget = service.MemoryBudget(100)
+
+    async def scenario():
+        held = await budget.reserve(80)
+        waiter = asyncio.ensure_future(budget.reserve(50))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        budget.release(held)
+
+    asyncio.run(scenario())
+    assert budget.reserved == 0
+    assert budget.stats()["waiting"] == 0
+
+
+def test_result_estimate_follows_input_size(service, monkeypatch):
+    monkeypatch.setattr(service, "MEMORY_RESULT_ESTIMATE_BYTES", 1000)
+    monkeypatch.setattr(service, "MEMORY_RESULT_INPUT_RATIO", 4.0)
+    assert service.result_estimate(100) == 400
+    assert service.result_estimate(10_000) == 1000
+    assert service.result_estimate(None) == 1000
+
+
+# ==================================================
+# JobScheduler
+# ==================================================
+def test_admit_rejects_full_lane_with_retry_after(service):
+    lane = service.job_scheduler.lanes["single"]
+    lane.in_flight = lane.limit
+    service.job_scheduler.admit("single")
+    service.job_scheduler.admit("single")
+    with pytest.raises(HTTPException) as exc:
+        service.job_scheduler.admit("single")
+    assert exc.value.status_code == 429
+    assert "Retry-After" in exc.value.headers
+    service.job_scheduler.withdraw("single")
+    assert lane.queued == 1
+
+
+def test_admit_refuses_while_shutting_down(service):
+    service.job_scheduler.close()
+    with pytest.raises(HTTPException) as exc:
+        service.job_scheduler.admit("single")
+    assert exc.value.status_code == 503
+
+
+# ==================================================
+# submit_job
+# ==================================================
+def test_submit_job_reserves_and_schedules(service):
+    tasks = BackgroundTasks()
+    job_id = asyncio.run(service.submit_job(tasks, "b64", b64_request(service), "http://cb/1"))
+    assert len(tasks.tasks) == 1
+    assert service.memory_budget.reserved > 0
+    assert service.job_scheduler.lanes["single"].queued == 1
+    assert service.job_store.get(job_id)["state"] == "accepted"
+
+
+def test_submit_job_releases_everything_when_registration_fails(service, monkeypatch):
+    register = service.job_coalescer.register
+    created = []
+
+    def register_then_fail(job_id, *args):
+        register(job_id, *args)
+        created.append(job_id)
+        raise RuntimeError("queue down")
+
+    monkeypatch.setattr(service.job_coalescer, "register", register_then_fail)
+    with pytest.raises(RuntimeError):
+        asyncio.run(service.submit_job(BackgroundTasks(), "b64", b64_request(service), "http://cb/1", "key-1"))
+    assert service.memory_budget.reserved == 0
+    assert service.job_scheduler.lanes["single"].queued == 0
+    assert service.job_coalescer.stats()["keys"] == 0
+    assert service.job_store.get(created[0])["state"] == "failed"
+
+
+def test_submit_job_busy_budget_is_429(service, monkeypatch):
+    monkeypatch.setattr(service, "memory_budget", service.MemoryBudget(10_000))
+    service.memory_budget.try_reserve(10_000)
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(service.submit_job(BackgroundTasks(), "b64", b64_request(service), "http://cb/1"))
+    assert exc.value.status_code == 429
+    assert service.job_scheduler.lanes["single"].queued == 0
+
+
+def test_submit_job_too_large_is_413(service, monkeypatch):
+    monkeypatch.setattr(service, "memory_budget", service.MemoryBudget(1000))
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(service.submit_job(BackgroundTasks(), "b64", b64_request(service), "http://cb/1"))
+    assert exc.value.status_code == 413
+
+
+# ==================================================
+# Deadlines
+# ==================================================
+@pytest.mark.parametrize("value", [math.nan, math.inf, -1.0])
+def test_job_deadline_rejects_invalid_values(service, value):
+    with pytest.raises(HTTPException) as exc:
+        service.job_deadline("single", value)
+    assert exc.value.status_code == 422
+
+
+def test_job_deadline_caps_and_zero_means_none(service, monkeypatch):
+    monkeypatch.setattr(service, "MAX_DEADLINE_SECONDS", 60.0)
+    assert service.job_deadline("single", 0) is None
+    deadline = service.job_deadline("single", 1e12)
+    assert deadline - service.time.time() <= 60.0
@@ -0,0 +1,27 @@
+import asyncio
+import time
+
+
+def test_listing_stops_once_the_deadline_has_passed(service):
+    listed = []
+
+    async def keys():
+        for i in range(1000):
+            listed.append(i)
+            yield f"img{i}.jpg", 1024
+
+    async def scenario():
+        counters = service.BatchCounters("job-1")
+        token = service._job_deadline.set(time.time() - 1)
+        try:
+            variants = service.batch_variants(service.BatchProcessRequest(prompt="p"))
+            await service.run_batch_pipeline("job-1", keys(), variants, counters)
+        finally:
+            service._job_deadline.reset(token)
+        return counters
+
+    counters = asyncio.run(scenario())
+    assert len(listed) == 1
+    assert counters.failed == 1
+    assert counters.errors == ["délai du lot dépassé : 1 image(s) listée(s) non traitée(s), listing interrompu"]
+    assert service.memory_budget.reserved == 0
@@ -0,0 +1,89 @@
+import httpx
+import pytest
+from openai import APIConnectionError
+
+
+def connection_error():
+    return APIConnectionError(request=httpx.Request("POST", "https://api.openai.test/v1/images/edits"))
+
+
+def make_breaker(main, open_seconds=60.0, half_open_calls=1):
+    return main.CircuitBreaker(
+        True,
+        window=4,
+        min_calls=4,
+        error_rate=0.5,
+        slow_seconds=10.0,
+        slow_rate=0.5,
+        open_seconds=open_seconds,
+        half_open_calls=half_open_calls,
+    )
+
+
+def trip(breaker):
+    for _ in range(4):
+        breaker.allow()
+        breaker.record(0.1, connection_error())
+
+
+def test_opens_on_error_rate_and_refuses_calls(service):
+    breaker = make_breaker(service)
+    trip(breaker)
+    assert breaker.state == "open"
+    with pytest.raises(service.OpenAICircuitOpenError):
+        breaker.allow()
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_opens_on_slow_calls(service):
+    breaker = make_breaker(service)
+    for _ in range(4):
+        breaker.allow()
+        breaker.record(12.0)
+    assert breaker.state == "open"
+
+
+def test_client_errors_do_not_count(service):
+    breaker = make_breaker(service)
+    for _ in range(8):
+        breaker.allow()
+        breaker.record(0.1, ValueError("400 bad request"))
+    assert breaker.state == "closed"
+    assert breaker.stats()["calls"] == 0
+
+
+def test_half_open_probe_success_closes(service):
+    breaker = make_breaker(service, open_seconds=0.0)
+    trip(breaker)
+    breaker.allow()
+    assert breaker.state == "half_open"
+    with pytest.raises(service.OpenAICircuitOpenError):
+        breaker.allow()  # single probe already out
+    breaker.record(0.1)
+    assert breaker.state == "closed"
+
+
+def test_half_open_probe_failure_reopens(service):
+    breaker = make_breaker(service, open_seconds=0.0)
+    trip(breaker)
+    breaker.allow()
+    breaker.record(0.1, connection_error())
+    assert breaker.state == "open"
+    assert breaker.opened == 2
+
+
+def test_cancel_frees_the_half_open_probe(service):
+    breaker = make_breaker(service, open_seconds=0.0)
+    trip(breaker)
+    breaker.allow()
+    breaker.cancel()  # e.g. deadline hit while waiting for the rate limiter
+    breaker.allow()
+    breaker.record(0.1)
+    assert breaker.state == "closed"
+
+
+def test_disabled_breaker_never_opens(service):
+    breaker = service.CircuitBreaker(False, 4, 4, 0.5, 10.0, 0.5, 60.0, 1)
+    trip(breaker)
+    breaker.allow()
+    assert breaker.state == "closed"
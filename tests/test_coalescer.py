@@ -0,0 +1,81 @@
+import pytest
+from fastapi import HTTPException
+
+PAYLOAD = {"status": "completed", "job_id": "j1", "result_image_base64": "aGVsbG8="}
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, service, monkeypatch, tmp_path):
+    if request.param == "sqlite":
+        monkeypatch.setattr(service, "job_store", service.SqliteJobStore(str(tmp_path / "jobs.db")))
+    return service.job_store
+
+
+def start_job(service, idempotency_key=None, fingerprint="fp-1"):
+    service.job_store.create("j1", kind="b64")
+    service.job_coalescer.register("j1", idempotency_key, fingerprint)
+
+
+def test_unknown_request_is_new_work(service):
+    assert service.job_coalescer.attach(None, "fp-1", "http://cb/1") == (None, None)
+
+
+def test_duplicate_attaches_to_running_job(service, store):
+    start_job(service)
+    assert service.job_coalescer.attach(None, "fp-1", "http://cb/2") == ("j1", None)
+    assert service.job_coalescer.attach(None, "fp-1", "http://cb/2") == ("j1", None)
+    assert store.get("j1")["attached_callback_urls"] == ["http://cb/2"]
+    assert service.job_coalescer.stats()["coalesced"] == 2
+
+
+def test_finished_job_is_replayed_for_its_idempotency_key_only(service, store):
+    start_job(service, idempotency_key="key-1")
+    service.mark_job_finished("j1", PAYLOAD)
+
+    assert service.job_coalescer.attach("key-1", "fp-1", "http://cb/2") == ("j1", PAYLOAD)
+    # Without the key, identical content after completion is new work
+    assert service.job_coalescer.attach(None, "fp-1", "http://cb/3") == (None, None)
+    assert "http://cb/2" not in (store.get("j1").get("attached_callback_urls") or [])
+
+
+def test_idempotency_key_reused_for_other_request_is_422(service):
+    start_job(service, idempotency_key="key-1")
+    with pytest.raises(HTTPException) as exc:
+        service.job_coalescer.attach("key-1", "fp-2", "http://cb/2")
+    assert exc.value.status_code == 422
+
+
+def test_content_match_binds_the_new_idempotency_key(service):
+    start_job(service)
+    assert service.job_coalescer.attach("key-2", "fp-1", "http://cb/2") == ("j1", None)
+    service.mark_job_finished("j1", PAYLOAD)
+    assert service.job_coalescer.attach("key-2", "fp-1", "http://cb/3") == ("j1", PAYLOAD)
+
+
+def test_omitted_result_is_not_replayed(service):
+    start_job(service, idempotency_key="key-1")
+    service.mark_job_finished("j1", {**PAYLOAD, "result_image_base64": None, "result_image_omitted": True})
+    assert service.job_coalescer.attach("key-1", "fp-1", "http://cb/2") == (None, None)
+
+
+def test_release_and_forget(service):
+    start_job(service, idempotency_key="key-1")
+    service.job_coalescer.release("j1")
+    assert service.job_coalescer.stats()["keys"] == 1  # the Idempotency-Key stays for replays
+    service.job_coalescer.forget("j1")
+    assert service.job_coalescer.stats()["keys"] == 0
+
+
+def test_attach_callback_never_lands_on_a_finished_job(service, store):
+    store.create("j1", kind="b64")
+    service.mark_job_finished("j1", PAYLOAD)
+    record = store.attach_callback("j1", "http://cb/2")
+    assert record["state"] == "completed"
+    assert not store.get("j1").get("attached_callback_urls")
+    assert store.attach_callback("missing", "http://cb/2") is None
+
+
+def test_disabled_coalescer_attaches_nothing(service, monkeypatch):
+    monkeypatch.setattr(service, "job_coalescer", service.JobCoalescer(False, 3600))
+    start_job(service)
+    assert service.job_coalescer.attach(None, "fp-1", "http://cb/2") == (None, None)
@@ -0,0 +1,89 @@
+import asyncio
+import io
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+
+class FakeS3:
+    def __init__(self, objects=None):
+        self.objects = objects or {}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+
+def test_record_and_is_current(service):
+    manifest = service.BatchManifest("in-bucket", "demo/")
+    assert not manifest.dirty
+    manifest.record("demo/a.jpg", "etag-1", "hash-1", ["out/a.png"], "job-1")
+
+    assert manifest.dirty
+    assert manifest.is_current("demo/a.jpg", "etag-1", "hash-1")
+    assert not manifest.is_current("demo/a.jpg", "etag-2", "hash-1")  # input changed
+    assert not manifest.is_current("demo/a.jpg", "etag-1", "hash-2")  # prompt changed
+    assert not manifest.is_current("demo/b.jpg", "etag-1", "hash-1")
+    assert "output_keys" not in manifest.entries["demo/a.jpg"]
+
+
+def test_record_asks_for_flush_every_n_entries(service, monkeypatch):
+    monkeypatch.setattr(service, "BATCH_MANIFEST_FLUSH_EVERY", 2)
+    manifest = service.BatchManifest("in-bucket", "demo/")
+    assert not manifest.record("a", "e", "h", ["out/a"], "job-1")
+    assert manifest.record("b", "e", "h", ["out/b-1", "out/b-2"], "job-1")
+    assert manifest.entries["b"]["output_keys"] == ["out/b-1", "out/b-2"]
+
+
+def test_flush_then_load_round_trip(service, monkeypatch):
+    written = {}
+    monkeypatch.setattr(service, "put_object_bytes", lambda bucket, key, body, mime: written.__setitem__(key, body))
+
+    manifest = service.BatchManifest("in-bucket", "demo/")
+    manifest.record("demo/a.jpg", "etag-1", "hash-1", ["out/a.png"], "job-1")
+    asyncio.run(manifest.flush())
+    assert not manifest.dirty
+    assert json.loads(written[manifest.object_key])["input_prefix"] == "demo/"
+
+    monkeypatch.setattr(service, "get_s3_client", lambda: FakeS3(written))
+    reloaded = service.BatchManifest("in-bucket", "demo/")
+    reloaded.load()
+    assert reloaded.is_current("demo/a.jpg", "etag-1", "hash-1")
+
+
+def test_load_without_manifest_starts_empty(service, monkeypatch):
+    monkeypatch.setattr(service, "get_s3_client", lambda: FakeS3())
+    manifest = service.BatchManifest("in-bucket", "other/")
+    manifest.load()
+    assert manifest.entries == {}
+
+
+def test_manifest_scope_depends_on_bucket_and_prefix(service):
+    keys = {
+        service.BatchManifest("in-bucket", "demo/").object_key,
+        service.BatchManifest("in-bucket", "other/").object_key,
+        service.BatchManifest("in-2", "demo/").object_key,
+    }
+    assert len(keys) == 3
+
+
+def test_plain_batch_keeps_the_prompt_hash(service):
+    plain = service.batch_variants(service.BatchProcessRequest(prompt="make it blue"))
+    assert service.batch_variants_hash(plain) == service.batch_prompt_hash("make it blue")
+    fan_out = service.batch_variants(service.BatchProcessRequest(prompts=["a", "b"], output_formats=["png", "webp"]))
+    assert len(fan_out) == 4
+    assert service.batch_variants_hash(fan_out) != service.batch_variants_hash(plain)
+
+
+def test_failed_flush_keeps_entries_pending(service, monkeypatch):
+    def fail(*_args):
+        raise RuntimeError("manifest put failed")
+
+    monkeypatch.setattr(service, "put_object_bytes", fail)
+    manifest = service.BatchManifest("in-bucket", "demo/")
+    manifest.record("demo/a.jpg", "etag-1", "hash-1", ["out/a.png"], "job-1")
+    with pytest.raises(RuntimeError):
+        asyncio.run(manifest.flush())
+    assert manifest.dirty
@@ -0,0 +1,16 @@
+import asyncio
+
+
+def test_client_is_per_loop_and_closed_on_shutdown(service, monkeypatch):
+    monkeypatch.setattr(service, "OPENAI_API_KEY", "sk-test")
+
+    async def use_and_close():
+        client = service.get_async_openai_client()
+        assert service.get_async_openai_client() is client
+        await service.close_async_openai_client()
+        return client
+
+    first = asyncio.run(use_and_close())
+    assert first._client.is_closed
+    second = asyncio.run(use_and_close())
+    assert second is not first
@@ -0,0 +1,30 @@
+import asyncio
+import sqlite3
+
+
+class FlakyQueue:
+    """Job queue whose first claim fails like a locked SQLite file."""
+
+    def __init__(self, stop):
+        self.stop = stop
+        self.claims = 0
+
+    def claim(self, lane, worker_id, now, lease):
+        self.claims += 1
+        if self.claims == 1:
+            raise sqlite3.OperationalError("database is locked")
+        self.stop.set()
+        return None
+
+
+def test_worker_slot_survives_queue_errors(service, monkeypatch):
+    monkeypatch.setattr(service, "JOB_QUEUE_POLL_SECONDS", 0.01)
+
+    async def scenario():
+        stop = asyncio.Event()
+        queue = FlakyQueue(stop)
+        monkeypatch.setattr(service, "job_queue", queue)
+        await asyncio.wait_for(service._worker_slot("single", stop), timeout=5)
+        return queue.claims
+
+    assert asyncio.run(scenario()) == 2
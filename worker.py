@@ -0,0 +1,16 @@
+"""
+Queue-mode worker (JOB_EXECUTION_MODE=queue): runs the jobs the API enqueued.
+
+    python worker.py
+
+Kept out of main.py on purpose: the fallback process pool uses spawn, and spawn re-imports the
+parent's __main__ module in every pool process. main is only imported under the __main__ guard
+below, so those processes load this file and fallback_engine, not the app, its stores and clients.
+"""
+
+import asyncio
+
+if __name__ == "__main__":
+    import main
+
+    asyncio.run(main.run_worker())